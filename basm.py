@@ -1,187 +1,98 @@
+import concurrent.futures
+import hashlib
 import json
+import os
+import shutil
 import sys
+import time
+from typing import NamedTuple
 
-labels = {}
-
-def get_current_address() -> int:
-    return len(machine_code) // 2
-
-def assemble(opcode: str, args: list[str]) -> int:
-    if opcode == "ldi":
-        assert_amount_of_args(args, 2)
-        return 0b1010 << 12 | assemble_reg(args[0]) << 9 | assemble_immediate(args[1])
-    elif opcode == "jmp":
-        assert_amount_of_args(args, 1)
-        return 0b0010 << 12 | assemble_address(args[0])
-    elif opcode == "nop":
-        assert_amount_of_args(args, 0)
-        return 0b0000 << 12
-    elif opcode == "hlt":
-        assert_amount_of_args(args, 0)
-        return 0b0001 << 12
-    elif opcode == "brh":
-        assert_amount_of_args(args, 2)
-        return 0b0011 << 12 | assemble_condition(args[0]) << 10 | assemble_address(args[1])
-    elif opcode == "cal":
-        assert_amount_of_args(args, 1)
-        return 0b0100 << 12 | assemble_address(args[0])
-    elif opcode == "ret":
-        assert_amount_of_args(args, 0)
-        return 0b0101 << 12
-    elif opcode == "pld":
-        assert_amount_of_args(args, 2)
-        return 0b0110 << 12 | assemble_reg(args[0]) << 9 | assemble_immediate(args[1], port=True)
-    elif opcode == "pst":
-        assert_amount_of_args(args, 2)
-        return 0b0111 << 12 | assemble_reg(args[0]) << 9 | assemble_immediate(args[1], port=True)
-    elif opcode == "mld":
-        assert_amount_of_args(args, 3)
-        return 0b1000 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6 | assemble_offset(args[2])
-    elif opcode == "mst":
-        assert_amount_of_args(args, 3)
-        return 0b1001 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6 | assemble_offset(args[2])
-    elif opcode == "adi":
-        assert_amount_of_args(args, 2)
-        return 0b1011 << 12 | assemble_reg(args[0]) << 9 | assemble_immediate(args[1])
-    elif opcode == "add":
-        assert_amount_of_args(args, 3)
-        return 0b1100 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6 | assemble_reg(args[2])
-    elif opcode == "sub":
-        assert_amount_of_args(args, 3)
-        return 0b1101 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6 | assemble_reg(args[2])
-    elif opcode == "bit":
-        assert_amount_of_args(args, 4)
-        return 0b1110 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6 | assemble_operation(args[2]) << 3 | assemble_reg(args[3])
-    elif opcode == "rsh":
-        assert_amount_of_args(args, 2)
-        return 0b1111 << 12 | assemble_reg(args[0]) << 9 | assemble_reg(args[1]) << 6
-    # psuedo-instructions
-    elif opcode == "cmp":
-        assert_amount_of_args(args, 2)
-        return assemble("sub", ["r0", *args])
-    elif opcode == "mov":
-        assert_amount_of_args(args, 2)
-        return assemble("add", [*args, "r0"])
-    elif opcode == "lsh":
-        assert_amount_of_args(args, 2)
-        return assemble("add", [*args, args[1]])
-    elif opcode == "inc":
-        assert_amount_of_args(args, 1)
-        return assemble("adi", [*args, "1"])
-    elif opcode == "dec":
-        assert_amount_of_args(args, 1)
-        return assemble("adi", [*args, "-1"])
-    elif opcode == "orr":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "or", args[2]])
-    elif opcode == "and":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "and", args[2]])
-    elif opcode == "xor":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "xor", args[2]])
-    elif opcode == "imp":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "implies", args[2]])
-    elif opcode == "nor":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "nor", args[2]])
-    elif opcode == "nnd":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "nand", args[2]])
-    elif opcode == "xnr":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "xnor", args[2]])
-    elif opcode == "nmp":
-        assert_amount_of_args(args, 3)
-        return assemble("bit", [args[0], args[1], "nimplies", args[2]])
-    elif opcode == "not":
-        assert_amount_of_args(args, 2)
-        return assemble("bit", [args[0], args[1], "nor", "r0"])
-    else:
-        print(f"{input_path}:{line_number}: unknown opcode {opcode!r}")
-        exit(1)
+from debuginfo import pack_debug_info
 
-def assert_amount_of_args(args: list[str], amount: int) -> None:
-    if len(args) != amount:
-        print(f"{input_path}:{line_number}: expected {amount} argument(s), got {len(args)}")
-        exit(1)
+# bump whenever the machine code or debug info for a given source changes, this invalidates the build cache
+ASSEMBLER_VERSION = "3"
+
+DEFAULT_CACHE_DIR = ".basm_cache"
+
+# seconds between checks for modified files in watch mode
+WATCH_INTERVAL = 0.25
+
+class AssemblerError(Exception):
+    def __init__(self, message: str, path: str | None = None, line_number: int | None = None) -> None:
+        super().__init__(message)
+        self.message = message
+        self.path = path
+        self.line_number = line_number
+
+    def __str__(self) -> str:
+        if self.path is None:
+            return self.message
+        if self.line_number is None:
+            return f"{self.path}: {self.message}"
+        return f"{self.path}:{self.line_number}: {self.message}"
+
+CONDITIONS = {
+    "eq": 0b00,
+    "ne": 0b01,
+    "ge": 0b10,
+    "lt": 0b11,
+}
+
+OPERATIONS = {
+    "or": 0b000,
+    "and": 0b001,
+    "xor": 0b010,
+    "implies": 0b011,
+    "nor": 0b100,
+    "nand": 0b101,
+    "xnor": 0b110,
+    "nimplies": 0b111,
+}
+
+def parse_integer(text: str) -> int:
+    base = 10
+    if "0x" in text:
+        base = 16
+        text = text.replace("0x", "")
+    elif "0b" in text:
+        base = 2
+        text = text.replace("0b", "")
+
+    return int(text, base=base)
 
 def assemble_operation(op: str) -> int:
-    if op == "or":
-        return 0b000
-    elif op == "and":
-        return 0b001
-    elif op == "xor":
-        return 0b010
-    elif op == "implies":
-        return 0b011
-    elif op == "nor":
-        return 0b100
-    elif op == "nand":
-        return 0b101
-    elif op == "xnor":
-        return 0b110
-    elif op == "nimplies":
-        return 0b111
-    else:
-        print(f"{input_path}:{line_number}: unknown operation {op!r}")
-        exit(1)
+    if op not in OPERATIONS:
+        raise AssemblerError(f"unknown operation {op!r}")
+
+    return OPERATIONS[op]
 
 def assemble_condition(cond: str) -> int:
-    if cond == "eq":
-        return 0b00
-    elif cond == "ne":
-        return 0b01
-    elif cond == "ge":
-        return 0b10
-    elif cond == "lt":
-        return 0b11
-    else:
-        print(f"{input_path}:{line_number}: unknown condition {cond!r}")
-        exit(1)
+    if cond not in CONDITIONS:
+        raise AssemblerError(f"unknown condition {cond!r}")
+
+    return CONDITIONS[cond]
 
 def assemble_offset(offset: str) -> int:
     try:
-        base = 10
-        if "0x" in offset:
-            base = 16
-            offset = offset.replace("0x", "")
-        elif "0b" in offset:
-            base = 2
-            offset = offset.replace("0b", "")
-
-        offset_int = int(offset, base=base)
+        offset_int = parse_integer(offset)
     except ValueError:
-        print(f"{input_path}:{line_number}: expected offset, got {offset!r}")
-        exit(1)
+        raise AssemblerError(f"expected offset, got {offset!r}") from None
 
     if offset_int < -32 or offset_int > 31:
-        print(f"{input_path}:{line_number}: offset must be between -32 and 31")
-        exit(1)
+        raise AssemblerError("offset must be between -32 and 31")
 
     return offset_int & 0x3f
 
-def assemble_address(addr: str) -> int:
+def assemble_address(addr: str, labels: dict[str, int]) -> int:
     try:
-        base = 10
-        if "0x" in addr:
-            base = 16
-            addr = addr.replace("0x", "")
-        elif "0b" in addr:
-            base = 2
-            addr = addr.replace("0b", "")
-
-        addr_int = int(addr, base=base)
+        addr_int = parse_integer(addr)
     except ValueError:
         if addr not in labels:
-            print(f"{input_path}:{line_number}: unknown label or invalid integer address {addr!r}")
-            exit(1)
+            raise AssemblerError(f"unknown label or invalid integer address {addr!r}") from None
         addr_int = labels[addr]
 
     if addr_int < 0 or addr_int >= 2**10:
-        print(f"{input_path}:{line_number}: address must be between 0 and 1023")
-        exit(1)
+        raise AssemblerError("address must be between 0 and 1023")
 
     return addr_int
 
@@ -191,156 +102,945 @@ def assemble_immediate(imm: str, port: bool = False) -> int:
         expected = "port"
 
     try:
-        base = 10
-        if "0x" in imm:
-            base = 16
-            imm = imm.replace("0x", "")
-        elif "0b" in imm:
-            base = 2
-            imm = imm.replace("0b", "")
-
-        imm_int = int(imm, base=base)
+        imm_int = parse_integer(imm)
     except ValueError:
-        print(f"{input_path}:{line_number}: expected {expected}, got {imm!r}")
-        exit(1)
+        raise AssemblerError(f"expected {expected}, got {imm!r}") from None
 
     if imm_int < -128 or imm_int > 255:
-        print(f"{input_path}:{line_number}: {expected} must be between -128 and 255")
-        exit(1)
+        raise AssemblerError(f"{expected} must be between -128 and 255")
 
     return imm_int & 0xff
 
 def assemble_reg(reg: str) -> int:
-    if reg[0] != "r" or not reg[1:].isdigit():
-        print(f"{input_path}:{line_number}: expected register, got {reg!r}")
-        exit(1)
+    if reg[:1] != "r" or not reg[1:].isdigit():
+        raise AssemblerError(f"expected register, got {reg!r}")
 
     reg_num = int(reg[1:])
 
     if reg_num >= 8:
-        print(f"{input_path}:{line_number}: register number must be less than 8")
-        exit(1)
+        raise AssemblerError("register number must be less than 8")
 
     return reg_num
 
-def assemble_file(_input_path: str, _output_path: str, debug: bool) -> None:
-    global line_number
-    global machine_code
-    global input_path
-    global output_path
+# every operand assembler takes the argument text and the label table
+OPERAND_TYPES = {
+    "reg": lambda arg, labels: assemble_reg(arg),
+    "immediate": lambda arg, labels: assemble_immediate(arg),
+    "port": lambda arg, labels: assemble_immediate(arg, port=True),
+    "offset": lambda arg, labels: assemble_offset(arg),
+    "address": assemble_address,
+    "condition": lambda arg, labels: assemble_condition(arg),
+    "operation": lambda arg, labels: assemble_operation(arg),
+}
 
-    input_path = _input_path
-    output_path = _output_path
+# mnemonic: (opcode, operands), operands are (type, shift) pairs in source order
+INSTRUCTIONS = {
+    "nop": (0b0000, ()),
+    "hlt": (0b0001, ()),
+    "jmp": (0b0010, (("address", 0),)),
+    "brh": (0b0011, (("condition", 10), ("address", 0))),
+    "cal": (0b0100, (("address", 0),)),
+    "ret": (0b0101, ()),
+    "pld": (0b0110, (("reg", 9), ("port", 0))),
+    "pst": (0b0111, (("reg", 9), ("port", 0))),
+    "mld": (0b1000, (("reg", 9), ("reg", 6), ("offset", 0))),
+    "mst": (0b1001, (("reg", 9), ("reg", 6), ("offset", 0))),
+    "ldi": (0b1010, (("reg", 9), ("immediate", 0))),
+    "adi": (0b1011, (("reg", 9), ("immediate", 0))),
+    "add": (0b1100, (("reg", 9), ("reg", 6), ("reg", 0))),
+    "sub": (0b1101, (("reg", 9), ("reg", 6), ("reg", 0))),
+    "bit": (0b1110, (("reg", 9), ("reg", 6), ("operation", 3), ("reg", 0))),
+    "rsh": (0b1111, (("reg", 9), ("reg", 6))),
+}
 
-    with open(input_path, "r") as f:
-        source = f.read()
+# psuedo-instructions
+# mnemonic: (instruction, amount of args, operands), operands are either an index into the args or a literal
+PSEUDO_INSTRUCTIONS = {
+    "cmp": ("sub", 2, ("r0", 0, 1)),
+    "mov": ("add", 2, (0, 1, "r0")),
+    "lsh": ("add", 2, (0, 1, 1)),
+    "inc": ("adi", 1, (0, "1")),
+    "dec": ("adi", 1, (0, "-1")),
+    "orr": ("bit", 3, (0, 1, "or", 2)),
+    "and": ("bit", 3, (0, 1, "and", 2)),
+    "xor": ("bit", 3, (0, 1, "xor", 2)),
+    "imp": ("bit", 3, (0, 1, "implies", 2)),
+    "nor": ("bit", 3, (0, 1, "nor", 2)),
+    "nnd": ("bit", 3, (0, 1, "nand", 2)),
+    "xnr": ("bit", 3, (0, 1, "xnor", 2)),
+    "nmp": ("bit", 3, (0, 1, "nimplies", 2)),
+    "not": ("bit", 2, (0, 1, "nor", "r0")),
+}
 
-    debug_info = {
-        "labels": {},
-        "instructions": []
-    }
+def build_opcode_table() -> dict[str, tuple[int, int, tuple]]:
+    # mnemonic: (base word, amount of args, (operand assembler, shift, arg index) triples)
+    table = {}
 
-    machine_code = b""
+    for mnemonic, (opcode, operands) in INSTRUCTIONS.items():
+        fields = tuple((OPERAND_TYPES[type], shift, index) for index, (type, shift) in enumerate(operands))
+        table[mnemonic] = (opcode << 12, len(operands), fields)
 
-    # first pass: process labels
-    line_number = 0
-    for line in source.splitlines():
-        line_number += 1
+    for mnemonic, (instruction, amount, sources) in PSEUDO_INSTRUCTIONS.items():
+        opcode, operands = INSTRUCTIONS[instruction]
 
-        # remove comment
-        line = line.split("#")[0].strip()
+        # literal operands are encoded once, here
+        word = opcode << 12
+        fields = []
+        for (type, shift), source in zip(operands, sources):
+            if isinstance(source, str):
+                word |= OPERAND_TYPES[type](source, {}) << shift
+            else:
+                fields.append((OPERAND_TYPES[type], shift, source))
 
-        # process labels
-        while ":" in line:
-            label = line.split(":")[0].strip()
-            line = ":".join(line.split(":")[1:]).strip()
+        table[mnemonic] = (word, amount, tuple(fields))
 
-            if label in labels:
-                print(f"{input_path}:{line_number}: label {label!r} already defined")
-                exit(1)
-            labels[label] = get_current_address()
+    return table
 
-            debug_info["labels"][label] = {
-                "line": line_number,
-                "address": get_current_address()
-            }
+OPCODE_TABLE = build_opcode_table()
 
-        # ignore empty lines
-        if not line.strip():
-            continue
+def assemble(opcode: str, args: list[str], labels: dict[str, int]) -> int:
+    if opcode not in OPCODE_TABLE:
+        raise AssemblerError(f"unknown opcode {opcode!r}")
 
-        machine_code += b"\x00\x00"
+    word, amount, fields = OPCODE_TABLE[opcode]
 
-    machine_code = b""
+    if len(args) != amount:
+        raise AssemblerError(f"expected {amount} argument(s), got {len(args)}")
 
-    # second pass: assemble instructions
-    line_number = 0
-    for line in source.splitlines():
-        line_number += 1
+    for assembler, shift, index in fields:
+        word |= assembler(args[index], labels) << shift
 
-        if get_current_address() >= 2**10:
-            print(f"{input_path}:{line_number}: program too long")
-            exit(1)
+    return word
 
+class SourceLine(NamedTuple):
+    line_number: int
+    labels: list[str]
+    opcode: str | None
+    args: list[str]
+    # (path, line number) the line was written on, set by tokenize when it's given the path. line_number is the line of the main
+    # file it ended up on, the .include or macro call for lines of included files and macros
+    origin: tuple[str, int] | None = None
+
+def tokenize(source: str, path: str | None = None) -> list[SourceLine]:
+    lines = []
+
+    for line_number, line in enumerate(source.splitlines(), 1):
         # remove comment
-        line = line.split("#")[0].strip()
+        line = line.split("#", 1)[0]
 
-        # remove labels
-        while ":" in line:
-            line = ":".join(line.split(":")[1:]).strip()
+        # split off labels
+        *labels, line = line.split(":")
+        line = line.strip()
 
         # ignore empty lines
-        if not line.strip():
+        if not line and not labels:
+            continue
+
+        opcode = None
+        args = []
+        if line:
+            opcode, *rest = line.split(maxsplit=1)
+            if rest:
+                args = [arg.strip() for arg in rest[0].split(",")]
+
+        origin = (path, line_number) if path is not None else None
+        lines.append(SourceLine(line_number, [label.strip() for label in labels], opcode, args, origin))
+
+    return lines
+
+# preprocessor, expands the .include, .define and macro directives of the tokenized lines:
+#   .include "path"             the lines of another file, relative to the including file
+#   .define NAME value          replaces every NAME argument after it with value
+#   .macro name param, ...      the lines up to .endmacro are inserted wherever name is used as an opcode, with
+#   .endmacro                   the params replaced by the arguments. labels defined in a macro are local to it
+class Module(NamedTuple):
+    path: str
+    # (modification time, size) of the file when it was parsed
+    modified: tuple[int, int]
+    # sha-256 of the source, part of the build cache key of everything that includes it
+    digest: str
+    source: str
+    lines: list[SourceLine]
+
+class Macro(NamedTuple):
+    params: list[str]
+    lines: list[SourceLine]
+    # path of the file it was defined in
+    path: str
+
+# parsed included files by path, shared by everything one process assembles (a batch worker, or every run of watch
+# mode), so a library included by many programs is tokenized once. it's kept in the order the modules were last
+# used in, and the least recently used one is dropped once there are more than MODULE_CACHE_SIZE
+MODULE_CACHE = {}
+MODULE_CACHE_SIZE = 256
+
+def get_modified(path: str) -> tuple[int, int] | None:
+    # a file that's truncated and written again can keep its modification time, but not its size
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def load_module(path: str) -> Module:
+    modified = get_modified(path)
+    module = MODULE_CACHE.pop(path, None)
+    if module is None or modified is None or module.modified != modified:
+        # a file that was deleted stays out of the cache
+        with open(path, "r") as f:
+            source = f.read()
+
+        module = Module(path, modified, hashlib.sha256(source.encode()).hexdigest(), source, tokenize(source, path))
+
+    MODULE_CACHE[path] = module
+    while len(MODULE_CACHE) > MODULE_CACHE_SIZE:
+        del MODULE_CACHE[next(iter(MODULE_CACHE))]
+
+    return module
+
+def include_module(line: SourceLine, path: str) -> Module:
+    if len(line.args) != 1 or len(line.args[0]) < 2 or line.args[0][0] != "\"" or line.args[0][-1] != "\"":
+        raise AssemblerError("expected a quoted path", path, line.line_number)
+
+    include_path = os.path.normpath(os.path.join(os.path.dirname(path), line.args[0][1:-1]))
+    try:
+        return load_module(include_path)
+    except OSError as e:
+        raise AssemblerError(f"can't include {include_path!r}: {e.strerror}", path, line.line_number) from None
+
+def get_dependencies(lines: list[SourceLine], path: str) -> dict[str, Module]:
+    # every file the lines include, directly or through other files, without expanding anything
+    modules = {}
+    pending = [(lines, path)]
+    while pending:
+        lines, path = pending.pop()
+        for line in lines:
+            if line.opcode == ".include":
+                module = include_module(line, path)
+                if module.path not in modules:
+                    modules[module.path] = module
+                    pending.append((module.lines, module.path))
+
+    return modules
+
+class Preprocessor:
+    def __init__(self) -> None:
+        self.defines = {}
+        self.macros = {}
+        # path: module, of every included file
+        self.modules = {}
+        # includes and macros that are being expanded, to catch recursion
+        self.includes = []
+        self.calls = []
+        # amount of macro calls expanded, makes the names of local labels unique
+        self.expansions = 0
+        self.lines = []
+
+    def add_labels(self, line: SourceLine, line_number: int, origin: tuple[str, int]) -> None:
+        # the labels on a directive line label whatever comes after it
+        if line.labels:
+            self.lines.append(SourceLine(line_number, line.labels, None, [], origin))
+
+    def process(self, lines: list[SourceLine], path: str, line_number: int | None = None) -> None:
+        # line_number is the line of the main file the lines are included or expanded on
+        macro = None
+        for line in lines:
+            origin = (path, line.line_number)
+            main_line_number = line_number if line_number is not None else line.line_number
+
+            if macro is not None:
+                name, params, body, _ = macro
+                if line.opcode == ".endmacro":
+                    # labels on .endmacro are local labels at the end of the body
+                    if line.labels:
+                        body.append(line._replace(opcode=None, args=[]))
+                    self.macros[name] = Macro(params, body, path)
+                    macro = None
+                elif line.opcode == ".macro":
+                    raise AssemblerError("macros can't be defined inside of a macro", *origin)
+                else:
+                    body.append(line)
+                continue
+
+            if line.opcode == ".include":
+                module = include_module(line, path)
+                if module.path in self.includes:
+                    raise AssemblerError(f"{module.path!r} includes itself", *origin)
+
+                self.modules[module.path] = module
+                self.add_labels(line, main_line_number, origin)
+                self.includes.append(module.path)
+                self.process(module.lines, module.path, main_line_number)
+                self.includes.pop()
+            elif line.opcode == ".define":
+                # .define NAME value, commas between the two are allowed
+                words = " ".join(line.args).split()
+                if len(words) != 2:
+                    raise AssemblerError("expected a name and a value", *origin)
+
+                self.add_labels(line, main_line_number, origin)
+                self.defines[words[0]] = self.defines.get(words[1], words[1])
+            elif line.opcode == ".macro":
+                # .macro name param, param, ..., the first param is only separated by a space
+                words = line.args[0].split() if line.args else []
+                if not words:
+                    raise AssemblerError("expected a macro name", *origin)
+                if words[0] in OPCODE_TABLE or words[0] in self.macros:
+                    raise AssemblerError(f"{words[0]!r} is already defined", *origin)
+
+                self.add_labels(line, main_line_number, origin)
+                macro = (words[0], words[1:] + line.args[1:], [], origin)
+            elif line.opcode == ".endmacro":
+                raise AssemblerError(".endmacro without .macro", *origin)
+            elif line.opcode in self.macros:
+                self.expand_macro(line, main_line_number, origin)
+            elif line.opcode is not None and line.opcode.startswith("."):
+                raise AssemblerError(f"unknown directive {line.opcode!r}", *origin)
+            else:
+                args = [self.defines.get(arg, arg) for arg in line.args]
+                self.lines.append(line._replace(line_number=main_line_number, args=args, origin=origin))
+
+        if macro is not None:
+            raise AssemblerError(f"macro {macro[0]!r} has no .endmacro", *macro[3])
+
+    def expand_macro(self, line: SourceLine, line_number: int, origin: tuple[str, int]) -> None:
+        name = line.opcode
+        macro = self.macros[name]
+        if len(line.args) != len(macro.params):
+            raise AssemblerError(f"expected {len(macro.params)} argument(s), got {len(line.args)}", *origin)
+        if name in self.calls:
+            raise AssemblerError(f"macro {name!r} calls itself", *origin)
+
+        self.expansions += 1
+        names = {label: f"{name}.{self.expansions}.{label}" for body_line in macro.lines for label in body_line.labels}
+        arguments = dict(zip(macro.params, [self.defines.get(arg, arg) for arg in line.args]))
+
+        body = [
+            body_line._replace(
+                labels=[names[label] for label in body_line.labels],
+                args=[arguments.get(arg, names.get(arg, arg)) for arg in body_line.args],
+            )
+            for body_line in macro.lines
+        ]
+
+        self.add_labels(line, line_number, origin)
+        self.calls.append(name)
+        self.process(body, macro.path, line_number)
+        self.calls.pop()
+
+def preprocess(lines: list[SourceLine], path: str) -> tuple[list[SourceLine], dict[str, Module]]:
+    # returns the expanded lines and path: module of every included file
+    if not any([line.opcode is not None and line.opcode.startswith(".") for line in lines]):
+        # nothing to expand without directives, there can't be any defines or macros
+        return lines, {}
+
+    preprocessor = Preprocessor()
+    preprocessor.includes.append(os.path.normpath(path))
+    preprocessor.process(lines, path)
+    return preprocessor.lines, preprocessor.modules
+
+# peephole optimizer, rewrites the tokenized lines before they're assembled. removed instructions become
+# label-only lines, so their labels move to the next instruction and every other line keeps its line number
+FLAG_INSTRUCTIONS = {"add", "sub", "adi", "bit"}
+FLAG_PRESERVING_INSTRUCTIONS = {"nop", "ldi", "mld", "mst", "pld", "pst", "rsh"}
+BRANCH_FLAGS = {"eq": "zero", "ne": "zero", "ge": "carry", "lt": "carry"}
+ALL_FLAGS = frozenset({"zero", "carry"})
+# instruction: index of the address argument
+ADDRESS_ARGS = {"jmp": 0, "brh": 1, "cal": 0}
+UNCONDITIONAL_JUMPS = {"hlt", "jmp", "ret"}
+
+def expand(line: SourceLine) -> tuple[str | None, list[str]]:
+    # returns the instruction a line assembles to and all of its arguments, with pseudo-instructions expanded
+    if line.opcode in PSEUDO_INSTRUCTIONS:
+        instruction, amount, sources = PSEUDO_INSTRUCTIONS[line.opcode]
+        if len(line.args) != amount:
+            return None, []
+        return instruction, [source if isinstance(source, str) else line.args[source] for source in sources]
+
+    if line.opcode in INSTRUCTIONS and len(line.args) == len(INSTRUCTIONS[line.opcode][1]):
+        return line.opcode, list(line.args)
+
+    return None, []
+
+def remove_instruction(line: SourceLine) -> SourceLine:
+    return line._replace(opcode=None, args=[])
+
+def get_instruction(lines: list[SourceLine], index: int) -> int:
+    # index of the first instruction at or after index, len(lines) past the last instruction
+    while index < len(lines) and lines[index].opcode is None:
+        index += 1
+
+    return index
+
+def get_next_instruction(lines: list[SourceLine], index: int) -> int:
+    return get_instruction(lines, index + 1)
+
+def get_target(lines: list[SourceLine], label_lines: dict[str, int], label: str) -> int:
+    return get_instruction(lines, label_lines[label])
+
+def get_live_flags(lines: list[SourceLine], label_lines: dict[str, int], index: int) -> frozenset[str]:
+    # flags that may be read by a brh after the instruction at index, before an instruction sets them again
+    live = set()
+    visited = set()
+    pending = [index + 1]
+    while pending:
+        index = pending.pop()
+        while index not in visited:
+            if index >= len(lines):
+                # runs off the end of the program
+                return ALL_FLAGS
+            visited.add(index)
+
+            instruction, args = expand(lines[index])
+            if lines[index].opcode is None or instruction in FLAG_PRESERVING_INSTRUCTIONS:
+                index += 1
+            elif instruction in FLAG_INSTRUCTIONS or instruction == "hlt":
+                break
+            elif instruction == "brh":
+                live.add(BRANCH_FLAGS[args[0]])
+                pending.append(label_lines[args[1]])
+                index += 1
+            elif instruction == "jmp":
+                index = label_lines[args[0]]
+            else:
+                # the flags are live in whatever a cal or ret continues at
+                return ALL_FLAGS
+
+    return frozenset(live)
+
+def thread_jumps(lines: list[SourceLine], label_lines: dict[str, int]) -> bool:
+    # jumps, branches and calls to a jmp go to the target of that jmp instead
+    changed = False
+    for index, line in enumerate(lines):
+        instruction, args = expand(line)
+        if instruction not in ADDRESS_ARGS:
+            continue
+
+        label = args[ADDRESS_ARGS[instruction]]
+        seen = {label}
+        target = get_target(lines, label_lines, label)
+        while target < len(lines):
+            target_instruction, target_args = expand(lines[target])
+            if target_instruction != "jmp" or target_args[0] in seen:
+                break
+            label = target_args[0]
+            seen.add(label)
+            target = get_target(lines, label_lines, label)
+
+        if label != args[ADDRESS_ARGS[instruction]]:
+            args[ADDRESS_ARGS[instruction]] = label
+            lines[index] = line._replace(args=args)
+            changed = True
+
+    return changed
+
+def remove_jumps_to_next(lines: list[SourceLine], label_lines: dict[str, int]) -> bool:
+    changed = False
+    for index, line in enumerate(lines):
+        instruction, args = expand(line)
+        if instruction in ["jmp", "brh"] and get_target(lines, label_lines, args[ADDRESS_ARGS[instruction]]) == get_next_instruction(lines, index):
+            lines[index] = remove_instruction(line)
+            changed = True
+
+    return changed
+
+def remove_dead_code(lines: list[SourceLine]) -> bool:
+    # instructions after a hlt, jmp or ret can only be reached through a label
+    changed = False
+    reachable = True
+    for index, line in enumerate(lines):
+        if line.labels:
+            reachable = True
+
+        if line.opcode is None:
+            continue
+        if not reachable:
+            lines[index] = remove_instruction(line)
+            changed = True
+        elif expand(line)[0] in UNCONDITIONAL_JUMPS:
+            reachable = False
+
+    return changed
+
+def remove_nops(lines: list[SourceLine], label_lines: dict[str, int]) -> bool:
+    # removes nops and moves of a register to itself, as long as nothing reads the flags the move sets
+    changed = False
+    for index, line in enumerate(lines):
+        instruction, args = expand(line)
+        if instruction == "add" and ((args[1] == args[0] and args[2] == "r0") or (args[2] == args[0] and args[1] == "r0")):
+            if get_live_flags(lines, label_lines, index):
+                continue
+        elif instruction != "nop":
+            continue
+
+        lines[index] = remove_instruction(line)
+        changed = True
+
+    return changed
+
+def fold_immediates(lines: list[SourceLine], label_lines: dict[str, int]) -> bool:
+    # merges an adi into the adi on the same register right before it, the carry it sets can differ so it may not be live.
+    # adis on r0 are left alone, r0 reads 0 so every one of them sets the flags from its own immediate
+    changed = False
+    for index, line in enumerate(lines):
+        instruction, args = expand(line)
+        if instruction != "adi" or args[0] == "r0":
+            continue
+
+        next_index = get_next_instruction(lines, index)
+        if next_index >= len(lines) or any(lines[i].labels for i in range(index + 1, next_index + 1)):
             continue
 
-        opcode, *args = line.split(maxsplit=1)
-        if args:
-            args = [arg.strip() for arg in args[0].split(",")]
+        next_instruction, next_args = expand(lines[next_index])
+        if next_instruction != "adi" or next_args[0] != args[0]:
+            continue
+
+        try:
+            immediate = (parse_integer(args[1]) + parse_integer(next_args[1])) & 0xff
+        except ValueError:
+            continue
+
+        live = get_live_flags(lines, label_lines, next_index)
+        if "carry" in live:
+            continue
+
+        if immediate == 0 and not live:
+            lines[index] = remove_instruction(line)
         else:
-            args = []
-        if any([" " in arg for arg in args]):
-            print(f"{input_path}:{line_number}: missing comma between arguments")
-            exit(1)
+            lines[index] = line._replace(opcode="adi", args=[args[0], str(immediate)])
+        lines[next_index] = remove_instruction(lines[next_index])
+        changed = True
 
-        debug_info["instructions"].append({
-            "line": line_number,
-            "address": get_current_address(),
-        })
+    return changed
 
-        machine_code += assemble(opcode, args).to_bytes(2, "big")
+def optimize(lines: list[SourceLine]) -> list[SourceLine]:
+    # the lines have to assemble without errors, programs that use numeric addresses are left alone
+    for line in lines:
+        instruction, args = expand(line)
+        if instruction in ADDRESS_ARGS:
+            try:
+                parse_integer(args[ADDRESS_ARGS[instruction]])
+                return lines
+            except ValueError:
+                pass
 
-    if debug:
-        debug_info["source"] = source
-        debug_info["source_path"] = input_path
+    lines = list(lines)
+    # label: index of the line it's on, labels stay on their line when the instruction there is removed
+    label_lines = {label: index for index, line in enumerate(lines) for label in line.labels}
+    changed = True
+    while changed:
+        changed = thread_jumps(lines, label_lines)
+        changed |= remove_jumps_to_next(lines, label_lines)
+        changed |= remove_dead_code(lines)
+        changed |= remove_nops(lines, label_lines)
+        changed |= fold_immediates(lines, label_lines)
+
+    return lines
+
+class Assembly(NamedTuple):
+    machine_code: bytes
+    labels: dict[str, int]
+    # (opcode, args) of the instruction at every address
+    instructions: list[tuple[str, list[str]]]
+    # amount of instructions that were encoded, the others were copied from the previous assembly
+    encoded: int
+    # path: (modification time, size) of every included file
+    dependencies: dict[str, tuple[int, int]]
+
+def assemble_source(source: str, path: str = "<source>", optimized: bool = False, lines: list[SourceLine] | None = None) -> tuple[bytes, dict]:
+    assembly, debug_info = assemble_incremental(source, path, optimized, lines=lines)
+    return assembly.machine_code, debug_info
+
+def assemble_incremental(source: str, path: str = "<source>", optimized: bool = False, previous: Assembly | None = None, lines: list[SourceLine] | None = None) -> tuple[Assembly, dict]:
+    # when no label moved and the amount of instructions is the same as in the previous assembly, only the
+    # instructions that changed are encoded. lines is the source tokenized with its path, if the caller has it already
+    labels = {}
+
+    debug_info = {
+        "labels": {},
+        "instructions": [],
+        "source": source,
+        "source_path": path,
+        "files": {},
+    }
+
+    # where the line that's being assembled was written, errors are reported there
+    origin = (path, None)
+    try:
+        if lines is None:
+            lines = tokenize(source, path)
+        lines, modules = preprocess(lines, path)
+        debug_info["files"] = {module.path: module.source for module in modules.values()}
+
+        if optimized:
+            # errors are reported before the optimizer can remove the lines they're on
+            placeholder_labels = {label: 0 for line in lines for label in line.labels}
+            for line in lines:
+                if line.opcode is not None:
+                    origin = line.origin
+                    if any([" " in arg for arg in line.args]):
+                        raise AssemblerError("missing comma between arguments")
+                    assemble(line.opcode, line.args, placeholder_labels)
+
+            lines = optimize(lines)
+
+        # first pass: process labels
+        address = 0
+        for line in lines:
+            line_number = line.line_number
+            origin = line.origin
 
-        with open(f"{output_path}.dbg", "w") as f:
-            json.dump(debug_info, f, indent=4)
+            for label in line.labels:
+                if label in labels:
+                    raise AssemblerError(f"label {label!r} already defined")
+                labels[label] = address
+
+                debug_info["labels"][label] = {
+                    "line": line_number,
+                    "address": address
+                }
+
+            if line.opcode is not None:
+                address += 1
+
+        incremental = previous is not None and previous.labels == labels and len(previous.instructions) == address
+        if incremental:
+            machine_code = bytearray(previous.machine_code)
+        else:
+            machine_code = bytearray(2 * min(address, 2**10))
+
+        # second pass: assemble instructions
+        instructions = []
+        encoded = 0
+        address = 0
+        for line in lines:
+            if line.opcode is None:
+                continue
+
+            line_number = line.line_number
+            origin = line.origin
+
+            if address >= 2**10:
+                raise AssemblerError("program too long")
+
+            if any([" " in arg for arg in line.args]):
+                raise AssemblerError("missing comma between arguments")
+
+            debug_info["instructions"].append({
+                "line": line_number,
+                "address": address,
+            })
+            if origin != (path, line_number):
+                debug_info["instructions"][-1]["origin"] = {"path": origin[0], "line": origin[1]}
+
+            instruction = (line.opcode, line.args)
+            instructions.append(instruction)
+            if not incremental or previous.instructions[address] != instruction:
+                word = assemble(line.opcode, line.args, labels)
+                machine_code[address * 2] = word >> 8
+                machine_code[address * 2 + 1] = word & 0xff
+                encoded += 1
+            address += 1
+    except AssemblerError as e:
+        if e.path is None:
+            e.path, e.line_number = origin
+        raise
+
+    dependencies = {module.path: module.modified for module in modules.values()}
+    return Assembly(bytes(machine_code), labels, instructions, encoded, dependencies), debug_info
+
+DEBUG_FORMATS = ["json", "binary"]
+
+def dump_debug_info(debug_info: dict, debug_format: str) -> bytes:
+    if debug_format == "binary":
+        return pack_debug_info(debug_info)
+    return json.dumps(debug_info, indent=4).encode()
+
+def assemble_file(input_path: str, output_path: str, debug: bool, debug_format: str = "json", optimized: bool = False) -> None:
+    with open(input_path, "r") as f:
+        source = f.read()
+
+    machine_code, debug_info = assemble_source(source, input_path, optimized)
+
+    if debug:
+        with open(f"{output_path}.dbg", "wb") as f:
+            f.write(dump_debug_info(debug_info, debug_format))
 
     with open(output_path, "wb") as f:
         f.write(machine_code)
 
+def get_cache_key(source: str, input_path: str, debug: bool, debug_format: str, optimized: bool, dependencies: dict[str, Module]) -> str:
+    # the debug info contains the source path, so it is part of the key, and so is every file the source includes
+    key = f"{ASSEMBLER_VERSION}\0{int(debug)}\0{debug_format}\0{int(optimized)}\0{input_path}\0{source}"
+    for path in sorted(dependencies):
+        key += f"\0{path}\0{dependencies[path].digest}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def write_atomic(path: str, data: bytes) -> None:
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def copy_atomic(source_path: str, path: str) -> None:
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, path)
+
+def assemble_cached(input_path: str, output_path: str, debug: bool, debug_format: str, optimized: bool, cache_dir: str | None) -> tuple[bool, float, str | None]:
+    # returns (cache hit, wall time, error message)
+    start = time.perf_counter()
+
+    try:
+        with open(input_path, "r") as f:
+            source = f.read()
+
+        # tokenized once for both the cache key and the assembly
+        lines = tokenize(source, input_path)
+        cache_path = None
+        if cache_dir is not None:
+            dependencies = get_dependencies(lines, input_path)
+            cache_path = os.path.join(cache_dir, get_cache_key(source, input_path, debug, debug_format, optimized, dependencies))
+
+            if os.path.exists(f"{cache_path}.bin") and (not debug or os.path.exists(f"{cache_path}.dbg")):
+                copy_atomic(f"{cache_path}.bin", output_path)
+                if debug:
+                    copy_atomic(f"{cache_path}.dbg", f"{output_path}.dbg")
+
+                return True, time.perf_counter() - start, None
+
+        machine_code, debug_info = assemble_source(source, input_path, optimized, lines)
+
+        debug_data = dump_debug_info(debug_info, debug_format) if debug else None
+        write_atomic(output_path, machine_code)
+        if debug:
+            write_atomic(f"{output_path}.dbg", debug_data)
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_atomic(f"{cache_path}.bin", machine_code)
+            if debug:
+                write_atomic(f"{cache_path}.dbg", debug_data)
+    except (AssemblerError, OSError) as e:
+        return False, time.perf_counter() - start, str(e)
+
+    return False, time.perf_counter() - start, None
+
+def read_manifest(manifest_path: str) -> list[tuple[str, str]]:
+    # every line of a manifest is "<input.basm> <output.bin>", paths are relative to the manifest
+    base = os.path.dirname(manifest_path)
+    jobs = []
+
+    with open(manifest_path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+
+            paths = line.split()
+            if len(paths) != 2:
+                raise AssemblerError("expected an input and an output path", manifest_path, line_number)
+
+            jobs.append((os.path.join(base, paths[0]), os.path.join(base, paths[1])))
+
+    return jobs
+
+def get_output_path(input_path: str, output_dir: str | None) -> str:
+    name = os.path.splitext(os.path.basename(input_path))[0] + ".bin"
+    return os.path.join(output_dir if output_dir is not None else os.path.dirname(input_path), name)
+
+def assemble_batch(jobs: list[tuple[str, str]], debug: bool, debug_format: str, optimized: bool, cache_dir: str | None, workers: int | None) -> bool:
+    start = time.perf_counter()
+
+    if workers == 1 or len(jobs) <= 1:
+        results = [assemble_cached(input_path, output_path, debug, debug_format, optimized, cache_dir) for input_path, output_path in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(assemble_cached, input_path, output_path, debug, debug_format, optimized, cache_dir) for input_path, output_path in jobs]
+            results = [future.result() for future in futures]
+
+    failed = 0
+    cached = 0
+    for (input_path, output_path), (hit, elapsed, error) in zip(jobs, results):
+        if error is not None:
+            failed += 1
+            print(error)
+            continue
+
+        cached += hit
+        print(f"{input_path} -> {output_path}: {elapsed * 1000:.1f}ms{' (cached)' if hit else ''}")
+
+    elapsed = time.perf_counter() - start
+    print(f"assembled {len(jobs) - failed}/{len(jobs)} file(s) ({cached} cached) in {elapsed * 1000:.1f}ms")
+
+    return failed == 0
+
+def get_watch_jobs(input_path: str, output_path: str | None, output_dir: str | None) -> list[tuple[str, str]]:
+    # a directory is scanned again every time, so new files are picked up
+    if output_path is not None:
+        return [(input_path, output_path)]
+
+    paths = [os.path.join(input_path, name) for name in sorted(os.listdir(input_path)) if name.endswith(".basm")]
+
+    # files included by another file of the directory are libraries, they're only assembled as part of it. the
+    # modules are cached, so this only parses files that changed
+    included = set()
+    for path in paths:
+        try:
+            dependencies = get_dependencies(load_module(path).lines, path)
+        except (AssemblerError, OSError):
+            # reported when the file itself is assembled
+            continue
+        included.update(dependency for dependency in dependencies if dependency != os.path.normpath(path))
+
+    return [(path, get_output_path(path, output_dir)) for path in paths if os.path.normpath(path) not in included]
+
+def watch(input_path: str, output_path: str | None, debug: bool, debug_format: str, optimized: bool, output_dir: str | None) -> None:
+    # reassembles every watched file whenever it or a file it includes is modified, until interrupted. the debug
+    # info is written before the machine code, debuggers reload once the machine code changes
+    # input path: ((modification time, size) of the input and every file it included, last successful assembly)
+    watched = {}
+    while True:
+        for job_input_path, job_output_path in get_watch_jobs(input_path, output_path, output_dir):
+            modified = get_modified(job_input_path)
+            if modified is None:
+                continue
+
+            previous = None
+            if job_input_path in watched:
+                previous = watched[job_input_path][1]
+
+            # the files included by the last successful assembly
+            dependencies = previous.dependencies if previous is not None else {}
+            state = (modified, *(get_modified(path) for path in dependencies))
+            if job_input_path in watched and watched[job_input_path][0] == state:
+                continue
+
+            start = time.perf_counter()
+            try:
+                with open(job_input_path, "r") as f:
+                    source = f.read()
+
+                assembly, debug_info = assemble_incremental(source, job_input_path, optimized, previous)
+
+                if debug:
+                    write_atomic(f"{job_output_path}.dbg", dump_debug_info(debug_info, debug_format))
+                write_atomic(job_output_path, assembly.machine_code)
+            except (AssemblerError, OSError) as e:
+                watched[job_input_path] = (state, previous)
+                print(e)
+                continue
+
+            watched[job_input_path] = ((modified, *assembly.dependencies.values()), assembly)
+            elapsed = time.perf_counter() - start
+            print(f"{job_input_path} -> {job_output_path}: {elapsed * 1000:.1f}ms, encoded {assembly.encoded}/{len(assembly.instructions)} instruction(s)")
+
+        time.sleep(WATCH_INTERVAL)
+
 def print_help(error: bool) -> None:
     print(f"usage: {sys.argv[0]} [flags] <input.basm> <output.bin>")
+    print(f"       {sys.argv[0]} [flags] -b <input.basm>...")
+    print(f"       {sys.argv[0]} [flags] -m <manifest>")
+    print(f"       {sys.argv[0]} [flags] -w <input.basm> <output.bin>")
+    print(f"       {sys.argv[0]} [flags] -w <directory>")
     print("flags:")
     print("  -h, --help: show this help message")
     print("  -d, --debug: generate debug information (for use with bdbg)")
+    print("  --debug-format <json|binary>: format of the debug information, implies -d (default: json)")
+    print("  -O, --optimize: run the peephole optimizer (jump threading, dead code removal, folding of adi)")
+    print("  -b, --batch: assemble every input to <input>.bin in parallel")
+    print("  -m, --manifest <file>: assemble the \"<input.basm> <output.bin>\" pairs listed in a file in parallel")
+    print("  -w, --watch: reassemble the input, or every .basm file in a directory, whenever it changes")
+    print("  -o, --output-dir <dir>: directory to write batch and watched directory outputs to (default: next to the input)")
+    print("  -j, --jobs <count>: amount of worker processes for batch assembly (default: cpu count)")
+    print(f"  --cache-dir <dir>: build cache directory for batch assembly (default: {DEFAULT_CACHE_DIR})")
+    print("  --no-cache: disable the build cache")
 
     exit(1 if error else 0)
 
 if __name__ == "__main__":
     debug = False
+    debug_format = "json"
+    optimized = False
+    batch = False
+    manifest = None
+    watching = False
+    output_dir = None
+    workers = None
+    cache_dir = DEFAULT_CACHE_DIR
     while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
         if sys.argv[1] in ["-h", "--help"]:
             print_help(error=False)
         elif sys.argv[1] in ["-d", "--debug"]:
             debug = True
+        elif sys.argv[1] == "--debug-format" and len(sys.argv) > 2 and sys.argv[2] in DEBUG_FORMATS:
+            debug = True
+            debug_format = sys.argv.pop(2)
+        elif sys.argv[1] in ["-O", "--optimize"]:
+            optimized = True
+        elif sys.argv[1] in ["-b", "--batch"]:
+            batch = True
+        elif sys.argv[1] in ["-m", "--manifest"] and len(sys.argv) > 2:
+            manifest = sys.argv.pop(2)
+        elif sys.argv[1] in ["-w", "--watch"]:
+            watching = True
+        elif sys.argv[1] in ["-o", "--output-dir"] and len(sys.argv) > 2:
+            output_dir = sys.argv.pop(2)
+        elif sys.argv[1] in ["-j", "--jobs"] and len(sys.argv) > 2:
+            if not sys.argv[2].isdecimal() or int(sys.argv[2]) == 0:
+                print(f"the amount of jobs must be a positive integer, not {sys.argv[2]!r}")
+                print_help(error=True)
+            workers = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--cache-dir" and len(sys.argv) > 2:
+            cache_dir = sys.argv.pop(2)
+        elif sys.argv[1] == "--no-cache":
+            cache_dir = None
         else:
             print(f"unknown flag {sys.argv[1]!r}")
             print_help(error=True)
 
         sys.argv.pop(1)
 
+    if watching:
+        if len(sys.argv) == 2 and os.path.isdir(sys.argv[1]):
+            if output_dir is not None:
+                os.makedirs(output_dir, exist_ok=True)
+            output_path = None
+        elif len(sys.argv) == 3:
+            output_path = sys.argv[2]
+        else:
+            print_help(error=True)
+
+        try:
+            watch(sys.argv[1], output_path, debug, debug_format, optimized, output_dir)
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
+    if batch or manifest is not None:
+        jobs = [(input_path, get_output_path(input_path, output_dir)) for input_path in sys.argv[1:]]
+        if manifest is not None:
+            try:
+                jobs += read_manifest(manifest)
+            except (AssemblerError, OSError) as e:
+                print(e)
+                exit(1)
+
+        if not jobs:
+            print_help(error=True)
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        if not assemble_batch(jobs, debug, debug_format, optimized, cache_dir, workers):
+            exit(1)
+        exit(0)
+
     if len(sys.argv) < 3:
         print_help(error=True)
 
-    assemble_file(sys.argv[1], sys.argv[2], debug)
+    try:
+        assemble_file(sys.argv[1], sys.argv[2], debug, debug_format, optimized)
+    except AssemblerError as e:
+        print(e)
+        exit(1)
@@ -0,0 +1,236 @@
+import sys
+
+import numpy as np
+
+from bdbg import BIT_OPERATION, DECODE_TABLE, SINK_REGISTER, WRITES_REG_A, Emulator
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <program.bin>")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  -n, --instances <count>: amount of instances to run (default: 1000)")
+    print("  -s, --seed <seed>: seed for the random initial registers and memory (default: 0)")
+    print("  --max-cycles <count>: stop after this many cycles (default: run until every instance stops)")
+    print("  --verify: run every instance on the scalar emulator as well and compare the final states")
+
+    exit(1 if error else 0)
+
+# messages an instance can stop with, indexed by its message code, 0 is still running
+# instances have no devices, so every pld and pst stops with PORT_IO
+MESSAGES = [None, "halted", "return with an empty call stack", "no device on port {port}"]
+RUNNING = 0
+HALTED = 1
+EMPTY_RETURN = 2
+PORT_IO = 3
+
+# bit operations on int64 arrays, in the order of OPERATIONS
+BIT_FUNCTIONS = [
+    lambda b, c: b | c,
+    lambda b, c: b & c,
+    lambda b, c: b ^ c,
+    lambda b, c: (~b | c) & 0xff,
+    lambda b, c: ~(b | c) & 0xff,
+    lambda b, c: ~(b & c) & 0xff,
+    lambda b, c: ~(b ^ c) & 0xff,
+    lambda b, c: b & ~c & 0xff,
+]
+
+class BatchEmulator:
+    # runs many instances of one program in lockstep, every instance matches what Emulator does with the same state
+    def __init__(self, machine_code: bytes, count: int, stack_capacity: int = 16) -> None:
+        self.count = count
+
+        # the rom is decoded once, every step gathers the operands of all instances from these tables by pc
+        rom = machine_code[:2 * 2**10].ljust(2 * 2**10, b"\x00")
+        decoded = []
+        for address in range(2**10):
+            operation, a, b, c = DECODE_TABLE[int.from_bytes(rom[address * 2:address * 2 + 2], "big")]
+            if a == 0 and operation in WRITES_REG_A:
+                a = SINK_REGISTER
+            decoded.append((operation, a, b, c))
+        self.operations, self.a, self.b, self.c = (np.array(column, dtype=np.int64) for column in zip(*decoded))
+
+        self.pc = np.zeros(count, dtype=np.int64)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.regs = np.zeros((count, 8 + 1), dtype=np.uint8)
+        self.memory = np.zeros((count, 256), dtype=np.uint8)
+        self.zero = np.zeros(count, dtype=bool)
+        self.carry = np.zeros(count, dtype=bool)
+        # return addresses, grown when an instance calls deeper than the capacity
+        self.stack = np.zeros((count, stack_capacity), dtype=np.int64)
+        self.stack_pointer = np.zeros(count, dtype=np.int64)
+        # index into MESSAGES of the message every instance stopped with
+        self.messages = np.zeros(count, dtype=np.int8)
+
+    def get_message(self, index: int) -> str | None:
+        message = MESSAGES[self.messages[index]]
+        if self.messages[index] == PORT_IO:
+            # pc is already past the pld or pst
+            message = message.format(port=self.b[(self.pc[index] - 1) & 0x3ff])
+        return message
+
+    def get_state(self, index: int) -> dict:
+        # the same state Emulator.get_state() returns
+        return {
+            "cycles": int(self.cycles[index]),
+            "pc": int(self.pc[index]),
+            "registers": self.regs[index, :8].tolist(),
+            "zero": bool(self.zero[index]),
+            "carry": bool(self.carry[index]),
+            "stack": self.stack[index, :self.stack_pointer[index]].tolist(),
+            "memory": self.memory[index].tolist(),
+        }
+
+    def run(self, max_cycles: int) -> int:
+        # steps every running instance until it emits a message or max_cycles have been executed, returns the amount
+        # of instances that are still running
+        running = np.flatnonzero(self.messages == RUNNING)
+        for _ in range(max_cycles):
+            if not len(running):
+                break
+            if self.step(running):
+                running = np.flatnonzero(self.messages == RUNNING)
+
+        return len(running)
+
+    def step(self, running: np.ndarray) -> bool:
+        # steps the given running instances once, returns whether any of them emitted a message
+        pc = self.pc[running]
+        operations = self.operations[pc]
+        a = self.a[pc]
+        b = self.b[pc]
+        c = self.c[pc]
+
+        next_pc = (pc + 1) & 0x3ff
+        messages = np.zeros(len(running), dtype=np.int8)
+        self.cycles[running] += 1
+
+        for operation in np.flatnonzero(np.bincount(operations, minlength=24)):
+            mask = operations == operation
+            rows = running[mask]
+            op_a = a[mask]
+            op_b = b[mask]
+            op_c = c[mask]
+
+            if operation == 0b0000:  # nop
+                pass
+            elif operation == 0b0001:  # hlt
+                next_pc[mask] = pc[mask]
+                messages[mask] = HALTED
+            elif operation == 0b0010:  # jmp
+                next_pc[mask] = op_a
+            elif operation == 0b0011:  # brh
+                zero = self.zero[rows]
+                carry = self.carry[rows]
+                taken = np.select([op_a == 0, op_a == 1, op_a == 2], [zero, ~zero, carry], ~carry)
+                next_pc[mask] = np.where(taken, op_b, next_pc[mask])
+            elif operation == 0b0100:  # cal
+                if (self.stack_pointer[rows] >= self.stack.shape[1]).any():
+                    self.stack = np.concatenate([self.stack, np.zeros_like(self.stack)], axis=1)
+                self.stack[rows, self.stack_pointer[rows]] = pc[mask]
+                self.stack_pointer[rows] += 1
+                next_pc[mask] = op_a
+            elif operation == 0b0101:  # ret
+                empty = self.stack_pointer[rows] == 0
+                returning = rows[~empty]
+                self.stack_pointer[returning] -= 1
+                addresses = next_pc[mask]
+                addresses[empty] = pc[mask][empty]
+                addresses[~empty] = (self.stack[returning, self.stack_pointer[returning]] + 1) & 0x3ff
+                next_pc[mask] = addresses
+                messages[mask] = np.where(empty, EMPTY_RETURN, RUNNING)
+            elif operation in [0b0110, 0b0111]:  # pld, pst
+                messages[mask] = PORT_IO
+            elif operation == 0b1000:  # mld
+                self.regs[rows, op_a] = self.memory[rows, (self.regs[rows, op_b] + op_c) & 0xff]
+            elif operation == 0b1001:  # mst
+                self.memory[rows, (self.regs[rows, op_b] + op_c) & 0xff] = self.regs[rows, op_a]
+            elif operation == 0b1010:  # ldi
+                self.regs[rows, op_a] = op_b
+            elif operation == 0b1111:  # rsh
+                self.regs[rows, op_a] = self.regs[rows, op_b] >> 1
+            else:
+                if operation == 0b1011:  # adi
+                    value = self.regs[rows, op_c].astype(np.int64) + op_b
+                    carry = value > 0xff
+                elif operation == 0b1100:  # add
+                    value = self.regs[rows, op_b].astype(np.int64) + self.regs[rows, op_c]
+                    carry = value > 0xff
+                elif operation == 0b1101:  # sub
+                    value = self.regs[rows, op_b].astype(np.int64) - self.regs[rows, op_c]
+                    carry = value >= 0
+                else:  # bit operations
+                    value = BIT_FUNCTIONS[operation - BIT_OPERATION](self.regs[rows, op_b].astype(np.int64), self.regs[rows, op_c].astype(np.int64))
+                    carry = False
+
+                result = value & 0xff
+                self.regs[rows, op_a] = result
+                self.zero[rows] = result == 0
+                self.carry[rows] = carry
+
+        self.pc[running] = next_pc
+        if not messages.any():
+            return False
+
+        self.messages[running] = messages
+        return True
+
+if __name__ == "__main__":
+    count = 1000
+    seed = 0
+    max_cycles = None
+    verify = False
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] in ["-n", "--instances"] and len(sys.argv) > 2:
+            count = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-s", "--seed"] and len(sys.argv) > 2:
+            seed = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--max-cycles" and len(sys.argv) > 2:
+            max_cycles = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--verify":
+            verify = True
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 2:
+        print_help(error=True)
+
+    with open(sys.argv[1], "rb") as f:
+        machine_code = f.read()
+
+    # random initial registers (r0 stays 0) and memory for every instance
+    rng = np.random.default_rng(seed)
+    emulator = BatchEmulator(machine_code, count)
+    emulator.regs[:, 1:8] = rng.integers(0, 256, (count, 7), dtype=np.uint8)
+    emulator.memory[:] = rng.integers(0, 256, (count, 256), dtype=np.uint8)
+    initial_regs = emulator.regs.copy()
+    initial_memory = emulator.memory.copy()
+
+    running = emulator.run(max_cycles if max_cycles is not None else 2**63 - 1)
+
+    for code, message in enumerate(MESSAGES):
+        amount = int((emulator.messages == code).sum())
+        if amount:
+            print(f"{amount} instance(s) {message or 'still running'}")
+    print(f"cycles: min {emulator.cycles.min()}, mean {emulator.cycles.mean():.1f}, max {emulator.cycles.max()}")
+
+    if verify:
+        mismatches = 0
+        for index in range(count):
+            scalar = Emulator(machine_code, jit=False)
+            scalar.regs[:] = initial_regs[index].tobytes()
+            scalar.memory[:] = initial_memory[index].tobytes()
+            message = scalar.run(int(emulator.cycles[index]))
+
+            if message != emulator.get_message(index) or scalar.get_state() != emulator.get_state(index):
+                mismatches += 1
+                print(f"instance {index} differs from the scalar emulator")
+
+        print(f"verified {count} instance(s), {mismatches} mismatch(es)")
+        if mismatches:
+            exit(1)
@@ -0,0 +1,395 @@
+import math
+import os
+import sys
+
+from bdbg import Emulator, decode
+from debuginfo import load_debug_info
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <program.bin>")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  -t, --trips <label|address>=<count>: trip count of the loop starting at a label or address, either")
+    print("      the exact amount of times it jumps back or <min>:<max>, can be given multiple times")
+    print("  --no-blocks: don't list the basic blocks")
+
+    exit(1 if error else 0)
+
+HLT = 0b0001
+JMP = 0b0010
+BRH = 0b0011
+CAL = 0b0100
+RET = 0b0101
+
+# operations that end a basic block
+TERMINATORS = {HLT, JMP, BRH, CAL, RET}
+
+# (best, worst) amount of cycles, worst is math.inf when it can't be bounded
+Bounds = tuple[float, float]
+
+def get_successors(rom: list[int], address: int) -> tuple[list[int], int | None]:
+    # returns the addresses execution can continue at after the instruction at address, and the call target of a cal
+    # execution continues after a cal at the next instruction, as the call returns there
+    operation, a, b, _ = decode(rom[address])
+    next_address = (address + 1) & 0x3ff
+
+    if operation in [HLT, RET]:
+        return [], None
+    elif operation == JMP:
+        return [a], None
+    elif operation == BRH:
+        return sorted({b, next_address}), None
+    elif operation == CAL:
+        return [next_address], a
+
+    return [next_address], None
+
+def get_components(nodes: list[int], edges: dict[int, list[int]]) -> list[list[int]]:
+    # strongly connected components in topological order (kosaraju's algorithm)
+    order = []
+    visited = set()
+    for root in nodes:
+        if root in visited:
+            continue
+
+        visited.add(root)
+        stack = [(root, iter(edges[root]))]
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                if successor not in visited:
+                    visited.add(successor)
+                    stack.append((successor, iter(edges[successor])))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+
+    predecessors = {node: [] for node in nodes}
+    for node in nodes:
+        for successor in edges[node]:
+            predecessors[successor].append(node)
+
+    components = []
+    assigned = set()
+    for root in reversed(order):
+        if root in assigned:
+            continue
+
+        assigned.add(root)
+        component = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            component.append(node)
+            for predecessor in predecessors[node]:
+                if predecessor not in assigned:
+                    assigned.add(predecessor)
+                    stack.append(predecessor)
+
+        components.append(component)
+
+    return components
+
+def add_bounds(a: Bounds, b: Bounds) -> Bounds:
+    return a[0] + b[0], a[1] + b[1]
+
+def multiply_bounds(trips: Bounds, bounds: Bounds) -> Bounds:
+    # 0 trips of an unbounded iteration cost nothing
+    return trips[0] * bounds[0], 0 if trips[1] == 0 else trips[1] * bounds[1]
+
+def merge_bounds(bounds: list[Bounds]) -> Bounds:
+    return min(best for best, _ in bounds), max(worst for _, worst in bounds)
+
+def format_depth(depth: float) -> str:
+    return "unbounded (recursive)" if depth == math.inf else str(depth)
+
+def format_bounds(bounds: Bounds) -> str:
+    best, worst = bounds
+    return f"best {best:.0f}, worst " + ("unbounded" if worst == math.inf else f"{worst:.0f}")
+
+class Block:
+    def __init__(self, start: int) -> None:
+        self.start = start
+        # address after the last instruction
+        self.end = start
+        self.successors = []
+        # call target of the cal that ends the block, None if it doesn't end with a cal
+        self.call = None
+        # whether execution can run past the end of the program from this block
+        self.runs_off_end = False
+
+class ControlFlowGraph:
+    def __init__(self, rom: list[int], length: int) -> None:
+        self.rom = rom
+        self.length = length
+
+        # find the reachable instructions, starting at 0 and following every jump, branch and call
+        self.reachable = set()
+        self.call_targets = set()
+        leaders = {0}
+        pending = [0]
+        while pending:
+            address = pending.pop()
+            if address in self.reachable or address >= length:
+                continue
+            self.reachable.add(address)
+
+            successors, call = get_successors(rom, address)
+            pending += successors
+            if call is not None:
+                self.call_targets.add(call)
+                pending.append(call)
+                leaders.add(call)
+
+            if decode(rom[address])[0] in TERMINATORS:
+                leaders.update(successors)
+
+        # split the reachable instructions into basic blocks
+        self.blocks = {}
+        for leader in sorted(leaders & self.reachable):
+            block = Block(leader)
+            address = leader
+            while True:
+                successors, call = get_successors(rom, address)
+                block.end = address + 1
+                if decode(rom[address])[0] in TERMINATORS or block.end in leaders or block.end >= length:
+                    break
+                address += 1
+
+            block.successors = [successor for successor in successors if successor < length]
+            block.runs_off_end = len(block.successors) < len(successors)
+            block.call = call
+            self.blocks[leader] = block
+
+        # function entry: blocks of the function, the code at 0 is the entry of the program
+        self.functions = {}
+        for entry in sorted({0} | (self.call_targets & self.reachable)):
+            blocks = set()
+            pending = [entry]
+            while pending:
+                start = pending.pop()
+                if start not in blocks:
+                    blocks.add(start)
+                    pending += self.blocks[start].successors
+            self.functions[entry] = blocks
+
+        self.function_bounds = {}
+        # header of every loop that was found: trip count bounds
+        self.loops = {}
+
+    def get_unreachable_ranges(self) -> list[tuple[int, int]]:
+        # (start, end) of every unreachable range of instructions, end is exclusive
+        ranges = []
+        for address in range(self.length):
+            if address in self.reachable:
+                continue
+            if ranges and ranges[-1][1] == address:
+                ranges[-1] = (ranges[-1][0], address + 1)
+            else:
+                ranges.append((address, address + 1))
+
+        return ranges
+
+    def get_callees(self, entry: int) -> set[int]:
+        return {self.blocks[start].call for start in self.functions[entry] if self.blocks[start].call is not None}
+
+    def get_call_depth(self, entry: int, active: set[int] | None = None) -> float:
+        # the maximum amount of return addresses on the call stack while the function runs, math.inf for recursion
+        active = active or set()
+        if entry in active:
+            return math.inf
+
+        depth = 0
+        for callee in self.get_callees(entry):
+            depth = max(depth, 1 + self.get_call_depth(callee, active | {entry}))
+
+        return depth
+
+    def get_block_bounds(self, start: int, trip_counts: dict[int, Bounds]) -> Bounds:
+        block = self.blocks[start]
+        bounds = (block.end - block.start, block.end - block.start)
+        if block.call is not None:
+            bounds = add_bounds(bounds, self.get_function_bounds(block.call, trip_counts))
+        if block.runs_off_end:
+            # runs through the empty rom and wraps around to 0
+            bounds = (bounds[0], math.inf)
+
+        return bounds
+
+    def get_function_bounds(self, entry: int, trip_counts: dict[int, Bounds]) -> Bounds:
+        # cycles from the call (or the start of the program) until the function returns or halts, calls are
+        # assumed to return
+        if entry in self.function_bounds:
+            if self.function_bounds[entry] is None:
+                # recursion
+                return 0, math.inf
+            return self.function_bounds[entry]
+
+        self.function_bounds[entry] = None
+        blocks = self.functions[entry]
+        distances = self.get_distances(blocks, entry, None, trip_counts)
+
+        exits = [distances[start] for start in blocks if not self.blocks[start].successors or self.blocks[start].runs_off_end]
+        bounds = merge_bounds(exits) if exits else (0, math.inf)
+
+        self.function_bounds[entry] = bounds
+        return bounds
+
+    def get_distances(self, nodes: set[int], entry: int, loop_header: int | None, trip_counts: dict[int, Bounds]) -> dict[int, Bounds]:
+        # bounds on the cycles from the start of entry until the end of every block, loops are collapsed using their
+        # trip counts, jumps back to loop_header are ignored so only a single iteration of that loop is measured
+        edges = {node: [s for s in self.blocks[node].successors if s in nodes and s != loop_header] for node in nodes}
+        predecessors = {node: [] for node in nodes}
+        for node in nodes:
+            for successor in edges[node]:
+                predecessors[successor].append(node)
+
+        distances = {}
+        for component in get_components([entry, *sorted(nodes - {entry})], edges):
+            members = set(component)
+
+            # cycles before the component is entered
+            incoming = [distances[p] for node in component for p in predecessors[node] if p not in members and p in distances]
+            if entry in members:
+                incoming.append((0, 0))
+            if not incoming:
+                continue
+            start = merge_bounds(incoming)
+
+            headers = [node for node in component if node == entry or any(p not in members for p in predecessors[node])]
+            header = min(headers)
+            if len(component) == 1 and header not in edges[header]:
+                distances[header] = add_bounds(start, self.get_block_bounds(header, trip_counts))
+                continue
+
+            # a loop: every iteration runs from the header back to it, the loop is left after some amount of
+            # iterations from any of its blocks
+            inner = self.get_distances(members, header, header, trip_counts)
+            iteration = merge_bounds([inner[node] for node in component if header in self.blocks[node].successors and node in inner])
+
+            trips = trip_counts.get(header, (0, math.inf))
+            if len(headers) > 1:
+                # entered in the middle, the trip count can't be trusted
+                trips = (0, math.inf)
+            self.loops[header] = trips
+
+            for node in component:
+                if node in inner:
+                    distances[node] = add_bounds(start, add_bounds(multiply_bounds(trips, iteration), inner[node]))
+
+        return distances
+
+def parse_trip_count(text: str) -> Bounds:
+    if ":" in text:
+        minimum, maximum = text.split(":", 1)
+        return int(minimum), int(maximum)
+
+    return int(text), int(text)
+
+def format_address(address: int, labels: dict[int, str], lines: dict[int, int]) -> str:
+    text = f"{address:#05x}"
+    if address in labels:
+        text += f" ({labels[address]})"
+    if address in lines:
+        text += f" line {lines[address]}"
+
+    return text
+
+if __name__ == "__main__":
+    trip_arguments = []
+    list_blocks = True
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] in ["-t", "--trips"] and len(sys.argv) > 2 and "=" in sys.argv[2]:
+            trip_arguments.append(sys.argv.pop(2))
+        elif sys.argv[1] == "--no-blocks":
+            list_blocks = False
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 2:
+        print_help(error=True)
+
+    with open(sys.argv[1], "rb") as f:
+        machine_code = f.read()
+
+    debug_info = None
+    if os.path.exists(f"{sys.argv[1]}.dbg"):
+        debug_info = load_debug_info(f"{sys.argv[1]}.dbg")
+
+    labels = {}
+    lines = {}
+    label_addresses = {}
+    if debug_info is not None:
+        for name, (address, _) in debug_info.labels.items():
+            labels.setdefault(address, name)
+            label_addresses[name] = address
+        lines = dict(debug_info.instructions)
+
+    trip_counts = {}
+    for argument in trip_arguments:
+        location, count = argument.split("=", 1)
+        try:
+            address = label_addresses[location] if location in label_addresses else int(location, 0)
+            trip_counts[address] = parse_trip_count(count)
+        except ValueError:
+            print(f"invalid trip count {argument!r}")
+            exit(1)
+
+    length = min(len(machine_code) // 2, 2**10)
+    cfg = ControlFlowGraph(Emulator(machine_code).rom, length)
+
+    print(f"{length} instructions, {len(cfg.reachable)} reachable, {len(cfg.blocks)} basic blocks, {len(cfg.functions)} functions")
+
+    unreachable = cfg.get_unreachable_ranges()
+    if unreachable:
+        print()
+        print("unreachable code:")
+        for start, end in unreachable:
+            print(f"  {format_address(start, labels, lines)} to {format_address(end - 1, labels, lines)}, {end - start} instruction(s)")
+
+    if list_blocks:
+        print()
+        print("basic blocks:")
+        for block in cfg.blocks.values():
+            successors = ", ".join(f"{successor:#05x}" for successor in block.successors)
+            if block.runs_off_end:
+                successors += (", " if successors else "") + "past the end of the program"
+            line = f"  {format_address(block.start, labels, lines)}: {block.end - block.start} instruction(s)"
+            if block.call is not None:
+                line += f", calls {block.call:#05x}"
+            print(line + (f" -> {successors}" if successors else ""))
+
+    bounds = cfg.get_function_bounds(0, trip_counts)
+
+    print()
+    print("call graph:")
+    for entry in cfg.functions:
+        callees = ", ".join(format_address(callee, labels, {}) for callee in sorted(cfg.get_callees(entry)))
+        print(f"  {format_address(entry, labels, lines)}: {len(cfg.functions[entry])} blocks, "
+              f"call depth {format_depth(cfg.get_call_depth(entry))}, "
+              f"cycles {format_bounds(cfg.get_function_bounds(entry, trip_counts))}"
+              + (f", calls {callees}" if callees else ""))
+
+    if cfg.loops:
+        print()
+        print("loops:")
+        for header, trips in sorted(cfg.loops.items()):
+            if trips[1] == math.inf:
+                trips_text = "no trip count"
+            elif trips[0] == trips[1]:
+                trips_text = f"{trips[0]} trips"
+            else:
+                trips_text = f"{trips[0]} to {trips[1]} trips"
+            print(f"  {format_address(header, labels, lines)}: {trips_text}")
+
+    for address in sorted(set(trip_counts) - set(cfg.loops)):
+        print(f"warning: no loop starts at {format_address(address, labels, lines)}")
+
+    print()
+    print(f"program: max call depth {format_depth(cfg.get_call_depth(0))}, cycles {format_bounds(bounds)}")
@@ -1,43 +1,877 @@
-import curses
-import curses.textpad
+import array
 import json
 import sys
 import os
+import time
+
+from btrace import TRACE_INFO_BRANCH_TAKEN, TRACE_INFO_MEMORY_WRITE, TRACE_RECORD, TraceWriter
+from debuginfo import DebugInfo, load_debug_info
+from ports import PortBus, create_default_bus
+from snapshot import DEFAULT_CHECKPOINT_INTERVAL, Checkpoints, restore_snapshot
 
 def print_help(error: bool) -> None:
     print(f"usage: {sys.argv[0]} [flags] <program.bin>")
     print("flags:")
     print("  -h, --help: show this help message")
+    print("  --run: run the program without the debugger and print the final state as json")
+    print("  --max-cycles <count>: stop a --run after this many cycles (default: run until the program halts)")
+    print("  --trace <path>: record a binary execution trace of a --run, see btrace.py")
+    print("  --input <path>: controller input of a --run, one byte per read of the controller port, - for stdin")
+    print("  --async: read the --input while the program runs instead of before it starts (for pipes)")
+    print("  --seed <seed>: seed of the random number generator port")
+    print(f"  --journal-size <entries>: amount of cycles the debugger can step back, 0 disables reverse stepping (default: {DEFAULT_JOURNAL_SIZE})")
+    print("  --connect <address>: debug a program running on a debug server (see bserver.py) instead of running it locally")
+    print("  --checkpoint-dir <path>: save a snapshot of the state every --checkpoint-interval cycles into this directory")
+    print(f"  --checkpoint-interval <cycles>: cycles between checkpoints (default: {DEFAULT_CHECKPOINT_INTERVAL})")
+    print("  --resume <path>: start from a snapshot instead of cycle 0, a directory resumes from its latest checkpoint")
 
     exit(1 if error else 0)
 
-def debug_program(path: str) -> None:
+def load_resume_snapshot(machine_code: bytes, path: str) -> bytes:
+    # the snapshot at path, or the latest checkpoint of the program in the directory at path
+    if not os.path.isdir(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    checkpoints = Checkpoints(machine_code, path)
+    cycles = checkpoints.find()
+    if cycles is None:
+        print(f"{path} has no checkpoints of this program", file=sys.stderr)
+        exit(1)
+    return checkpoints.load(cycles)
+
+def run_program(path: str, max_cycles: int | None, trace_path: str | None, input_path: str | None, use_async: bool, seed: int | None, checkpoint_dir: str | None, checkpoint_interval: int, resume_path: str | None) -> None:
     with open(path, "rb") as f:
         machine_code = f.read()
 
-    if not os.path.exists(f"{path}.dbg"):
-        print("debug information not found, run the assembler with the -d flag to generate debug information")
-        exit(1)
+    source_map = None
+    if os.path.exists(f"{path}.dbg"):
+        source_map = SourceMap(load_debug_info(f"{path}.dbg"))
+
+    # display output goes to stderr, stdout is reserved for the final state
+    bus, controller = create_default_bus(sys.stderr, seed)
+    emulator = Emulator(machine_code, ports=bus)
+    if resume_path is not None:
+        try:
+            restore_snapshot(emulator, load_resume_snapshot(machine_code, resume_path))
+        except (OSError, ValueError) as e:
+            print(f"can't resume from {resume_path}: {e}", file=sys.stderr)
+            exit(1)
+    if trace_path is not None:
+        emulator.trace = TraceWriter(trace_path, emulator.cycles, emulator.regs)
+
+    # checkpoints are saved at every multiple of the interval
+    checkpoints = None
+    next_checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoints = Checkpoints(machine_code, checkpoint_dir)
+        next_checkpoint = (emulator.cycles // checkpoint_interval + 1) * checkpoint_interval
+
+    def save_checkpoint() -> None:
+        nonlocal next_checkpoint
+        if next_checkpoint is not None and emulator.cycles >= next_checkpoint:
+            checkpoints.save(emulator)
+            next_checkpoint = (emulator.cycles // checkpoint_interval + 1) * checkpoint_interval
+
+    input_file = None
+    if input_path is not None:
+        input_file = sys.stdin.buffer if input_path == "-" else open(input_path, "rb")
+
+    start = time.perf_counter()
+    start_cycles = emulator.cycles
+    message = None
+    if use_async:
+        import asyncio
+
+        from ports import run_async
+
+        inputs = [(controller, input_file.fileno())] if input_file is not None else []
+        # the slices don't line up with the interval, checkpoints are saved at the end of the slice that reaches it
+        message = asyncio.run(run_async(emulator, max_cycles, inputs, save_checkpoint))
+    else:
+        if input_file is not None:
+            controller.feed(input_file.read())
+
+        while message is None and (max_cycles is None or emulator.cycles < max_cycles):
+            budget = 2**20
+            if max_cycles is not None:
+                budget = min(budget, max_cycles - emulator.cycles)
+            if next_checkpoint is not None:
+                budget = min(budget, next_checkpoint - emulator.cycles)
+            message = emulator.run(budget)
+            save_checkpoint()
+    elapsed = time.perf_counter() - start
+
+    bus.flush()
+
+    if emulator.trace is not None:
+        emulator.trace.close()
+
+    state = {"message": message, **emulator.get_state()}
+    if source_map is not None:
+        state["line"] = source_map.get_line_number(emulator.pc)
+
+    print(json.dumps(state))
+    executed = emulator.cycles - start_cycles
+    print(f"executed {executed} cycles in {elapsed:.3f}s ({executed / max(elapsed, 1e-9):,.0f} cycles/sec)", file=sys.stderr)
+
+def debug_program(path: str, journal_size: int, address: str | None, seed: int | None, checkpoint_dir: str | None, checkpoint_interval: int, resume_path: str | None) -> None:
+    import curses
+    import io
+
+    from bserver import DebugClient, DebugSession, start_local_session
+
+    source_map = load_source_map(path)
+
+    if address is not None:
+        client = DebugClient.connect(address)
+    else:
+        with open(path, "rb") as f:
+            machine_code = f.read()
+        # the screen belongs to curses, display output is printed once the debugger quits
+        output = io.StringIO()
+        session = DebugSession(machine_code, journal_size, lambda: create_default_bus(output, seed)[0], path, checkpoint_dir, checkpoint_interval)
+        if resume_path is not None:
+            try:
+                session.restore(load_resume_snapshot(machine_code, resume_path))
+            except (OSError, ValueError) as e:
+                print(f"can't resume from {resume_path}: {e}", file=sys.stderr)
+                exit(1)
+        client = start_local_session(session)
+
+    try:
+        curses.wrapper(lambda stdscr: debug_loop(stdscr, client, source_map, path))
+    finally:
+        client.close()
+        if address is None:
+            session.emulator.ports.flush()
+            print(output.getvalue(), end="")
+
+BIT_OPERATION = 0b10000
+
+# operations whose a operand is a destination register: pld, mld, ldi, adi, add, sub, rsh and bit
+WRITES_REG_A = {0b0110, 0b1000, 0b1010, 0b1011, 0b1100, 0b1101, 0b1111, *range(BIT_OPERATION, BIT_OPERATION + 8)}
+
+SINK_REGISTER = 8
+
+def decode_word(instruction: int) -> tuple[int, int, int, int]:
+    # returns (operation, a, b, c), operation is the opcode, or BIT_OPERATION + the operation for bit instructions
+    # only the operands used by the opcode are extracted, unused ones are 0
+    opcode = instruction >> 12
+    reg_a = (instruction >> 9) & 0b111
+    reg_b = (instruction >> 6) & 0b111
+
+    if opcode in [0b0010, 0b0100]:  # jmp, cal
+        return opcode, instruction & 0x3ff, 0, 0
+    elif opcode == 0b0011:  # brh
+        return opcode, (instruction >> 10) & 0b11, instruction & 0x3ff, 0
+    elif opcode in [0b0110, 0b0111, 0b1010]:  # pld, pst, ldi
+        return opcode, reg_a, instruction & 0xff, 0
+    elif opcode == 0b1011:  # adi, reg a is both the destination and the source
+        return opcode, reg_a, instruction & 0xff, reg_a
+    elif opcode in [0b1000, 0b1001]:  # mld, mst
+        offset = instruction & 0x3f
+        return opcode, reg_a, reg_b, offset - 0x40 if offset & 0x20 else offset
+    elif opcode in [0b1100, 0b1101]:  # add, sub
+        return opcode, reg_a, reg_b, instruction & 0b111
+    elif opcode == 0b1110:  # bit
+        return BIT_OPERATION + ((instruction >> 3) & 0b111), reg_a, reg_b, instruction & 0b111
+    elif opcode == 0b1111:  # rsh
+        return opcode, reg_a, reg_b, 0
+
+    # nop, hlt, ret
+    return opcode, 0, 0, 0
+
+# decode_word() of every instruction word, shared by the emulators and the disassembler (see bdis.py)
+DECODE_TABLE = [decode_word(instruction) for instruction in range(2**16)]
+
+def decode(instruction: int) -> tuple[int, int, int, int]:
+    return DECODE_TABLE[instruction]
+
+# operations that end a basic block: hlt, brh, cal and ret, jmp is followed into its target instead
+BLOCK_TERMINATORS = {0b0001, 0b0011, 0b0100, 0b0101}
+
+# port io is left to the interpreter, so pld and pst are never part of a block
+BLOCK_EXCLUDED = {0b0110, 0b0111}
+
+BIT_EXPRESSIONS = [
+    "{b} | {c}",
+    "{b} & {c}",
+    "{b} ^ {c}",
+    "(~{b} | {c}) & 0xff",
+    "~({b} | {c}) & 0xff",
+    "~({b} & {c}) & 0xff",
+    "~({b} ^ {c}) & 0xff",
+    "{b} & ~{c} & 0xff",
+]
+
+# a block is only compiled once execution has entered it this many times
+BLOCK_COMPILE_THRESHOLD = 16
+
+# upper bound on the amount of instructions in one block, jumps are followed so blocks can get long
+MAX_BLOCK_LENGTH = 256
+
+def generate_block_source(rom: list[int], address: int, breakpoints: frozenset[int] = frozenset(), excluded: frozenset[int] = frozenset()) -> tuple[str, int] | None:
+    # returns the source of a function executing the basic block starting at address, and its length in
+    # instructions, or None if the instruction at address can't be part of a block
+    # unconditional jumps are followed into their target, and a block whose terminator branches back to its
+    # own start loops inside the function for as long as the cycle budget it gets passed allows
+    # blocks never run into a breakpoint, a breakpoint address can only be the start of a block
+    # excluded addresses (instrumented instructions) are never part of a block
+    def read(reg: int) -> str:
+        return "0" if reg == 0 else f"regs[{reg}]"
+
+    def write(reg: int, value: str) -> None:
+        if reg != 0:
+            body.append(f"regs[{reg}] = {value}")
+
+    body = []
+    visited = set()
+    length = 0
+    current = address
+    terminator = None
+
+    while current not in visited and length < MAX_BLOCK_LENGTH and (length == 0 or current not in breakpoints):
+        operation, a, b, c = decode(rom[current])
+
+        if operation in BLOCK_EXCLUDED or current in excluded:
+            break
+
+        visited.add(current)
+        length += 1
+        body.append(f"# {current:03X}: {rom[current]:04X}")
+
+        if operation == 0b0010:  # jmp
+            current = a
+            continue
+
+        if operation in BLOCK_TERMINATORS:
+            terminator = (operation, a, b, current)
+            break
+
+        if operation == 0b1000:  # mld
+            write(a, f"memory[({read(b)} + {c}) & 0xff]")
+        elif operation == 0b1001:  # mst
+            body.append(f"memory[({read(b)} + {c}) & 0xff] = {read(a)}")
+        elif operation == 0b1010:  # ldi
+            write(a, str(b))
+        elif operation == 0b1111:  # rsh
+            write(a, f"{read(b)} >> 1")
+        elif operation in [0b1011, 0b1100, 0b1101]:  # adi, add, sub
+            if operation == 0b1011:
+                body.append(f"value = {read(c)} + {b}")
+            elif operation == 0b1100:
+                body.append(f"value = {read(b)} + {read(c)}")
+            else:
+                body.append(f"value = {read(b)} - {read(c)}")
+            body.append("result = value & 0xff")
+            write(a, "result")
+            body.append("zero = result == 0")
+            body.append("carry = value >= 0" if operation == 0b1101 else "carry = value > 0xff")
+        elif operation >= BIT_OPERATION:  # bit
+            body.append(f"result = {BIT_EXPRESSIONS[operation - BIT_OPERATION].format(b=read(b), c=read(c))}")
+            write(a, "result")
+            body.append("zero = result == 0")
+            body.append("carry = False")
+
+        current = (current + 1) & 0x3ff
+
+    if length == 0:
+        return None
+
+    # (condition, pc) pairs leaving the block, checked in order, the last condition is always "True"
+    exits = []
+    message = "None"
+    if terminator is None:
+        exits.append(("True", current))
+    else:
+        operation, a, b, current = terminator
+        next_address = (current + 1) & 0x3ff
+        if operation == 0b0001:  # hlt
+            exits.append(("True", current))
+            message = "'halted'"
+        elif operation == 0b0011:  # brh
+            flag = ["zero", "zero", "carry", "carry"][a]
+            taken, not_taken = (b, next_address) if a in [0b00, 0b10] else (next_address, b)
+            exits.append((flag, taken))
+            exits.append(("True", not_taken))
+        elif operation == 0b0100:  # cal
+            body.append(f"self.stack.append({current})")
+            exits.append(("True", a))
+        elif operation == 0b0101:  # ret
+            exits.append(("True", current))
+            message = "self.execute_ret(0, 0, 0)"
+
+    lines = [
+        "def block(self, budget):",
+        "    regs = self.regs",
+        "    memory = self.memory",
+        "    zero = self.zero",
+        "    carry = self.carry",
+        "    cycles = 0",
+        "    while True:",
+        *(f"        {line}" for line in body),
+        f"        cycles += {length}",
+    ]
+    for condition, pc in exits:
+        lines.append(f"        if {condition}:")
+        if pc == address and message == "None" and address not in breakpoints:
+            # loop back to the start, unless that would exceed the cycle budget
+            lines.append(f"            if cycles + {length} > budget:")
+            lines.append(f"                pc = {pc}")
+            lines.append("                break")
+            lines.append("            continue")
+        else:
+            lines.append(f"            pc = {pc}")
+            lines.append("            break")
+    lines += [
+        "    self.zero = zero",
+        "    self.carry = carry",
+        "    self.cycles += cycles",
+        "    self.pc = pc",
+        f"    return {message}",
+    ]
+
+    return "\n".join(lines) + "\n", length
+
+# events hooks can be added for, see Emulator.add_hook()
+HOOK_EVENTS = ["step", "mem_read", "mem_write", "branch", "call", "ret", "halt"]
 
-    with open(f"{path}.dbg", "r") as f:
-        debug_info = json.load(f)
+# operation: the hook event observing it
+OPERATION_EVENTS = {0b0001: "halt", 0b0011: "branch", 0b0100: "call", 0b0101: "ret", 0b1000: "mem_read", 0b1001: "mem_write"}
 
-    curses.wrapper(lambda stdscr: debug_loop(stdscr, machine_code, debug_info))
+# journal entry layout, one 64 bit integer per executed instruction holding what's needed to undo it
+#   bits 0-9: pc, bit 10: zero, bit 11: carry
+#   bits 12-15: written register (0 if none), bits 16-23: its old value
+#   bit 24: memory written, bits 25-32: its address, bits 33-40: its old value
+#   bits 41-42: stack operation (JOURNAL_PUSH, JOURNAL_POP or 0), bits 43-52: the popped value
+JOURNAL_PUSH = 1
+JOURNAL_POP = 2
+
+class Journal:
+    # ring buffer of undo entries, the oldest entries are overwritten once it's full
+    def __init__(self, capacity: int) -> None:
+        self.entries = array.array("Q", bytes(8 * capacity))
+        self.capacity = capacity
+        self.end = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def push(self, entry: int) -> None:
+        self.entries[self.end] = entry
+        self.end = (self.end + 1) % self.capacity
+        self.length = min(self.length + 1, self.capacity)
+
+    def pop(self) -> int | None:
+        if self.length == 0:
+            return None
+
+        self.end = (self.end - 1) % self.capacity
+        self.length -= 1
+        return self.entries[self.end]
+
+    def clear(self) -> None:
+        self.end = 0
+        self.length = 0
 
 class Emulator:
-    def __init__(self, machine_code: bytes) -> None:
-        self.machine_code = machine_code
+    def __init__(self, machine_code: bytes, jit: bool = True, journal_size: int = 0, ports: PortBus | None = None) -> None:
         self.pc = 0
-        self.memory = [0] * 256
-        self.regs = [ZeroRegister(), *[Register() for _ in range(7)]]
+        self.cycles = 0
+        self.memory = bytearray(256)
+        # r0 is hard-wired to zero: instructions writing r0 are decoded to write the scratch byte
+        # regs[SINK_REGISTER] instead, which is never read
+        self.regs = bytearray(8 + 1)
         self.zero = False
         self.carry = False
         self.stack = []
 
-    def step(self) -> str:
-        return self.execute_instruction(int.from_bytes(self.machine_code[self.pc * 2:self.pc * 2 + 2], "big"))
+        # devices pld and pst talk to, every port is empty without a bus
+        self.ports = ports if ports is not None else PortBus()
+
+        # indexed by the operation returned by decode()
+        self.handlers = [
+            self.execute_nop, self.execute_hlt, self.execute_jmp, None,
+            self.execute_cal, self.execute_ret, self.execute_pld, self.execute_pst,
+            self.execute_mld, self.execute_mst, self.execute_ldi, self.execute_adi,
+            self.execute_add, self.execute_sub, None, self.execute_rsh,
+            self.execute_or, self.execute_and, self.execute_xor, self.execute_implies,
+            self.execute_nor, self.execute_nand, self.execute_xnor, self.execute_nimplies,
+        ]
+
+        # indexed by the condition of brh instructions
+        self.branch_handlers = [self.execute_brh_eq, self.execute_brh_ne, self.execute_brh_ge, self.execute_brh_lt]
+
+        # instrumentation hooks, the program only gets instrumented handlers at the addresses that are observed,
+        # which are never part of a compiled block
+        self.hooks = {event: [] for event in HOOK_EVENTS}
+        self.watchpoints = []
+        self.instrumented = frozenset()
+
+        # compiled basic blocks by start address, False if the address can't start a block
+        self.jit = jit
+        self.blocks = [None] * 2**10
+        self.block_visits = [0] * 2**10
+        self.block_breakpoints = frozenset()
+
+        # undo journal for reverse stepping, None when disabled
+        self.journal = None
+        if journal_size > 0:
+            self.journal = Journal(journal_size)
+
+        # execution trace writer (see btrace.py), None when disabled
+        self.trace = None
+        self.traced_program = None
+
+        # execution counts (see bprof.py), None when disabled
+        self.profile = None
+
+        self.load_rom(machine_code)
+
+    def load_rom(self, machine_code: bytes) -> None:
+        # replaces the rom, the registers, memory, flags and call stack are kept. the journal is cleared since
+        # stepping back into the old rom isn't possible
+        self.machine_code = machine_code
+
+        # the rom is immutable while it's loaded, so every address is decoded once up front
+        rom = machine_code[:2 * 2**10].ljust(2 * 2**10, b"\x00")
+        self.rom = [int.from_bytes(rom[address * 2:address * 2 + 2], "big") for address in range(2**10)]
+        self.program = [self.decode(instruction) for instruction in self.rom]
+        self.operations = [DECODE_TABLE[instruction][0] for instruction in self.rom]
+        self.decoded_program = list(self.program)
+
+        self.blocks = [None] * 2**10
+        self.block_visits = [0] * 2**10
+        self.traced_program = None
+        if self.journal is not None:
+            self.journal.clear()
+
+        # address: (written register, memory store (reg b, offset), stack operation) of the instruction there
+        self.effects = []
+        for instruction in self.rom:
+            operation, a, b, c = DECODE_TABLE[instruction]
+            self.effects.append((
+                a if operation in WRITES_REG_A else 0,
+                (b, c) if operation == 0b1001 else None,
+                JOURNAL_PUSH if operation == 0b0100 else JOURNAL_POP if operation == 0b0101 else 0,
+            ))
+
+        if self.instrumented or self.watchpoints or any(self.hooks.values()):
+            self.update_instrumentation()
+
+    def decode(self, instruction: int) -> tuple:
+        operation, a, b, c = DECODE_TABLE[instruction]
+        if operation == 0b0011:  # brh
+            return self.branch_handlers[a], a, b, c
+        if a == 0 and operation in WRITES_REG_A:
+            a = SINK_REGISTER
+        return self.handlers[operation], a, b, c
+
+    def step(self) -> str | None:
+        if self.profile is not None:
+            return self.run_profiled(1, frozenset())
+        if self.journal is not None or self.trace is not None:
+            return self.step_recorded()
+
+        handler, a, b, c = self.program[self.pc]
+        self.cycles += 1
+        return handler(a, b, c)
+
+    def step_recorded(self) -> str | None:
+        # steps, journaling the instruction first and/or tracing it afterwards
+        pc = self.pc
+        if self.journal is not None:
+            self.record()
+
+        handler, a, b, c = self.program[pc]
+        self.cycles += 1
+        if self.trace is None:
+            return handler(a, b, c)
+
+        reg, store, _ = self.effects[pc]
+        address = None
+        if store is not None:
+            address = (self.regs[store[0]] + store[1]) & 0xff
+
+        message = handler(a, b, c)
+
+        self.trace.write(
+            self.cycles - 1, pc, self.rom[pc],
+            reg, self.regs[reg],
+            address, self.memory[address] if address is not None else 0,
+            message is None and self.pc != (pc + 1) & 0x3ff,
+        )
+        return message
+
+    def record(self) -> None:
+        # journals what the instruction at pc is about to change
+        pc = self.pc
+        reg, store, stack_operation = self.effects[pc]
+
+        entry = pc | self.zero << 10 | self.carry << 11
+        if reg:
+            entry |= reg << 12 | self.regs[reg] << 16
+        if store is not None:
+            address = (self.regs[store[0]] + store[1]) & 0xff
+            entry |= 1 << 24 | address << 25 | self.memory[address] << 33
+        if stack_operation == JOURNAL_PUSH:
+            entry |= JOURNAL_PUSH << 41
+        elif stack_operation == JOURNAL_POP and self.stack:
+            entry |= JOURNAL_POP << 41 | self.stack[-1] << 43
+
+        self.journal.push(entry)
+
+    def step_back(self) -> bool:
+        # undoes the last journaled instruction, returns False if there's nothing left to undo
+        if self.journal is None:
+            return False
+
+        entry = self.journal.pop()
+        if entry is None:
+            return False
+
+        self.pc = entry & 0x3ff
+        self.zero = bool(entry >> 10 & 1)
+        self.carry = bool(entry >> 11 & 1)
+
+        reg = entry >> 12 & 0b1111
+        if reg:
+            self.regs[reg] = entry >> 16 & 0xff
+        if entry >> 24 & 1:
+            self.memory[entry >> 25 & 0xff] = entry >> 33 & 0xff
+
+        stack_operation = entry >> 41 & 0b11
+        if stack_operation == JOURNAL_PUSH:
+            self.stack.pop()
+        elif stack_operation == JOURNAL_POP:
+            self.stack.append(entry >> 43 & 0x3ff)
+
+        self.cycles -= 1
+        return True
+
+    def run_back(self, breakpoints: set[int] | None = None) -> bool:
+        # steps back until execution reaches one of the breakpoint addresses, returns False if the journal ran out first
+        while self.step_back():
+            if breakpoints and self.pc in breakpoints:
+                return True
+
+        return False
+
+    def add_hook(self, event: str, callback, addresses=None) -> None:
+        # calls callback whenever an instruction (at one of the addresses, or anywhere) causes event:
+        #   step(emulator, pc) before every instruction
+        #   mem_read(emulator, pc, address, value) after mld, mem_write(emulator, pc, address, value) after mst
+        #   branch(emulator, pc, target, taken) after brh
+        #   call(emulator, pc, target) after cal, ret(emulator, pc, return address) after ret
+        #   halt(emulator, pc) after hlt
+        # a callback can return a message to stop the emulator after the instruction
+        if event not in self.hooks:
+            raise ValueError(f"unknown hook event {event!r}")
+
+        self.hooks[event].append((callback, frozenset(addresses) if addresses is not None else None))
+        self.update_instrumentation()
+
+    def remove_hook(self, event: str, callback) -> None:
+        self.hooks[event] = [hook for hook in self.hooks[event] if hook[0] != callback]
+        self.update_instrumentation()
+
+    def add_watchpoint(self, start: int, end: int, callback) -> None:
+        # calls callback(emulator, pc, address, value, write) after every mld or mst accessing memory[start:end]
+        self.watchpoints.append((start, end, callback))
+        self.update_instrumentation()
+
+    def remove_watchpoint(self, callback) -> None:
+        self.watchpoints = [watchpoint for watchpoint in self.watchpoints if watchpoint[2] != callback]
+        self.update_instrumentation()
+
+    def update_instrumentation(self) -> None:
+        # swaps instrumented handlers in (and plain ones back) for every address, compiled blocks are dropped
+        # when the set of instrumented addresses changes
+        instrumented = set()
+        for address in range(2**10):
+            entry = self.instrument(address)
+            if entry is None:
+                self.program[address] = self.decoded_program[address]
+            else:
+                self.program[address] = entry
+                instrumented.add(address)
+
+        if instrumented != self.instrumented:
+            self.instrumented = frozenset(instrumented)
+            self.blocks = [None] * 2**10
+        self.traced_program = None
+
+    def instrument(self, address: int) -> tuple | None:
+        # returns the program entry running the hooks observing the instruction at address, None if there are none
+        handler, a, b, c = self.decoded_program[address]
+        operation = self.operations[address]
+
+        def get_callbacks(event: str) -> list:
+            return [callback for callback, addresses in self.hooks[event] if addresses is None or address in addresses]
+
+        step_hooks = get_callbacks("step")
+        event_hooks = get_callbacks(OPERATION_EVENTS[operation]) if operation in OPERATION_EVENTS else []
+        watchpoints = list(self.watchpoints) if operation in [0b1000, 0b1001] else []
+        if not step_hooks and not event_hooks and not watchpoints:
+            return None
+
+        def instrumented(a: int, b: int, c: int) -> str | None:
+            pc = self.pc
+            pending = None
+            for hook in step_hooks:
+                pending = pending or hook(self, pc)
+
+            memory_address = (self.regs[b] + c) & 0xff if operation in [0b1000, 0b1001] else 0
+            message = handler(a, b, c)
+
+            if operation in [0b1000, 0b1001]:  # mld, mst
+                value = self.memory[memory_address]
+                for hook in event_hooks:
+                    pending = pending or hook(self, pc, memory_address, value)
+                for start, end, hook in watchpoints:
+                    if start <= memory_address < end:
+                        pending = pending or hook(self, pc, memory_address, value, operation == 0b1001)
+            elif operation == 0b0011:  # brh
+                for hook in event_hooks:
+                    pending = pending or hook(self, pc, b, self.pc == b)
+            elif operation == 0b0100 or (operation == 0b0101 and message is None):  # cal, ret
+                for hook in event_hooks:
+                    pending = pending or hook(self, pc, self.pc)
+            elif operation == 0b0001:  # hlt
+                for hook in event_hooks:
+                    pending = pending or hook(self, pc)
+
+            return message or pending
+
+        return instrumented, a, b, c
+
+    def compile_block(self, address: int) -> tuple | bool:
+        generated = generate_block_source(self.rom, address, self.block_breakpoints, self.instrumented)
+        if generated is None:
+            return False
+
+        source, length = generated
+        namespace = {}
+        exec(compile(source, f"<block {address:03X}>", "exec"), namespace)
+        return namespace["block"], length
+
+    def run(self, max_cycles: int, breakpoints: set[int] | None = None) -> str | None:
+        # runs until an instruction emits a message, max_cycles have been executed or execution reaches one of
+        # the breakpoint addresses, the instruction at pc when run is called is always executed
+        if self.profile is not None:
+            return self.run_profiled(max_cycles, breakpoints or frozenset())
+        if self.journal is None and self.trace is not None:
+            return self.run_traced(max_cycles, breakpoints or frozenset())
+        if self.journal is not None or self.trace is not None:
+            return self.run_recorded(max_cycles, breakpoints or frozenset())
+        if self.jit:
+            return self.run_compiled(max_cycles, breakpoints or frozenset())
+        return self.run_interpreted(max_cycles, breakpoints or frozenset())
+
+    def run_compiled(self, max_cycles: int, breakpoints: set[int]) -> str | None:
+        # executes whole basic blocks per dispatch, falling back to the interpreter for uncompiled blocks and
+        # blocks that would overshoot max_cycles
+        if breakpoints != self.block_breakpoints:
+            # compiled blocks may run past the new breakpoints
+            self.block_breakpoints = frozenset(breakpoints)
+            self.blocks = [None] * 2**10
+
+        program = self.program
+        blocks = self.blocks
+        block_visits = self.block_visits
+        start = self.cycles
+        limit = start + max_cycles
+
+        while self.cycles < limit:
+            pc = self.pc
+            if pc in breakpoints and self.cycles != start:
+                return None
+
+            block = blocks[pc]
+
+            if block is None:
+                block_visits[pc] += 1
+                if block_visits[pc] >= BLOCK_COMPILE_THRESHOLD:
+                    block = blocks[pc] = self.compile_block(pc)
+
+            if block and block[1] <= limit - self.cycles:
+                message = block[0](self, limit - self.cycles)
+            else:
+                handler, a, b, c = program[pc]
+                self.cycles += 1
+                message = handler(a, b, c)
+
+            if message is not None:
+                return message
+
+        return None
+
+    def run_interpreted(self, max_cycles: int, breakpoints: set[int]) -> str | None:
+        program = self.program
+        executed = 0
+        try:
+            if breakpoints:
+                while executed < max_cycles:
+                    if executed and self.pc in breakpoints:
+                        return None
+                    handler, a, b, c = program[self.pc]
+                    executed += 1
+                    message = handler(a, b, c)
+                    if message is not None:
+                        return message
+            else:
+                while executed < max_cycles:
+                    handler, a, b, c = program[self.pc]
+                    executed += 1
+                    message = handler(a, b, c)
+                    if message is not None:
+                        return message
+        finally:
+            self.cycles += executed
+
+        return None
+
+    def run_reference(self, max_cycles: int) -> str | None:
+        # executes one instruction word at a time with execute_instruction(), without the decode table, the
+        # handlers, compiled blocks or instrumentation. this is the reference every other engine is checked against
+        # (see bench.py --check)
+        for _ in range(max_cycles):
+            self.cycles += 1
+            message = self.execute_instruction(self.rom[self.pc])
+            if message is not None:
+                return message
+
+        return None
+
+    def run_recorded(self, max_cycles: int, breakpoints: set[int]) -> str | None:
+        # interprets every instruction with step_recorded(), compiled blocks don't journal or trace
+        step_recorded = self.step_recorded
+        executed = 0
+        while executed < max_cycles:
+            if executed and self.pc in breakpoints:
+                return None
+            executed += 1
+            message = step_recorded()
+            if message is not None:
+                return message
+
+        return None
+
+    def run_traced(self, max_cycles: int, breakpoints: set[int]) -> str | None:
+        # run_recorded() without the journal, packing the records straight into the trace buffer
+        rom = self.rom
+        regs = self.regs
+        memory = self.memory
+        trace = self.trace
+        buffer = trace.buffer
+        buffer_size = len(buffer)
+        pack_into = TRACE_RECORD.pack_into
+        record_size = TRACE_RECORD.size
+
+        if self.traced_program is None:
+            # address: (handler, a, b, c, instruction, written register, info byte without the branch bit, register
+            # and offset of the memory store, pc after the instruction unless it branches). instructions that don't
+            # store read r0 + 0, so their address is 0 like in step_recorded()
+            self.traced_program = []
+            for pc in range(len(rom)):
+                reg, store, _ = self.effects[pc]
+                info = reg if store is None else reg | TRACE_INFO_MEMORY_WRITE
+                self.traced_program.append((*self.program[pc], rom[pc], reg, info, *(store or (0, 0)), (pc + 1) & 0x3ff))
+        traced_program = self.traced_program
+
+        start = self.cycles
+        cycles = start
+        end = start + max_cycles
+        offset = trace.offset
+        pc = self.pc
+        try:
+            while cycles < end:
+                if breakpoints and cycles != start and pc in breakpoints:
+                    return None
+
+                handler, a, b, c, instruction, reg, info, store_reg, store_offset, fallthrough = traced_program[pc]
+                address = (regs[store_reg] + store_offset) & 0xff
+                message = handler(a, b, c)
+                next_pc = self.pc
+                if next_pc != fallthrough and message is None:
+                    info |= TRACE_INFO_BRANCH_TAKEN
+
+                pack_into(buffer, offset, cycles, pc, instruction, info, regs[reg], address, memory[address])
+                offset += record_size
+                if offset == buffer_size:
+                    trace.offset = offset
+                    trace.flush()
+                    offset = 0
+
+                cycles += 1
+                pc = next_pc
+                if message is not None:
+                    return message
+        finally:
+            trace.records += cycles - start
+            trace.offset = offset
+            self.cycles = cycles
+
+        return None
+
+    def run_profiled(self, max_cycles: int, breakpoints: set[int]) -> str | None:
+        # interprets every instruction, counting executions and taken branches per address and the calls and
+        # inclusive cycles per call target, profiling doesn't journal or trace
+        program = self.program
+        stack_operations = [stack_operation for _, _, stack_operation in self.effects]
+        profile = self.profile
+        executions = profile.executions
+        taken = profile.taken
+        call_stack = profile.call_stack
+
+        start = self.cycles
+        cycles = start
+        end = start + max_cycles
+        pc = self.pc
+        try:
+            while cycles < end:
+                if cycles != start and pc in breakpoints:
+                    return None
+
+                handler, a, b, c = program[pc]
+                message = handler(a, b, c)
+                cycles += 1
+                if message is not None:
+                    executions[pc] += 1
+                    return message
+
+                executions[pc] += 1
+                next_pc = self.pc
+                if next_pc != (pc + 1) & 0x3ff:
+                    taken[pc] += 1
+                stack_operation = stack_operations[pc]
+                if stack_operation:
+                    if stack_operation == JOURNAL_PUSH:
+                        profile.enter(next_pc, cycles - 1)
+                    elif call_stack:
+                        profile.leave(cycles)
+                pc = next_pc
+        finally:
+            self.cycles = cycles
+
+        return None
+
+    def get_state(self) -> dict:
+        return {
+            "cycles": self.cycles,
+            "pc": self.pc,
+            "registers": list(self.regs[:8]),
+            "zero": self.zero,
+            "carry": self.carry,
+            "stack": list(self.stack),
+            "memory": list(self.memory),
+        }
 
     def execute_instruction(self, instruction: int) -> str | None:
+        # extracts the fields of the instruction word itself and executes it without decode() or the handlers, so
+        # it can serve as the reference for them
         opcode = instruction >> 12
         arg_reg_a = (instruction >> 9) & 0b111
         arg_reg_b = (instruction >> 6) & 0b111
@@ -48,205 +882,609 @@ class Emulator:
         arg_offset = instruction & 0x3f
         arg_immediate = instruction & 0xff
 
-        if opcode == 0b1010:  # ldi
-            self.regs[arg_reg_a].write(arg_immediate)
-        elif opcode == 0b1101:  # sub
-            self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() - self.regs[arg_reg_c].get())
+        # the offset is signed, 6 bits
+        if arg_offset >= 0x20:
+            arg_offset -= 0x40
+
+        def write(reg: int, value: int) -> None:
+            # r0 always reads 0
+            if reg != 0:
+                self.regs[reg] = value & 0xff
+
+        def write_flags(reg: int, value: int, carry: bool) -> None:
+            write(reg, value)
+            self.zero = value & 0xff == 0
+            self.carry = carry
+
+        a = self.regs[arg_reg_a] if arg_reg_a != 0 else 0
+        b = self.regs[arg_reg_b] if arg_reg_b != 0 else 0
+        c = self.regs[arg_reg_c] if arg_reg_c != 0 else 0
+        next_pc = (self.pc + 1) & 0x3ff
+
+        if opcode == 0b0000:  # nop
+            pass
+        elif opcode == 0b0001:  # hlt
+            return "halted"
+        elif opcode == 0b0010:  # jmp
+            next_pc = arg_address
         elif opcode == 0b0011:  # brh
             if ((arg_condition == 0b00 and self.zero)
                 or (arg_condition == 0b01 and not self.zero)
                 or (arg_condition == 0b10 and self.carry)
                 or (arg_condition == 0b11 and not self.carry)):
-                self.pc = arg_address - 1
-        elif opcode == 0b0000:  # nop
-            pass
-        elif opcode == 0b0001:  # hlt
-            return "halted"
-        elif opcode == 0b0010:  # jmp
-            self.pc = arg_address - 1
+                next_pc = arg_address
         elif opcode == 0b0100:  # cal
             self.stack.append(self.pc)
-            self.pc = arg_address - 1
+            next_pc = arg_address
         elif opcode == 0b0101:  # ret
-            self.pc = self.stack.pop()
-        elif opcode == 0b0110:  # pld
-            self.pc += 1
-            return "port io is not implemented yet"
-        elif opcode == 0b0111:  # pst
-            self.pc += 1
-            return "port io is not implemented yet"
+            if not self.stack:
+                return "return with an empty call stack"
+            next_pc = (self.stack.pop() + 1) & 0x3ff
+        elif opcode in [0b0110, 0b0111]:  # pld, pst
+            self.pc = next_pc
+            device = self.ports.ports[arg_immediate]
+            if device is None:
+                return f"no device on port {arg_immediate}"
+            if opcode == 0b0110:
+                write(arg_reg_a, device.read(arg_immediate))
+            else:
+                device.write(arg_immediate, a)
         elif opcode == 0b1000:  # mld
-            self.regs[arg_reg_a].write(self.memory[self.regs[arg_reg_b].get() + arg_offset])
+            write(arg_reg_a, self.memory[(b + arg_offset) & 0xff])
         elif opcode == 0b1001:  # mst
-            self.memory[self.regs[arg_reg_b].get() + arg_offset] = self.regs[arg_reg_a].get()
+            self.memory[(b + arg_offset) & 0xff] = a
+        elif opcode == 0b1010:  # ldi
+            write(arg_reg_a, arg_immediate)
         elif opcode == 0b1011:  # adi
-            self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_a].get() + arg_immediate)
+            write_flags(arg_reg_a, a + arg_immediate, a + arg_immediate > 0xff)
         elif opcode == 0b1100:  # add
-            self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() + self.regs[arg_reg_c].get())
-        elif opcode == 0b1110:  # bit
+            write_flags(arg_reg_a, b + c, b + c > 0xff)
+        elif opcode == 0b1101:  # sub, carry is set when nothing was borrowed
+            write_flags(arg_reg_a, b - c, b >= c)
+        elif opcode == 0b1110:  # bit, never sets carry
             if arg_operation == 0b000:  # or
-                self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() | self.regs[arg_reg_c].get())
+                write_flags(arg_reg_a, b | c, False)
             elif arg_operation == 0b001:  # and
-                self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() & self.regs[arg_reg_c].get())
+                write_flags(arg_reg_a, b & c, False)
             elif arg_operation == 0b010:  # xor
-                self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() ^ self.regs[arg_reg_c].get())
+                write_flags(arg_reg_a, b ^ c, False)
             elif arg_operation == 0b011:  # implies
-                self.zero, self.carry = self.regs[arg_reg_a].write((~self.regs[arg_reg_b].get()) | self.regs[arg_reg_c].get())
+                write_flags(arg_reg_a, ~b | c, False)
             elif arg_operation == 0b100:  # nor
-                self.zero, self.carry = self.regs[arg_reg_a].write(~(self.regs[arg_reg_b].get() | self.regs[arg_reg_c].get()))
+                write_flags(arg_reg_a, ~(b | c), False)
             elif arg_operation == 0b101:  # nand
-                self.zero, self.carry = self.regs[arg_reg_a].write(~(self.regs[arg_reg_b].get() & self.regs[arg_reg_c].get()))
+                write_flags(arg_reg_a, ~(b & c), False)
             elif arg_operation == 0b110:  # xnor
-                self.zero, self.carry = self.regs[arg_reg_a].write(~(self.regs[arg_reg_b].get() ^ self.regs[arg_reg_c].get()))
+                write_flags(arg_reg_a, ~(b ^ c), False)
             elif arg_operation == 0b111:  # nimplies
-                self.zero, self.carry = self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() & (~self.regs[arg_reg_c].get()))
+                write_flags(arg_reg_a, b & ~c, False)
         elif opcode == 0b1111:  # rsh
-            self.regs[arg_reg_a].write(self.regs[arg_reg_b].get() >> 1 if self.regs[arg_reg_b].get() >= 0 else (self.regs[arg_reg_b].get() + 2**8) >> 1)
-        else:
-            self.pc += 1
-            return f"unknown opcode {bin(opcode)} at address {hex(self.pc)}"
+            write(arg_reg_a, b >> 1)
 
-        self.pc += 1
+        self.pc = next_pc
         return None
 
-class Register:
-    def __init__(self) -> None:
-        self.value = 0
+    def execute_nop(self, a: int, b: int, c: int) -> str | None:
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_hlt(self, a: int, b: int, c: int) -> str | None:
+        return "halted"
+
+    def execute_jmp(self, address: int, b: int, c: int) -> str | None:
+        self.pc = address
+
+    def execute_brh_eq(self, condition: int, address: int, c: int) -> str | None:
+        self.pc = address if self.zero else (self.pc + 1) & 0x3ff
+
+    def execute_brh_ne(self, condition: int, address: int, c: int) -> str | None:
+        self.pc = (self.pc + 1) & 0x3ff if self.zero else address
+
+    def execute_brh_ge(self, condition: int, address: int, c: int) -> str | None:
+        self.pc = address if self.carry else (self.pc + 1) & 0x3ff
+
+    def execute_brh_lt(self, condition: int, address: int, c: int) -> str | None:
+        self.pc = (self.pc + 1) & 0x3ff if self.carry else address
 
-    def write(self, value: int) -> tuple[bool, bool]:
-        self.value = value & 0xff
-        return self.value == 0, self.value < 0
+    def execute_cal(self, address: int, b: int, c: int) -> str | None:
+        self.stack.append(self.pc)
+        self.pc = address
 
-    def get(self) -> int:
-        return self.value
+    def execute_ret(self, a: int, b: int, c: int) -> str | None:
+        if not self.stack:
+            return "return with an empty call stack"
+        self.pc = (self.stack.pop() + 1) & 0x3ff
 
-class ZeroRegister(Register):
-    def get(self) -> int:
-        return 0
+    def execute_pld(self, reg: int, port: int, c: int) -> str | None:
+        self.pc = (self.pc + 1) & 0x3ff
+        device = self.ports.ports[port]
+        if device is None:
+            return f"no device on port {port}"
+        self.regs[reg] = device.read(port)
 
-def get_line_number(debug_info: dict, pc: int) -> int:
-    for instruction in debug_info["instructions"]:
-        if instruction["address"] == pc:
-            return instruction["line"]
+    def execute_pst(self, reg: int, port: int, c: int) -> str | None:
+        self.pc = (self.pc + 1) & 0x3ff
+        device = self.ports.ports[port]
+        if device is None:
+            return f"no device on port {port}"
+        device.write(port, self.regs[reg])
 
-    return None
+    def execute_mld(self, reg_a: int, reg_b: int, offset: int) -> str | None:
+        regs = self.regs
+        regs[reg_a] = self.memory[(regs[reg_b] + offset) & 0xff]
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_mst(self, reg_a: int, reg_b: int, offset: int) -> str | None:
+        regs = self.regs
+        self.memory[(regs[reg_b] + offset) & 0xff] = regs[reg_a]
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_ldi(self, reg: int, immediate: int, c: int) -> str | None:
+        self.regs[reg] = immediate
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_adi(self, reg_a: int, immediate: int, reg_b: int) -> str | None:
+        regs = self.regs
+        value = regs[reg_b] + immediate
+        result = value & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = value > 0xff
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_add(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        value = regs[reg_b] + regs[reg_c]
+        result = value & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = value > 0xff
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_sub(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        # computed as b + ~c + 1, so carry is set when nothing was borrowed
+        regs = self.regs
+        value = regs[reg_b] - regs[reg_c]
+        result = value & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = value >= 0
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_rsh(self, reg_a: int, reg_b: int, c: int) -> str | None:
+        regs = self.regs
+        regs[reg_a] = regs[reg_b] >> 1
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_or(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = regs[reg_b] | regs[reg_c]
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_and(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = regs[reg_b] & regs[reg_c]
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_xor(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = regs[reg_b] ^ regs[reg_c]
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_implies(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = (~regs[reg_b] | regs[reg_c]) & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_nor(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = ~(regs[reg_b] | regs[reg_c]) & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_nand(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = ~(regs[reg_b] & regs[reg_c]) & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_xnor(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = ~(regs[reg_b] ^ regs[reg_c]) & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+    def execute_nimplies(self, reg_a: int, reg_b: int, reg_c: int) -> str | None:
+        regs = self.regs
+        result = regs[reg_b] & ~regs[reg_c] & 0xff
+        regs[reg_a] = result
+        self.zero = result == 0
+        self.carry = False
+        self.pc = (self.pc + 1) & 0x3ff
+
+class SourceMap:
+    def __init__(self, debug_info: DebugInfo) -> None:
+        self.debug_info = debug_info
+        self.source_path = debug_info.source_path
+        self.lines = debug_info.lines
+        self.labels = debug_info.labels
+
+        # address: line number, None for addresses without an instruction
+        self.address_lines = [None] * 2**10
+        # line number: address of the first instruction on that line (an .include or a macro call can have many),
+        # None for lines without an instruction
+        self.line_addresses = [None] * (len(self.lines) + 1)
+
+        for address, line_number in debug_info.instructions:
+            self.address_lines[address] = line_number
+            if line_number <= len(self.lines) and self.line_addresses[line_number] is None:
+                self.line_addresses[line_number] = address
+
+        # line number: line number of the first instruction at or after that line
+        self.next_instruction_lines = [None] * (len(self.lines) + 2)
+        for line_number in range(len(self.lines), 0, -1):
+            if self.line_addresses[line_number] is not None:
+                self.next_instruction_lines[line_number] = line_number
+            else:
+                self.next_instruction_lines[line_number] = self.next_instruction_lines[line_number + 1]
+
+    def get_line_number(self, pc: int) -> int | None:
+        return self.address_lines[pc]
+
+    def get_breakpoint_location(self, line_number: int) -> tuple[int, int] | None:
+        # returns the (line, address) of the first instruction at or after line_number
+        line_number = self.next_instruction_lines[line_number]
+        if line_number is None:
+            return None
+
+        return line_number, self.line_addresses[line_number]
+
+def load_source_map(path: str) -> SourceMap:
+    # without debug information, the source view shows the disassembly of the program
+    if os.path.exists(f"{path}.dbg"):
+        return SourceMap(load_debug_info(f"{path}.dbg"))
+
+    from bdis import disassemble_debug_info
+
+    with open(path, "rb") as f:
+        return SourceMap(disassemble_debug_info(f.read(), path))
+
+# amount of cycles the debugger can step back by default, every journal entry takes 8 bytes
+DEFAULT_JOURNAL_SIZE = 2**20
+
+# cycles a debug server runs the program for before it answers the requests of its clients
+RUN_BATCH_CYCLES = 10_000
+
+# the screen is redrawn at most this many times per second
+MAX_FPS = 30
+
+def debug_loop(stdscr, client, source_map: SourceMap, path: str) -> None:
+    # a client of a debug server, the program runs on the server and every frame shows the state it reports.
+    # the debug info (or disassembly) of path is reloaded whenever the server reloads the program
+    import curses
+
+    from bserver import DebugServerError
 
-def debug_loop(stdscr, machine_code: bytes, debug_info: dict) -> None:
     curses.curs_set(0)
     curses.start_color()
     curses.use_default_colors()
 
     curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
     curses.init_pair(2, curses.COLOR_BLUE, curses.COLOR_BLACK)
-
-    stdscr.clear()
-    stdscr.nodelay(1)
+    curses.init_pair(3, curses.COLOR_RED, curses.COLOR_BLACK)
 
     REGISTERS_WINDOW_WIDTH = 53
 
-    emulator = Emulator(machine_code)
+    state = client.request("state")
+    rom_version = state["rom_version"]
 
     scroll = 0
+    cursor = 1
     message = None
 
-    while True:
-        stdscr.erase()
+    # address the program runs to, when it's running
+    run_to = None
+
+    # the windows are created on the first frame and whenever the terminal is resized
+    size = None
+    # what every pane currently displays, so only the parts that changed are redrawn
+    shown = {}
 
+    def draw_source_line(line_number: int, highlighted: int | None) -> None:
+        y = line_number - scroll
+        if y < 1 or y > height - 3:
+            return
+
+        line = ""
+        if line_number - 1 < len(source_map.lines):
+            line = source_map.lines[line_number - 1]
+
+        color = curses.color_pair(2)
+        if highlighted == line_number:
+            color = curses.color_pair(1)
+
+        source_win.move(y, 0)
+        source_win.clrtoeol()
+        source_win.addstr(y, 1, f" {str(line_number).rjust(4)} ", color)
+        if line_number in breakpoints:
+            source_win.addstr(y, 1, "*", curses.color_pair(3))
+
+        if len(line) > source_win.getmaxyx()[1] - 9:
+            line = line[:source_win.getmaxyx()[1] - 13] + "..."
+        source_win.addstr(y, 7, f" {'>' if line_number == cursor else '|'} {line}")
+
+    while True:
         height, width = stdscr.getmaxyx()
 
-        source_win = stdscr.derwin(height - 2, width - 1 - REGISTERS_WINDOW_WIDTH, 0, 0)
+        running = state["running"]
+        memory = bytes.fromhex(state["memory"])
+        # line: address, of the breakpoints every client set
+        breakpoints = {}
+        for address in state["breakpoints"]:
+            line_number = source_map.get_line_number(address)
+            if line_number is not None:
+                breakpoints[line_number] = address
 
-        source_win.addstr(0, 1, f"  source ({debug_info['source_path']})".ljust(source_win.getmaxyx()[1] - 1), curses.color_pair(1))
-        for y in range(height - 3):
-            line_number = y + scroll + 1
+        if (height, width) != size:
+            size = (height, width)
+            shown = {}
 
-            line = ""
-            if line_number - 1 < len(debug_info["source"].split("\n")):
-                line = debug_info["source"].split("\n")[line_number - 1]
+            stdscr.erase()
+            stdscr.noutrefresh()
 
-            color = curses.color_pair(2)
-            if get_line_number(debug_info, emulator.pc) == line_number:
-                color = curses.color_pair(1)
+            source_win = stdscr.derwin(height - 2, width - 1 - REGISTERS_WINDOW_WIDTH, 0, 0)
+            source_win.addstr(0, 1, f"  source ({source_map.source_path})".ljust(source_win.getmaxyx()[1] - 1), curses.color_pair(1))
 
-            source_win.addstr(y + 1, 1, f" {str(line_number).rjust(4)} ", color)
+            message_win = stdscr.derwin(2, width - 1 - REGISTERS_WINDOW_WIDTH, height - 2, 0)
+            message_win.addstr(0, 1, "  message".ljust(message_win.getmaxyx()[1] - 1), curses.color_pair(1))
 
-            if len(line) > source_win.getmaxyx()[1] - 9:
-                line = line[:source_win.getmaxyx()[1] - 13] + "..."
-            source_win.addstr(y + 1, 7, f" | {line}")
+            memory_win = stdscr.derwin(height - 6, REGISTERS_WINDOW_WIDTH, 6, width - 1 - REGISTERS_WINDOW_WIDTH)
+            memory_win.addstr(0, 1, "  memory".ljust(memory_win.getmaxyx()[1] - 1), curses.color_pair(1))
+            for i in range(0x10):
+                memory_win.addstr(1, 4 + i * 3, f" {i:02X}", curses.color_pair(2))
+            for y in range(min(height - 8, 0x10)):
+                memory_win.addstr(y + 2, 1, f" {y * 16:02X}", curses.color_pair(2))
 
-        source_win.refresh()
+            registers_win = stdscr.derwin(6, REGISTERS_WINDOW_WIDTH, 0, width - 1 - REGISTERS_WINDOW_WIDTH)
+            registers_win.addstr(0, 1, "  registers & flags".ljust(registers_win.getmaxyx()[1] - 1), curses.color_pair(1))
 
-        message_win = stdscr.derwin(2, width - 1 - REGISTERS_WINDOW_WIDTH, height - 2, 0)
+        # keep the cursor on screen
+        if cursor - scroll > height - 3:
+            scroll = cursor - (height - 3)
+        elif cursor < scroll + 1:
+            scroll = cursor - 1
 
-        message_win.addstr(0, 1, "  message".ljust(message_win.getmaxyx()[1] - 1), curses.color_pair(1))
-        if message:
-            display_message = f"  {message}"
-            if len(display_message) >= message_win.getmaxyx()[1]:
-                display_message = display_message[:message_win.getmaxyx()[1] - 4] + "..."
+        highlighted = source_map.get_line_number(state["pc"])
+        view = (scroll, frozenset(breakpoints))
+        if shown.get("view") != view:
+            for line_number in range(scroll + 1, scroll + height - 2):
+                draw_source_line(line_number, highlighted)
+        else:
+            # only the lines whose cursor or pc marker moved
+            for line_number in {shown["cursor"], cursor, shown["highlighted"], highlighted}:
+                if line_number is not None:
+                    draw_source_line(line_number, highlighted)
+        if shown.get("view") != view or shown["cursor"] != cursor or shown["highlighted"] != highlighted:
+            shown["view"] = view
+            shown["cursor"] = cursor
+            shown["highlighted"] = highlighted
+            source_win.noutrefresh()
 
+        if running:
+            display_message = f"  running... (c to pause)"
+        else:
+            display_message = f"  {message}" if message else ""
+            # instructions of included files and macros are shown on the line that includes or calls them
+            origin = source_map.debug_info.get_origin_line(state["pc"])
+            if not message and origin is not None:
+                display_message = f"  at {origin[0]}:{origin[1]}: {origin[2].strip()}"
+        if len(display_message) >= message_win.getmaxyx()[1]:
+            display_message = display_message[:message_win.getmaxyx()[1] - 4] + "..."
+        if shown.get("message") != display_message:
+            shown["message"] = display_message
+            message_win.move(1, 0)
+            message_win.clrtoeol()
             message_win.addstr(1, 0, display_message)
+            message_win.noutrefresh()
 
-        message_win.refresh()
+        shown_memory = shown.get("memory")
+        if shown_memory != memory:
+            # only the cells that changed
+            for y in range(min(height - 8, 0x10)):
+                for x in range(0x10):
+                    value = memory[y * 0x10 + x]
+                    if shown_memory is None or shown_memory[y * 0x10 + x] != value:
+                        memory_win.addstr(y + 2, 4 + x * 3, f" {value:02X}")
+            shown["memory"] = memory
+            memory_win.noutrefresh()
 
-        memory_win = stdscr.derwin(height - 6, REGISTERS_WINDOW_WIDTH, 6, width - 1 - REGISTERS_WINDOW_WIDTH)
+        registers = (tuple(state["registers"]), state["zero"], state["carry"], state["pc"], state["cycles"])
+        if shown.get("registers") != registers:
+            shown["registers"] = registers
+            for i in range(2):
+                offset = 1
+                for j in range(4):
+                    index = i * 4 + j
+                    value = state["registers"][index]
 
-        memory_win.addstr(0, 1, "  memory".ljust(memory_win.getmaxyx()[1] - 1), curses.color_pair(1))
-        for i in range(0x10):
-            memory_win.addstr(1, 4 + i * 3, f" {i:02X}", curses.color_pair(2))
-        for y in range(min(height - 8, 0x10)):
-            memory_win.addstr(y + 2, 1, f" {y * 16:02X}", curses.color_pair(2))
+                    registers_win.addstr(i + 1, offset, f" r{index}", curses.color_pair(2))
+                    registers_win.addstr(i + 1, offset + 3, f": {str(value).rjust(4)}")
 
-            for x in range(0x10):
-                value = emulator.memory[y * 0x10 + x]
-                memory_win.addstr(y + 2, 4 + x * 3, f" {value:02X}")
+                    offset += 13
+            registers_win.addstr(4, 1, f" zero", curses.color_pair(2))
+            registers_win.addstr(4, 6, f":  {int(state['zero'])}")
+            registers_win.addstr(4, 14, f" carry", curses.color_pair(2))
+            registers_win.addstr(4, 20, f": {int(state['carry'])}")
+            registers_win.addstr(4, 27, f" pc", curses.color_pair(2))
+            registers_win.addstr(4, 30, f":  {state['pc']:03X}")
+            registers_win.addstr(5, 1, f" cycles", curses.color_pair(2))
+            registers_win.addstr(5, 8, f": {state['cycles']}")
+            registers_win.clrtoeol()
+            registers_win.noutrefresh()
 
-        memory_win.refresh()
+        curses.doupdate()
 
-        registers_win = stdscr.derwin(height - 2, REGISTERS_WINDOW_WIDTH, 0, width - 1 - REGISTERS_WINDOW_WIDTH)
+        # the screen is redrawn at most MAX_FPS times per second, also while idle since other clients can change
+        # the state
+        stdscr.timeout(1000 // MAX_FPS)
 
-        registers_win.addstr(0, 1, "  registers & flags".ljust(registers_win.getmaxyx()[1] - 1), curses.color_pair(1))
-        for i in range(2):
-            offset = 1
-            for j in range(4):
-                index = i * 4 + j
-                value = emulator.regs[index].get()
+        key = stdscr.getch()
+        try:
+            if key == curses.KEY_DOWN and cursor < len(source_map.lines):
+                cursor += 1
+            elif key == curses.KEY_UP and cursor > 1:
+                cursor -= 1
+            elif key == ord("c"):
+                run_to = None
+                if running:
+                    client.request("pause")
+                    running = False
+                else:
+                    client.request("continue")
+                    running = True
+                    message = None
+            elif key == ord("g") and not running:
+                location = source_map.get_breakpoint_location(cursor)
+                if location is not None:
+                    run_to = location[1]
+                    client.request("continue", to=run_to)
+                    running = True
+                    message = None
+            elif key == ord("b"):
+                location = source_map.get_breakpoint_location(cursor)
+                if location is not None:
+                    line_number, address = location
+                    if line_number in breakpoints:
+                        client.request("clear_breakpoint", address=address)
+                    else:
+                        client.request("set_breakpoint", address=address)
+            elif key == ord("s") and not running:
+                response = client.request("step")
+                message = response["message"]
 
-                registers_win.addstr(i + 1, offset, f" r{index}", curses.color_pair(2))
-                registers_win.addstr(i + 1, offset + 3, f": {str(value).rjust(4)}")
+                line_number = source_map.get_line_number(response["pc"])
+                if line_number is not None:
+                    cursor = line_number
+            elif key == ord("S") and not running:
+                response = client.request("step_back")
+                message = None
+                if not response["stepped"]:
+                    message = "nothing to step back to" if response["journal"] else "reverse stepping is disabled"
 
-                offset += 13
-        registers_win.addstr(4, 1, f" zero", curses.color_pair(2))
-        registers_win.addstr(4, 6, f":  {int(emulator.zero)}")
-        registers_win.addstr(4, 14, f" carry", curses.color_pair(2))
-        registers_win.addstr(4, 20, f": {int(emulator.carry)}")
-        registers_win.addstr(4, 27, f" pc", curses.color_pair(2))
-        registers_win.addstr(4, 30, f":  {emulator.pc:03X}")
+                line_number = source_map.get_line_number(response["pc"])
+                if line_number is not None:
+                    cursor = line_number
+            elif key == ord("C") and not running:
+                response = client.request("run_back")
+                message = None
+                if response["found"]:
+                    message = f"breakpoint at line {source_map.get_line_number(response['pc'])}"
+                else:
+                    message = "reached the start of the journal" if response["journal"] else "reverse stepping is disabled"
 
-        registers_win.refresh()
+                line_number = source_map.get_line_number(response["pc"])
+                if line_number is not None:
+                    cursor = line_number
+            elif key == ord("q"):
+                break
+            elif key == ord("r"):
+                client.request("reset")
+                message = None
+                run_to = None
+                running = False
+                cursor = 1
+            elif key == ord("k") and not running:
+                client.request("save_checkpoint")
+                message = f"saved a checkpoint at cycle {state['cycles']}"
+            elif key == ord("R") and not running:
+                # the latest checkpoint instead of running from the start again
+                response = client.request("restore_checkpoint")
+                message = f"resumed from the checkpoint at cycle {response['cycles']}"
+                run_to = None
 
-        stdscr.refresh()
+                line_number = source_map.get_line_number(response["pc"])
+                if line_number is not None:
+                    cursor = line_number
+        except DebugServerError as e:
+            # another client changed the state in the meantime
+            message = str(e)
 
-        key = stdscr.getch()
-        if key == curses.KEY_DOWN and scroll < debug_info["source"].count("\n"):
-            scroll += 1
-        elif key == curses.KEY_UP and scroll > 0:
-            scroll -= 1
-        elif key == ord("s"):
-            message = emulator.step()
-
-            if get_line_number(debug_info, emulator.pc) - scroll > height - 3 or get_line_number(debug_info, emulator.pc) < scroll + 1:
-                scroll = get_line_number(debug_info, emulator.pc) - 1
-        elif key == ord("q"):
-            break
-        elif key == ord("r"):
-            emulator = Emulator(machine_code)
-            message = None
-            scroll = 0
+        state = client.request("state")
+        if running and not state["running"]:
+            # the program stopped on its own
+            message = state["message"]
+            if message is None and state["pc"] != run_to:
+                message = f"breakpoint at line {source_map.get_line_number(state['pc'])}"
+
+            line_number = source_map.get_line_number(state["pc"])
+            if line_number is not None:
+                cursor = line_number
+
+        if state["rom_version"] != rom_version:
+            rom_version = state["rom_version"]
+            source_map = load_source_map(path)
+            cursor = min(cursor, max(len(source_map.lines), 1))
+            message = "reloaded the program" if state["kept_state"] else "reloaded the program, it was restarted"
+            # redraw everything
+            size = None
 
 if __name__ == "__main__":
+    run = False
+    max_cycles = None
+    trace_path = None
+    input_path = None
+    use_async = False
+    seed = None
+    journal_size = DEFAULT_JOURNAL_SIZE
+    address = None
+    checkpoint_dir = None
+    checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+    resume_path = None
     while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
         if sys.argv[1] in ["-h", "--help"]:
             print_help(error=False)
+        elif sys.argv[1] == "--run":
+            run = True
+        elif sys.argv[1] == "--max-cycles" and len(sys.argv) > 2:
+            max_cycles = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--trace" and len(sys.argv) > 2:
+            trace_path = sys.argv.pop(2)
+        elif sys.argv[1] == "--input" and len(sys.argv) > 2:
+            input_path = sys.argv.pop(2)
+        elif sys.argv[1] == "--async":
+            use_async = True
+        elif sys.argv[1] == "--seed" and len(sys.argv) > 2:
+            seed = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--journal-size" and len(sys.argv) > 2:
+            journal_size = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--connect" and len(sys.argv) > 2:
+            address = sys.argv.pop(2)
+        elif sys.argv[1] == "--checkpoint-dir" and len(sys.argv) > 2:
+            checkpoint_dir = sys.argv.pop(2)
+        elif sys.argv[1] == "--checkpoint-interval" and len(sys.argv) > 2:
+            if not sys.argv[2].isdecimal() or int(sys.argv[2]) == 0:
+                print(f"checkpoint interval must be a positive integer, not {sys.argv[2]!r}")
+                print_help(error=True)
+            checkpoint_interval = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--resume" and len(sys.argv) > 2:
+            resume_path = sys.argv.pop(2)
         else:
             print(f"unknown flag {sys.argv[1]!r}")
             print_help(error=True)
@@ -256,4 +1494,7 @@ if __name__ == "__main__":
     if len(sys.argv) < 2:
         print_help(error=True)
 
-    debug_program(sys.argv[1])
+    if run:
+        run_program(sys.argv[1], max_cycles, trace_path, input_path, use_async, seed, checkpoint_dir, checkpoint_interval, resume_path)
+    else:
+        debug_program(sys.argv[1], journal_size, address, seed, checkpoint_dir, checkpoint_interval, resume_path)
@@ -0,0 +1,191 @@
+import sys
+
+from basm import CONDITIONS, INSTRUCTIONS, OPERAND_TYPES, OPERATIONS, PSEUDO_INSTRUCTIONS
+from bdbg import BIT_OPERATION, DECODE_TABLE
+from debuginfo import DebugInfo
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <program.bin> [output.basm]")
+    print("the disassembly is printed when no output path is given")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  -a, --addresses: annotate every instruction with its address and instruction word")
+    print("  -t, --trim: leave out the nops (zero words) at the end of the program, for full rom dumps")
+
+    exit(1 if error else 0)
+
+CONDITION_NAMES = {value: name for name, value in CONDITIONS.items()}
+OPERATION_NAMES = {value: name for name, value in OPERATIONS.items()}
+
+# operation returned by decode(): instruction, bit instructions are decoded to BIT_OPERATION + their operation
+INSTRUCTION_NAMES = {opcode: mnemonic for mnemonic, (opcode, _) in INSTRUCTIONS.items() if mnemonic != "bit"}
+
+def format_operand(type: str, value: int) -> str | int:
+    # addresses stay integers, they're replaced by labels once the targets are known
+    if type == "reg":
+        return f"r{value}"
+    elif type == "condition":
+        return CONDITION_NAMES[value]
+    elif type == "operation":
+        return OPERATION_NAMES[value]
+    elif type == "address":
+        return value
+    return str(value)
+
+def build_pseudo_patterns() -> dict[str, list[tuple[str, tuple, tuple, tuple[str, ...]]]]:
+    # instruction: (pseudo-instruction, operand sources, literal value per operand or None, types of the args)
+    # per pseudo-instruction expanding to it, the ones that fix the most operands come first so "not" wins
+    # over "nor"
+    patterns = {}
+    for mnemonic, (instruction, amount, sources) in PSEUDO_INSTRUCTIONS.items():
+        operands = INSTRUCTIONS[instruction][1]
+
+        literals = []
+        types = [None] * amount
+        for (type, _), source in zip(operands, sources):
+            if isinstance(source, str):
+                literals.append(OPERAND_TYPES[type](source, {}))
+            else:
+                literals.append(None)
+                types[source] = type
+
+        # literal operands and operands that repeat an arg
+        fixed = len(operands) - amount
+        patterns.setdefault(instruction, []).append((fixed, mnemonic, sources, tuple(literals), tuple(types)))
+
+    return {
+        instruction: [pattern[1:] for pattern in sorted(entries, key=lambda pattern: -pattern[0])]
+        for instruction, entries in patterns.items()
+    }
+
+PSEUDO_PATTERNS = build_pseudo_patterns()
+
+def disassemble_operation(operation: int, a: int, b: int, c: int) -> tuple[str, tuple[str | int, ...]]:
+    # returns the mnemonic and the operands of a decoded instruction
+    if operation >= BIT_OPERATION:
+        instruction = "bit"
+        values = [a, b, operation - BIT_OPERATION, c]
+    else:
+        instruction = INSTRUCTION_NAMES[operation]
+        values = [a, b, c][:len(INSTRUCTIONS[instruction][1])]
+
+    for mnemonic, sources, literals, types in PSEUDO_PATTERNS.get(instruction, []):
+        args = [None] * len(types)
+        for value, source, literal in zip(values, sources, literals):
+            if literal is not None:
+                if value != literal:
+                    break
+            elif args[source] is None:
+                args[source] = value
+            elif args[source] != value:
+                break
+        else:
+            return mnemonic, tuple(format_operand(type, value) for type, value in zip(types, args))
+
+    operands = INSTRUCTIONS[instruction][1]
+    return instruction, tuple(format_operand(type, value) for (type, _), value in zip(operands, values))
+
+def build_disassembly_table() -> list[tuple[str, tuple[str | int, ...], bool]]:
+    # (mnemonic, operands, whether assembling them gives back the same word) of every instruction word. words that
+    # only differ in bits the instruction doesn't use (the cpu ignores those) decode the same, only the first one
+    # of them, without any of those bits set, can be assembled
+    table = []
+    disassembled = {}
+    for decoded in DECODE_TABLE:
+        if decoded in disassembled:
+            table.append((*disassembled[decoded], False))
+        else:
+            disassembled[decoded] = disassemble_operation(*decoded)
+            table.append((*disassembled[decoded], True))
+
+    return table
+
+# disassembling is a lookup
+DISASSEMBLY_TABLE = build_disassembly_table()
+
+def disassemble_lines(machine_code: bytes, annotate: bool = False, trim: bool = False) -> tuple[list[str], list[tuple[int, int]], dict[str, tuple[int, int]]]:
+    # returns the lines, (address, line) per instruction and name: (address, line) per label
+    machine_code = machine_code[:2 * 2**10]
+    if len(machine_code) % 2:
+        machine_code += b"\x00"
+
+    words = [int.from_bytes(machine_code[address:address + 2], "big") for address in range(0, len(machine_code), 2)]
+    if trim:
+        while words and words[-1] == 0:
+            words.pop()
+
+    entries = [DISASSEMBLY_TABLE[word] for word in words]
+
+    # synthesized labels for the jump, branch and call targets inside the program, call targets are functions
+    calls = set()
+    targets = set()
+    for mnemonic, operands, _ in entries:
+        for operand in operands:
+            if isinstance(operand, int) and operand < len(words):
+                targets.add(operand)
+                if mnemonic == "cal":
+                    calls.add(operand)
+    labels = {target: f"{'function' if target in calls else 'label'}_{target:03x}" for target in targets}
+
+    lines = []
+    instructions = []
+    label_lines = {}
+    for address, (word, (mnemonic, operands, exact)) in enumerate(zip(words, entries)):
+        if address in labels:
+            lines.append(f"{labels[address]}:")
+            label_lines[labels[address]] = (address, len(lines))
+
+        line = f"    {mnemonic}"
+        if operands:
+            line += " " + ", ".join(labels.get(operand, str(operand)) if isinstance(operand, int) else operand for operand in operands)
+
+        comments = []
+        if annotate:
+            comments.append(f"{address:#05x}: {word:#06x}")
+        if not exact:
+            comments.append(f"{word:#06x} has unused bits set")
+        if comments:
+            line = f"{line:<32}# {', '.join(comments)}"
+
+        lines.append(line)
+        instructions.append((address, len(lines)))
+
+    return lines, instructions, label_lines
+
+def disassemble(machine_code: bytes, annotate: bool = False, trim: bool = False) -> str:
+    lines, _, _ = disassemble_lines(machine_code, annotate, trim)
+    return "\n".join(lines) + "\n"
+
+def disassemble_debug_info(machine_code: bytes, path: str) -> DebugInfo:
+    # debug info for a program that has none, with the disassembly as its source
+    lines, instructions, labels = disassemble_lines(machine_code)
+    return DebugInfo(f"{path} (disassembly)", lines, instructions, labels)
+
+if __name__ == "__main__":
+    annotate = False
+    trim = False
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] in ["-a", "--addresses"]:
+            annotate = True
+        elif sys.argv[1] in ["-t", "--trim"]:
+            trim = True
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 2:
+        print_help(error=True)
+
+    with open(sys.argv[1], "rb") as f:
+        machine_code = f.read()
+
+    source = disassemble(machine_code, annotate, trim)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
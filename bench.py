@@ -0,0 +1,375 @@
+import json
+import os
+import random
+import sys
+import time
+
+from basm import CONDITIONS, INSTRUCTIONS, OPERATIONS, OPCODE_TABLE, PSEUDO_INSTRUCTIONS, assemble_source
+from bdbg import HOOK_EVENTS, Emulator
+from bprof import Profile
+from btrace import TraceWriter
+
+# the batch emulator needs numpy, it's only checked when numpy is installed
+try:
+    from bbatch import BatchEmulator
+except ImportError:
+    BatchEmulator = None
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags]")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  -n, --files <count>: amount of programs to assemble (default: 200)")
+    print("  -s, --seed <seed>: seed for the program generator (default: 0)")
+    print("  -l, --loops <count>: amount of outer loop iterations of the emulator benchmark (default: 255)")
+    print("  -k, --kernels <count>: amount of random loop kernels to emulate (default: 10)")
+    print("  -r, --repeat <count>: run every benchmark this many times and report the fastest run (default: 3)")
+    print("  --save-baseline <path>: save the results as a baseline")
+    print("  --baseline <path>: compare the results against a saved baseline, fails if any of them got slower by more than the tolerance")
+    print(f"  --tolerance <percent>: how much slower than the baseline a result may be (default: {DEFAULT_TOLERANCE})")
+    print("  -c, --check <cycles>: instead of benchmarking, run the generated programs and kernels for this many cycles on every engine and compare them against the reference, and the programs assembled with -O against the unoptimized ones")
+
+    exit(1 if error else 0)
+
+# percentage a result may fall below its baseline before it counts as a regression
+DEFAULT_TOLERANCE = 10
+
+# instructions of the loop kernel bodies, no control flow or port io so every kernel terminates
+KERNEL_MNEMONICS = [mnemonic for mnemonic in OPCODE_TABLE if mnemonic not in ["hlt", "jmp", "brh", "cal", "ret", "pld", "pst"]]
+# kernel bodies only use r0-r5, r6 and r7 are the loop counters
+KERNEL_REGISTERS = 6
+
+def generate_operand(rng: random.Random, type: str, labels: list[str], registers: int = 8) -> str:
+    if type == "reg":
+        return f"r{rng.randrange(registers)}"
+    elif type in ["immediate", "port"]:
+        return str(rng.randrange(-128, 256))
+    elif type == "offset":
+        return str(rng.randrange(-32, 32))
+    elif type == "address":
+        return rng.choice(labels)
+    elif type == "condition":
+        return rng.choice(list(CONDITIONS))
+    elif type == "operation":
+        return rng.choice(list(OPERATIONS))
+
+def get_operand_types(mnemonic: str) -> list[str]:
+    if mnemonic in INSTRUCTIONS:
+        return [type for type, _ in INSTRUCTIONS[mnemonic][1]]
+
+    # pseudo-instructions take their operand types from the instruction they expand to
+    instruction, amount, sources = PSEUDO_INSTRUCTIONS[mnemonic]
+    types = [None] * amount
+    for (type, _), source in zip(INSTRUCTIONS[instruction][1], sources):
+        if not isinstance(source, str):
+            types[source] = type
+
+    return types
+
+def generate_program(rng: random.Random, size: int = 2**10) -> str:
+    labels = [f"label_{i}" for i in range(size // 16)]
+    label_addresses = sorted(rng.sample(range(size), len(labels)))
+
+    lines = []
+    for address in range(size):
+        if label_addresses and label_addresses[0] == address:
+            label_addresses.pop(0)
+            lines.append(f"{labels[len(labels) - len(label_addresses) - 1]}:")
+
+        mnemonic = rng.choice(list(OPCODE_TABLE))
+        args = ", ".join(generate_operand(rng, type, labels) for type in get_operand_types(mnemonic))
+        lines.append(f"    {mnemonic} {args}  # instruction {address}")
+
+    return "\n".join(lines) + "\n"
+
+def generate_kernel_body(rng: random.Random, size: int, prefix: str) -> list[str]:
+    # random straight-line code, with forward branches over parts of it so both directions of every condition
+    # get taken
+    lines = []
+    skips = []
+    for index in range(size):
+        while skips and skips[0][0] == index:
+            lines.append(f"{skips.pop(0)[1]}:")
+
+        if rng.random() < 0.1:
+            label = f"{prefix}_skip_{index}"
+            skips.append((rng.randrange(index + 1, size + 1), label))
+            skips.sort()
+            lines.append(f"    brh {rng.choice(list(CONDITIONS))}, {label}")
+
+        mnemonic = rng.choice(KERNEL_MNEMONICS)
+        args = ", ".join(generate_operand(rng, type, [], KERNEL_REGISTERS) for type in get_operand_types(mnemonic))
+        lines.append(f"    {mnemonic} {args}")
+
+    lines += [f"{label}:" for _, label in skips]
+    return lines
+
+def generate_kernel(rng: random.Random, body_size: int = 24, outer: int = 64, inner: int = 255) -> str:
+    # a terminating, long running program: a random body (and a call to a random subroutine) in two nested
+    # counted loops, roughly outer * inner * body_size cycles
+    lines = [
+        f"    ldi r6, {outer}",
+        "outer:",
+        f"    ldi r7, {inner}",
+        "inner:",
+        *generate_kernel_body(rng, body_size, "body"),
+        "    cal subroutine",
+        "    dec r7",
+        "    brh ne, inner",
+        "    dec r6",
+        "    brh ne, outer",
+        "    hlt",
+        "subroutine:",
+        *generate_kernel_body(rng, body_size // 4, "subroutine"),
+        "    ret",
+    ]
+
+    return "\n".join(lines) + "\n"
+
+def benchmark_assembler(files: int, seed: int, repeat: int) -> dict[str, float]:
+    rng = random.Random(seed)
+    sources = [generate_program(rng) for _ in range(files)]
+
+    # the fastest of the repeats, the others are slowed down by noise
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for source in sources:
+            machine_code, _ = assemble_source(source)
+            assert len(machine_code) == 2 * 2**10
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    print(f"assembled {files} programs of {2**10} words in {elapsed:.3f}s")
+    print(f"  {elapsed / files * 1000:.3f}ms per file, {files / elapsed:.1f} files/sec")
+
+    return {"assembler files/sec": files / elapsed}
+
+def generate_loop_program(loops: int) -> str:
+    # examples/loop.basm (255 * 10), repeated loops times
+    return f"""
+ldi r4, {loops}
+outer:
+    ldi r1, 255
+    ldi r2, 10
+
+    ldi r3, 0
+    loop_start:
+        cmp r1, r0
+        brh eq, loop_end
+        dec r1
+
+        add r3, r3, r2
+
+        jmp loop_start
+
+    loop_end:
+    dec r4
+    brh ne, outer
+
+hlt
+"""
+
+def benchmark_emulator(name: str, programs: list[bytes], repeat: int) -> dict[str, float]:
+    results = {}
+    for jit in [False, True]:
+        engine = "basic block compiler" if jit else "interpreter"
+
+        elapsed = float("inf")
+        for _ in range(repeat):
+            cycles = 0
+            start = time.perf_counter()
+            for machine_code in programs:
+                emulator = Emulator(machine_code, jit=jit)
+                message = emulator.run(2**32)
+                assert message == "halted"
+                cycles += emulator.cycles
+            elapsed = min(elapsed, time.perf_counter() - start)
+
+        print(f"emulated {cycles} cycles of {name} in {elapsed:.3f}s ({engine})")
+        print(f"  {cycles / elapsed:,.0f} cycles/sec")
+        results[f"{name} {engine} cycles/sec"] = cycles / elapsed
+
+    return results
+
+def compare_baseline(results: dict[str, float], baseline: dict[str, float], tolerance: float) -> bool:
+    # returns whether every result is within the tolerance of its baseline
+    print()
+    print("compared to the baseline:")
+    regressions = 0
+    for name, value in results.items():
+        if name not in baseline:
+            print(f"  {name}: {value:,.1f} (not in the baseline)")
+            continue
+
+        change = (value - baseline[name]) / baseline[name] * 100
+        regression = change < -tolerance
+        regressions += regression
+        print(f"  {name}: {value:,.1f} (baseline {baseline[name]:,.1f}, {change:+.1f}%){' REGRESSION' if regression else ''}")
+
+    return regressions == 0
+
+def create_hooked(machine_code: bytes) -> Emulator:
+    # every hook event and a watchpoint on all of memory, so every address runs instrumented
+    emulator = Emulator(machine_code)
+    for event in HOOK_EVENTS:
+        emulator.add_hook(event, lambda *_: None)
+    emulator.add_watchpoint(0, 256, lambda *_: None)
+    return emulator
+
+def create_profiled(machine_code: bytes) -> Emulator:
+    emulator = Emulator(machine_code)
+    emulator.profile = Profile()
+    return emulator
+
+def create_traced(machine_code: bytes) -> Emulator:
+    emulator = Emulator(machine_code)
+    emulator.trace = TraceWriter(os.devnull, emulator.cycles, emulator.regs)
+    return emulator
+
+# name: function creating an emulator that runs the program on that engine
+ENGINES = {
+    "interpreter": lambda machine_code: Emulator(machine_code, jit=False),
+    "basic block compiler": lambda machine_code: Emulator(machine_code),
+    "journal": lambda machine_code: Emulator(machine_code, journal_size=2**10),
+    "trace": create_traced,
+    "profiler": create_profiled,
+    "hooks": create_hooked,
+}
+
+def check_program(machine_code: bytes, cycles: int, regs: bytes, memory: bytes) -> list[str]:
+    # runs the program from the given registers and memory on every engine, returns the engines whose message or
+    # final state differs from the reference
+    reference = Emulator(machine_code, jit=False)
+    reference.regs[:8] = regs
+    reference.memory[:] = memory
+    expected = (reference.run_reference(cycles), reference.get_state())
+
+    mismatches = []
+    for name, create in ENGINES.items():
+        emulator = create(machine_code)
+        emulator.regs[:8] = regs
+        emulator.memory[:] = memory
+        if (emulator.run(cycles), emulator.get_state()) != expected:
+            mismatches.append(name)
+
+    if BatchEmulator is not None:
+        batch = BatchEmulator(machine_code, 1)
+        batch.regs[0, :8] = list(regs)
+        batch.memory[0] = list(memory)
+        batch.run(cycles)
+        if (batch.get_message(0), batch.get_state(0)) != expected:
+            mismatches.append("batch")
+
+    return mismatches
+
+def check_engines(programs: list[tuple[str, bytes]], cycles: int, seed: int) -> bool:
+    rng = random.Random(seed)
+    engines = [*ENGINES, *(["batch"] if BatchEmulator is not None else [])]
+    print(f"checking {', '.join(engines)} against the reference, {cycles} cycles per program")
+
+    failed = 0
+    start = time.perf_counter()
+    for name, machine_code in programs:
+        # r0 is always 0
+        regs = bytes([0, *(rng.randrange(256) for _ in range(7))])
+        memory = bytes(rng.randrange(256) for _ in range(256))
+
+        mismatches = check_program(machine_code, cycles, regs, memory)
+        if mismatches:
+            failed += 1
+            print(f"  {name}: {', '.join(mismatches)} differ from the reference")
+
+    print(f"checked {len(programs)} programs in {time.perf_counter() - start:.3f}s, {failed} mismatch(es)")
+    return failed == 0
+
+# programs the optimizer once changed the behaviour of
+OPTIMIZER_REGRESSIONS = [
+    # every adi on r0 sets the flags from its own immediate since r0 reads 0, folding them changed the zero flag
+    ("adi on r0", "    ldi r2, 1\n    adi r0, 1\n    adi r0, -1\n    brh eq, skip\n    adi r2, 1\nskip:\n    hlt\n"),
+]
+
+def check_optimizer(sources: list[tuple[str, str]], cycles: int) -> bool:
+    # runs every program assembled with and without the optimizer, the ones that stop within the cycles have to stop
+    # with the same message, registers and memory. the flags it leaves behind, the pc and the cycles may differ
+    print(f"checking the optimizer, {cycles} cycles per program")
+
+    failed = 0
+    start = time.perf_counter()
+    for name, source in sources:
+        plain = Emulator(assemble_source(source)[0])
+        optimized = Emulator(assemble_source(source, optimized=True)[0])
+
+        message = plain.run(cycles)
+        if message is None:
+            continue
+
+        if (optimized.run(cycles), optimized.regs[:8], optimized.memory) != (message, plain.regs[:8], plain.memory):
+            failed += 1
+            print(f"  {name}: differs when optimized")
+
+    print(f"checked {len(sources)} programs in {time.perf_counter() - start:.3f}s, {failed} mismatch(es)")
+    return failed == 0
+
+if __name__ == "__main__":
+    files = 200
+    seed = 0
+    loops = 255
+    kernels = 10
+    repeat = 3
+    save_baseline_path = None
+    baseline_path = None
+    tolerance = DEFAULT_TOLERANCE
+    check_cycles = None
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] in ["-n", "--files"] and len(sys.argv) > 2:
+            files = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-s", "--seed"] and len(sys.argv) > 2:
+            seed = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-l", "--loops"] and len(sys.argv) > 2:
+            loops = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-k", "--kernels"] and len(sys.argv) > 2:
+            kernels = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-r", "--repeat"] and len(sys.argv) > 2:
+            repeat = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--save-baseline" and len(sys.argv) > 2:
+            save_baseline_path = sys.argv.pop(2)
+        elif sys.argv[1] == "--baseline" and len(sys.argv) > 2:
+            baseline_path = sys.argv.pop(2)
+        elif sys.argv[1] == "--tolerance" and len(sys.argv) > 2:
+            tolerance = float(sys.argv.pop(2))
+        elif sys.argv[1] in ["-c", "--check"] and len(sys.argv) > 2:
+            check_cycles = int(sys.argv.pop(2))
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    rng = random.Random(seed)
+    kernel_programs = [assemble_source(generate_kernel(rng))[0] for _ in range(kernels)]
+
+    if check_cycles is not None:
+        sources = [(f"program {i}", generate_program(rng)) for i in range(files)]
+        programs = [(name, assemble_source(source)[0]) for name, source in sources]
+        programs += [(f"kernel {i}", machine_code) for i, machine_code in enumerate(kernel_programs)]
+        engines_matched = check_engines(programs, check_cycles, seed)
+        optimizer_matched = check_optimizer(sources + OPTIMIZER_REGRESSIONS, check_cycles)
+        exit(0 if engines_matched and optimizer_matched else 1)
+
+    results = benchmark_assembler(files, seed, repeat)
+    results |= benchmark_emulator("loop", [assemble_source(generate_loop_program(loops))[0]], repeat)
+    if kernel_programs:
+        results |= benchmark_emulator("kernels", kernel_programs, repeat)
+
+    if save_baseline_path is not None:
+        with open(save_baseline_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if baseline_path is not None:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+
+        if not compare_baseline(results, baseline, tolerance):
+            exit(1)
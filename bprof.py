@@ -0,0 +1,164 @@
+import os
+import sys
+
+from bdbg import Emulator, decode
+from debuginfo import DebugInfo, load_debug_info
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <program.bin>")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  --max-cycles <count>: stop profiling after this many cycles (default: run until the program halts)")
+    print("  -n, --top <count>: amount of loops and call targets to report (default: 10)")
+    print("  --no-listing: don't print the annotated source listing")
+
+    exit(1 if error else 0)
+
+class Profile:
+    def __init__(self) -> None:
+        # address: amount of times the instruction there was executed
+        self.executions = [0] * 2**10
+        # address: amount of times the instruction there jumped somewhere other than the next instruction
+        self.taken = [0] * 2**10
+
+        # call target: amount of calls, cycles spent inside the call (including the ret)
+        self.calls = {}
+        self.inclusive_cycles = {}
+
+        # (call target, cycle of the cal) per active call, and the amount of active calls per target so
+        # recursive calls are only counted once
+        self.call_stack = []
+        self.active_calls = {}
+
+    def enter(self, target: int, cycle: int) -> None:
+        self.calls[target] = self.calls.get(target, 0) + 1
+        self.call_stack.append((target, cycle))
+        self.active_calls[target] = self.active_calls.get(target, 0) + 1
+
+    def leave(self, cycle: int) -> None:
+        target, start = self.call_stack.pop()
+        self.active_calls[target] -= 1
+        if not self.active_calls[target]:
+            self.inclusive_cycles[target] = self.inclusive_cycles.get(target, 0) + cycle - start
+
+    def get_loops(self, rom: list[int]) -> list[tuple[int, int, int, int]]:
+        # every taken backward jump or branch closes a loop, returns (start, end, iterations, cycles) per loop
+        loops = []
+        for address, count in enumerate(self.taken):
+            if not count:
+                continue
+
+            operation, a, b, _ = decode(rom[address])
+            if operation == 0b0010:  # jmp
+                target = a
+            elif operation == 0b0011:  # brh
+                target = b
+            else:
+                continue
+
+            if target <= address:
+                loops.append((target, address, count, sum(self.executions[target:address + 1])))
+
+        return sorted(loops, key=lambda loop: loop[3], reverse=True)
+
+def get_label_names(debug_info: DebugInfo | None) -> dict[int, str]:
+    names = {}
+    if debug_info is not None:
+        for name, (address, _) in debug_info.labels.items():
+            names.setdefault(address, name)
+
+    return names
+
+def format_location(address: int, labels: dict[int, str], lines: dict[int, int]) -> str:
+    location = f"{address:#05x}"
+    if address in labels:
+        location += f" ({labels[address]})"
+    if address in lines:
+        location += f" line {lines[address]}"
+
+    return location
+
+def print_listing(profile: Profile, rom: list[int], debug_info: DebugInfo, total: int) -> None:
+    # line: addresses of the instructions assembled from that line
+    line_addresses = {}
+    for address, line in debug_info.instructions:
+        line_addresses.setdefault(line, []).append(address)
+
+    for line_number in range(1, len(debug_info.lines) + 1):
+        count = sum(profile.executions[address] for address in line_addresses.get(line_number, []))
+
+        annotation = ""
+        if count:
+            annotation = f"{count:>12} {count / total:>6.1%}"
+            for address in line_addresses[line_number]:
+                if decode(rom[address])[0] == 0b0011:
+                    taken = profile.taken[address]
+                    annotation += f"  taken {taken}, not taken {profile.executions[address] - taken}"
+
+        print(f"{annotation:<60} {line_number:>5}  {debug_info.lines[line_number - 1]}")
+
+def print_report(profile: Profile, rom: list[int], debug_info: DebugInfo | None, total: int, top: int) -> None:
+    labels = get_label_names(debug_info)
+    lines = dict(debug_info.instructions) if debug_info is not None else {}
+
+    print(f"{total} cycles")
+
+    print()
+    print("hot loops:")
+    for start, end, iterations, cycles in profile.get_loops(rom)[:top]:
+        print(f"  {cycles:>12} {cycles / total:>6.1%}  {format_location(start, labels, lines)} to {format_location(end, labels, lines)}, taken back {iterations} times")
+
+    print()
+    print("call targets:")
+    targets = sorted(profile.calls, key=lambda target: profile.inclusive_cycles.get(target, 0), reverse=True)
+    for target in targets[:top]:
+        cycles = profile.inclusive_cycles.get(target, 0)
+        print(f"  {cycles:>12} {cycles / total:>6.1%}  {format_location(target, labels, lines)}, {profile.calls[target]} calls")
+
+if __name__ == "__main__":
+    max_cycles = None
+    top = 10
+    listing = True
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] == "--max-cycles" and len(sys.argv) > 2:
+            max_cycles = int(sys.argv.pop(2))
+        elif sys.argv[1] in ["-n", "--top"] and len(sys.argv) > 2:
+            top = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--no-listing":
+            listing = False
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 2:
+        print_help(error=True)
+
+    with open(sys.argv[1], "rb") as f:
+        machine_code = f.read()
+
+    debug_info = None
+    if os.path.exists(f"{sys.argv[1]}.dbg"):
+        debug_info = load_debug_info(f"{sys.argv[1]}.dbg")
+
+    emulator = Emulator(machine_code)
+    emulator.profile = Profile()
+
+    message = None
+    while message is None and (max_cycles is None or emulator.cycles < max_cycles):
+        budget = 2**20
+        if max_cycles is not None:
+            budget = min(budget, max_cycles - emulator.cycles)
+        message = emulator.run(budget)
+
+    if message is not None:
+        print(f"stopped: {message}")
+
+    total = max(emulator.cycles, 1)
+    if listing and debug_info is not None:
+        print_listing(emulator.profile, emulator.rom, debug_info, total)
+        print()
+    print_report(emulator.profile, emulator.rom, debug_info, total, top)
@@ -0,0 +1,449 @@
+import asyncio
+import inspect
+import json
+import os
+import socket
+import sys
+import threading
+
+from bdbg import RUN_BATCH_CYCLES, Emulator, load_resume_snapshot
+from debuginfo import load_debug_info
+from ports import PortBus, create_default_bus
+from snapshot import DEFAULT_CHECKPOINT_INTERVAL, Checkpoints, restore_snapshot
+
+# protocol: one json object per line in both directions. every request has a "command" and the arguments of that
+# command, the server answers every request in order with one response, which has an "error" if the request failed.
+# memory is always sent as a whole, hex encoded
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <address> <program.bin>")
+    print("address: host:port to listen on tcp, anything else is the path of a unix socket")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  --journal-size <entries>: amount of cycles clients can step back, journaling runs the program at a fraction of the speed (default: 0, no reverse stepping)")
+    print("  --seed <seed>: seed of the random number generator port")
+    print("  --checkpoint-dir <path>: keep the checkpoints in this directory instead of in memory, so later sessions can resume from them")
+    print(f"  --checkpoint-interval <cycles>: cycles between the checkpoints saved while the program runs (default: {DEFAULT_CHECKPOINT_INTERVAL})")
+    print("  --resume <path>: start from a snapshot instead of cycle 0, a directory resumes from its latest checkpoint")
+
+    exit(1 if error else 0)
+
+# seconds between checks whether the program was rebuilt
+RELOAD_INTERVAL = 0.25
+# most cycles one step or step_back request can take, they run without giving the other clients a turn
+MAX_STEP_COUNT = RUN_BATCH_CYCLES
+
+class DebugServerError(Exception):
+    pass
+
+def get_modified(path: str) -> tuple[int, int] | None:
+    # a file that's truncated and written again can keep its modification time, but not its size
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def load_labels(path: str) -> dict[str, int] | None:
+    # label: address, from the debug info next to the program, None without debug info
+    if not os.path.exists(f"{path}.dbg"):
+        return None
+
+    return {name: address for name, (address, _) in load_debug_info(f"{path}.dbg").labels.items()}
+
+class DebugSession:
+    # the emulator and its run state, shared by every client of a server
+    def __init__(self, machine_code: bytes, journal_size: int, create_ports=None, path: str | None = None, checkpoint_dir: str | None = None, checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        self.machine_code = machine_code
+        self.journal_size = journal_size
+        # called on every reset for a fresh bus, without it the program runs without devices
+        self.create_ports = create_ports
+
+        # a checkpoint is saved whenever a run passes a multiple of the interval
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoints = Checkpoints(machine_code, checkpoint_dir)
+
+        # the program is reloaded whenever the file at path changes, see watch()
+        self.path = path
+        if path is not None:
+            self.modified = get_modified(path)
+            self.labels = load_labels(path)
+        # incremented on every reload, clients reload their debug info when it changes
+        self.rom_version = 0
+        self.kept_state = True
+
+        self.breakpoints = set()
+        # set whenever the program isn't running, wait requests block on it
+        self.stopped = asyncio.Event()
+        self.task = None
+        self.reset()
+
+    def reset(self) -> None:
+        ports = self.create_ports() if self.create_ports is not None else PortBus()
+        self.emulator = Emulator(self.machine_code, journal_size=self.journal_size, ports=ports)
+        self.message = None
+        self.running = False
+        self.run_to = None
+        self.stopped.set()
+
+    def stop(self) -> None:
+        self.running = False
+        self.emulator.ports.flush()
+        self.stopped.set()
+
+    def reload(self, machine_code: bytes) -> None:
+        # the state carries over when every label is where it was and the program has the same length,
+        # otherwise the program starts over without breakpoints
+        labels = load_labels(self.path)
+        self.kept_state = labels is not None and labels == self.labels and len(machine_code) == len(self.machine_code)
+        self.machine_code = machine_code
+        self.labels = labels
+        self.rom_version += 1
+        self.checkpoints = Checkpoints(machine_code, self.checkpoint_dir)
+
+        if self.kept_state:
+            self.emulator.load_rom(machine_code)
+        else:
+            # the breakpoints would point at other instructions now
+            self.breakpoints.clear()
+            self.reset()
+
+    def restore(self, snapshot: bytes) -> None:
+        # the devices keep their state, they aren't part of a snapshot
+        restore_snapshot(self.emulator, snapshot)
+        self.message = None
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(RELOAD_INTERVAL)
+
+            modified = get_modified(self.path)
+            if modified is None or modified == self.modified:
+                continue
+            self.modified = modified
+
+            try:
+                with open(self.path, "rb") as f:
+                    machine_code = f.read()
+                self.reload(machine_code)
+            except (OSError, ValueError) as e:
+                print(f"failed to reload {self.path}: {e}", file=sys.stderr)
+
+    async def run(self) -> None:
+        # runs batches until the program stops, giving the other clients a turn after every batch
+        while self.running:
+            addresses = self.breakpoints if self.run_to is None else self.breakpoints | {self.run_to}
+            start = self.emulator.cycles
+            budget = min(RUN_BATCH_CYCLES, self.checkpoint_interval - start % self.checkpoint_interval)
+            self.message = self.emulator.run(budget, addresses)
+            if self.emulator.cycles != start and self.emulator.cycles % self.checkpoint_interval == 0:
+                self.checkpoints.save(self.emulator)
+            if self.message is not None or self.emulator.pc in addresses:
+                self.stop()
+
+            await asyncio.sleep(0)
+
+    def get_registers(self) -> dict:
+        emulator = self.emulator
+        return {
+            "cycles": emulator.cycles,
+            "pc": emulator.pc,
+            "registers": list(emulator.regs[:8]),
+            "zero": emulator.zero,
+            "carry": emulator.carry,
+            "stack": list(emulator.stack),
+        }
+
+    def get_state(self) -> dict:
+        return {
+            **self.get_registers(),
+            "memory": self.emulator.memory.hex(),
+            "running": self.running,
+            "message": self.message,
+            "breakpoints": sorted(self.breakpoints),
+            "journal": self.emulator.journal is not None,
+            "rom_version": self.rom_version,
+            "kept_state": self.kept_state,
+        }
+
+    def check_stopped(self) -> None:
+        if self.running:
+            raise DebugServerError("the program is running")
+
+    def check_count(self, count: int) -> None:
+        if not 0 <= count <= MAX_STEP_COUNT:
+            raise DebugServerError(f"count must be between 0 and {MAX_STEP_COUNT}, use continue to run further")
+
+    async def handle(self, request: dict) -> dict:
+        if not isinstance(request, dict) or "command" not in request:
+            raise DebugServerError("request without a command")
+
+        arguments = dict(request)
+        handler = getattr(self, f"command_{arguments.pop('command')}", None)
+        if handler is None:
+            raise DebugServerError(f"unknown command {request['command']!r}")
+
+        # checked against the signature up front, a TypeError raised by the handler itself is a bug in the server
+        signature = inspect.signature(handler)
+        try:
+            bound = signature.bind(**arguments)
+        except TypeError:
+            raise DebugServerError(f"invalid arguments for {request['command']!r}") from None
+        for name, value in bound.arguments.items():
+            if not isinstance(value, signature.parameters[name].annotation):
+                raise DebugServerError(f"invalid arguments for {request['command']!r}")
+
+        response = handler(**arguments)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    def command_state(self) -> dict:
+        return self.get_state()
+
+    def command_read_registers(self) -> dict:
+        return self.get_registers()
+
+    def command_read_memory(self) -> dict:
+        return {"memory": self.emulator.memory.hex()}
+
+    def command_step(self, count: int = 1) -> dict:
+        self.check_stopped()
+        self.check_count(count)
+        self.message = None
+        for _ in range(count):
+            self.message = self.emulator.step()
+            if self.message is not None:
+                break
+
+        self.emulator.ports.flush()
+        return self.get_state()
+
+    def command_step_back(self, count: int = 1) -> dict:
+        self.check_stopped()
+        self.check_count(count)
+        self.message = None
+        stepped = 0
+        while stepped < count and self.emulator.step_back():
+            stepped += 1
+
+        return {**self.get_state(), "stepped": stepped}
+
+    def command_run_back(self) -> dict:
+        # runs backwards until a breakpoint, found is False if the journal ran out first
+        self.check_stopped()
+        self.message = None
+        found = self.emulator.run_back(self.breakpoints)
+
+        return {**self.get_state(), "found": found}
+
+    def command_continue(self, to: int | None = None) -> dict:
+        # starts running in the background until a breakpoint, the address to, or a message
+        run_to = get_address(to) if to is not None else None
+        if not self.running:
+            self.running = True
+            self.message = None
+            self.run_to = run_to
+            self.stopped.clear()
+            # a task that was paused and hasn't noticed yet just keeps running
+            if self.task is None or self.task.done():
+                self.task = asyncio.create_task(self.run())
+
+        return self.get_state()
+
+    def command_pause(self) -> dict:
+        if self.running:
+            self.stop()
+
+        return self.get_state()
+
+    async def command_wait(self) -> dict:
+        # answers once the program stops running
+        await self.stopped.wait()
+        return self.get_state()
+
+    def command_set_breakpoint(self, address: int) -> dict:
+        self.breakpoints.add(get_address(address))
+        return {"breakpoints": sorted(self.breakpoints)}
+
+    def command_clear_breakpoint(self, address: int) -> dict:
+        self.breakpoints.discard(get_address(address))
+        return {"breakpoints": sorted(self.breakpoints)}
+
+    def command_reset(self) -> dict:
+        self.reset()
+        return self.get_state()
+
+    def command_checkpoints(self) -> dict:
+        return {"checkpoints": self.checkpoints.get_cycles()}
+
+    def command_save_checkpoint(self) -> dict:
+        self.check_stopped()
+        self.checkpoints.save(self.emulator)
+        return {"checkpoints": self.checkpoints.get_cycles()}
+
+    def command_restore_checkpoint(self, cycles: int | None = None) -> dict:
+        # restores the latest checkpoint at or before cycles, or the latest one
+        self.check_stopped()
+        checkpoint = self.checkpoints.find(cycles)
+        if checkpoint is None:
+            raise DebugServerError("no checkpoint to restore")
+
+        try:
+            self.restore(self.checkpoints.load(checkpoint))
+        except (OSError, ValueError) as e:
+            raise DebugServerError(f"failed to restore the checkpoint at cycle {checkpoint}: {e}") from e
+        return self.get_state()
+
+def get_address(address) -> int:
+    if not isinstance(address, int) or not 0 <= address < 2**10:
+        raise DebugServerError(f"invalid address {address!r}")
+
+    return address
+
+async def handle_client(session: DebugSession, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+            except ValueError:
+                # also raised for lines that aren't valid utf-8
+                response = {"error": "request is not valid json"}
+            else:
+                try:
+                    response = await session.handle(request)
+                except DebugServerError as e:
+                    response = {"error": str(e)}
+
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+def parse_address(address: str) -> tuple[str | None, int | None]:
+    # "host:port" is a tcp address, anything else is the path of a unix socket
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return host or "127.0.0.1", int(port)
+
+    return None, None
+
+async def stop_watching(watcher: asyncio.Task | None) -> None:
+    if watcher is not None:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+
+async def serve(session: DebugSession, address: str) -> None:
+    watcher = asyncio.create_task(session.watch()) if session.path is not None else None
+    try:
+        host, port = parse_address(address)
+        if port is None:
+            server = await asyncio.start_unix_server(lambda reader, writer: handle_client(session, reader, writer), address)
+        else:
+            server = await asyncio.start_server(lambda reader, writer: handle_client(session, reader, writer), host, port)
+
+        async with server:
+            await server.serve_forever()
+    finally:
+        await stop_watching(watcher)
+
+class DebugClient:
+    # a blocking connection to a debug server
+    def __init__(self, connection: socket.socket) -> None:
+        self.connection = connection
+        self.file = connection.makefile("rb")
+
+    @classmethod
+    def connect(cls, address: str) -> "DebugClient":
+        host, port = parse_address(address)
+        if port is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(address)
+        else:
+            connection = socket.create_connection((host, port))
+
+        return cls(connection)
+
+    def request(self, command: str, **arguments) -> dict:
+        self.connection.sendall(json.dumps({"command": command, **arguments}).encode() + b"\n")
+
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("the debug server closed the connection")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise DebugServerError(response["error"])
+        return response
+
+    def close(self) -> None:
+        self.file.close()
+        self.connection.close()
+
+def start_local_session(session: DebugSession) -> DebugClient:
+    # serves the session on a background thread to a single client connected through a socket pair
+    server_connection, client_connection = socket.socketpair()
+
+    async def serve_connection() -> None:
+        # the session ends with its only client
+        watcher = asyncio.create_task(session.watch()) if session.path is not None else None
+        try:
+            reader, writer = await asyncio.open_connection(sock=server_connection)
+            await handle_client(session, reader, writer)
+        finally:
+            await stop_watching(watcher)
+
+    threading.Thread(target=asyncio.run, args=(serve_connection(),), daemon=True).start()
+    return DebugClient(client_connection)
+
+if __name__ == "__main__":
+    # headless servers run at full speed unless reverse stepping is asked for
+    journal_size = 0
+    seed = None
+    checkpoint_dir = None
+    checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+    resume_path = None
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] == "--journal-size" and len(sys.argv) > 2:
+            journal_size = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--seed" and len(sys.argv) > 2:
+            seed = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--checkpoint-dir" and len(sys.argv) > 2:
+            checkpoint_dir = sys.argv.pop(2)
+        elif sys.argv[1] == "--checkpoint-interval" and len(sys.argv) > 2:
+            if not sys.argv[2].isdecimal() or int(sys.argv[2]) == 0:
+                print(f"checkpoint interval must be a positive integer, not {sys.argv[2]!r}")
+                print_help(error=True)
+            checkpoint_interval = int(sys.argv.pop(2))
+        elif sys.argv[1] == "--resume" and len(sys.argv) > 2:
+            resume_path = sys.argv.pop(2)
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 3:
+        print_help(error=True)
+
+    with open(sys.argv[2], "rb") as f:
+        machine_code = f.read()
+
+    # display output goes to stdout
+    session = DebugSession(machine_code, journal_size, lambda: create_default_bus(sys.stdout, seed)[0], sys.argv[2], checkpoint_dir, checkpoint_interval)
+    if resume_path is not None:
+        try:
+            session.restore(load_resume_snapshot(machine_code, resume_path))
+        except (OSError, ValueError) as e:
+            print(f"can't resume from {resume_path}: {e}", file=sys.stderr)
+            exit(1)
+    print(f"serving {sys.argv[2]} on {sys.argv[1]}", file=sys.stderr)
+    try:
+        asyncio.run(serve(session, sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,257 @@
+import mmap
+import struct
+import sys
+
+from debuginfo import load_debug_info
+
+# binary execution trace layout, all integers are little endian:
+#   header
+#   records: one per executed instruction, in execution order
+TRACE_MAGIC = b"BTRC"
+TRACE_VERSION = 1
+
+# magic, version, record size, start cycle, initial registers r0-r7
+TRACE_HEADER = struct.Struct("<4sHHQ8s")
+# cycle, pc, instruction, info, written register value, memory address, memory value
+TRACE_RECORD = struct.Struct("<QHHBBBB")
+
+# info byte: written register in bits 0-2 (0 when none), memory write, branch taken
+TRACE_INFO_REGISTER = 0b111
+TRACE_INFO_MEMORY_WRITE = 0b1000
+TRACE_INFO_BRANCH_TAKEN = 0b10000
+
+# offsets of the columns in a record
+CYCLE_OFFSET = 0
+PC_OFFSET = 8
+INSTRUCTION_OFFSET = 10
+INFO_OFFSET = 12
+REGISTER_VALUE_OFFSET = 13
+MEMORY_ADDRESS_OFFSET = 14
+MEMORY_VALUE_OFFSET = 15
+
+TRACE_BUFFER_RECORDS = 2**16
+
+def print_help(error: bool) -> None:
+    print(f"usage: {sys.argv[0]} [flags] <trace>")
+    print("flags:")
+    print("  -h, --help: show this help message")
+    print("  -m, --memory <address>: show the last write to memory[address]")
+    print("  -v, --visits <address|label>: show all visits to an address or label")
+    print("  -r, --register <register>: show the first cycle where the register changed")
+    print("  -d, --debug-info <path>: debug information used to resolve labels and lines")
+    print("without a query a summary of the trace is shown")
+
+    exit(1 if error else 0)
+
+class TraceWriter:
+    # streams fixed-width records to a file, packed into a reusable buffer and written out once it's full
+    def __init__(self, path: str, start_cycle: int, regs: bytes) -> None:
+        self.file = open(path, "wb")
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, start_cycle, bytes(regs[:8])))
+
+        self.buffer = bytearray(TRACE_BUFFER_RECORDS * TRACE_RECORD.size)
+        self.offset = 0
+        self.records = 0
+
+    def write(self, cycle: int, pc: int, instruction: int, reg: int, reg_value: int, address: int | None, value: int, branch_taken: bool) -> None:
+        info = reg
+        if address is not None:
+            info |= TRACE_INFO_MEMORY_WRITE
+        else:
+            address = 0
+        if branch_taken:
+            info |= TRACE_INFO_BRANCH_TAKEN
+
+        TRACE_RECORD.pack_into(self.buffer, self.offset, cycle, pc, instruction, info, reg_value, address, value)
+        self.offset += TRACE_RECORD.size
+        self.records += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self) -> None:
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+class TraceReader:
+    # memory maps a trace, queries scan a single column at a time
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, record_size, self.start_cycle, regs = TRACE_HEADER.unpack_from(self.buffer, 0)
+        if magic != TRACE_MAGIC:
+            raise ValueError("not a trace file")
+        if version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise ValueError(f"unsupported trace version {version}")
+
+        self.initial_regs = list(regs)
+        self.records = (len(self.buffer) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def __len__(self) -> int:
+        return self.records
+
+    def __getitem__(self, index: int) -> tuple[int, int, int, int, int, int, int]:
+        if index < 0:
+            index += self.records
+        if index < 0 or index >= self.records:
+            raise IndexError("record index out of range")
+
+        return TRACE_RECORD.unpack_from(self.buffer, TRACE_HEADER.size + index * TRACE_RECORD.size)
+
+    def column(self, offset: int) -> bytes:
+        # one byte of every record
+        end = TRACE_HEADER.size + self.records * TRACE_RECORD.size
+        return self.buffer[TRACE_HEADER.size + offset:end:TRACE_RECORD.size]
+
+    def find_last_memory_write(self, address: int) -> int | None:
+        addresses = self.column(MEMORY_ADDRESS_OFFSET)
+        infos = self.column(INFO_OFFSET)
+
+        index = addresses.rfind(address)
+        while index != -1:
+            if infos[index] & TRACE_INFO_MEMORY_WRITE:
+                return index
+            index = addresses.rfind(address, 0, index)
+
+        return None
+
+    def find_visits(self, pc: int) -> list[int]:
+        lows = self.column(PC_OFFSET)
+        highs = self.column(PC_OFFSET + 1)
+
+        visits = []
+        index = lows.find(pc & 0xff)
+        while index != -1:
+            if highs[index] == pc >> 8:
+                visits.append(index)
+            index = lows.find(pc & 0xff, index + 1)
+
+        return visits
+
+    def find_first_register_change(self, reg: int) -> int | None:
+        # 1 for every record that writes the register, so only those are visited
+        writes = self.column(INFO_OFFSET).translate(bytes(int(info & TRACE_INFO_REGISTER == reg) for info in range(256)))
+        values = self.column(REGISTER_VALUE_OFFSET)
+
+        value = self.initial_regs[reg]
+        index = writes.find(1)
+        while index != -1:
+            if values[index] != value:
+                return index
+            index = writes.find(1, index + 1)
+
+        return None
+
+def parse_integer(string: str) -> int:
+    return int(string, 0)
+
+def format_record(record: tuple[int, int, int, int, int, int, int], source_map: dict[int, int]) -> str:
+    cycle, pc, instruction, info, reg_value, address, value = record
+
+    line = f"cycle {cycle}: pc {pc:#05x} instruction {instruction:#06x}"
+    if pc in source_map:
+        line += f" line {source_map[pc]}"
+    if info & TRACE_INFO_REGISTER:
+        line += f", r{info & TRACE_INFO_REGISTER} = {reg_value:#04x}"
+    if info & TRACE_INFO_MEMORY_WRITE:
+        line += f", memory[{address:#04x}] = {value:#04x}"
+    if info & TRACE_INFO_BRANCH_TAKEN:
+        line += ", branch taken"
+
+    return line
+
+def print_summary(trace: TraceReader) -> None:
+    print(f"{len(trace)} records")
+    if len(trace) == 0:
+        return
+
+    infos = trace.column(INFO_OFFSET)
+    memory_writes = sum(infos.translate(bytes(int(bool(info & TRACE_INFO_MEMORY_WRITE)) for info in range(256))))
+    branches_taken = sum(infos.translate(bytes(int(bool(info & TRACE_INFO_BRANCH_TAKEN)) for info in range(256))))
+
+    print(f"cycles {trace[0][0]} to {trace[-1][0]}")
+    print(f"{memory_writes} memory writes, {branches_taken} branches taken")
+
+if __name__ == "__main__":
+    memory_address = None
+    visit = None
+    register = None
+    debug_info_path = None
+    while len(sys.argv) > 1 and sys.argv[1].startswith("-"):
+        if sys.argv[1] in ["-h", "--help"]:
+            print_help(error=False)
+        elif sys.argv[1] in ["-m", "--memory"] and len(sys.argv) > 2:
+            memory_address = parse_integer(sys.argv.pop(2))
+        elif sys.argv[1] in ["-v", "--visits"] and len(sys.argv) > 2:
+            visit = sys.argv.pop(2)
+        elif sys.argv[1] in ["-r", "--register"] and len(sys.argv) > 2:
+            register = int(sys.argv.pop(2).lower().removeprefix("r"))
+        elif sys.argv[1] in ["-d", "--debug-info"] and len(sys.argv) > 2:
+            debug_info_path = sys.argv.pop(2)
+        else:
+            print(f"unknown flag {sys.argv[1]!r}")
+            print_help(error=True)
+
+        sys.argv.pop(1)
+
+    if len(sys.argv) < 2:
+        print_help(error=True)
+
+    trace = TraceReader(sys.argv[1])
+
+    labels = {}
+    source_map = {}
+    if debug_info_path is not None:
+        debug_info = load_debug_info(debug_info_path)
+        labels = {name: address for name, (address, _) in debug_info.labels.items()}
+        source_map = dict(debug_info.instructions)
+
+    if memory_address is not None:
+        if not 0 <= memory_address <= 0xff:
+            print(f"memory address {memory_address} out of range")
+            exit(1)
+
+        index = trace.find_last_memory_write(memory_address)
+        if index is None:
+            print(f"memory[{memory_address:#04x}] is never written")
+        else:
+            print(format_record(trace[index], source_map))
+
+    if visit is not None:
+        if visit in labels:
+            pc = labels[visit]
+        else:
+            try:
+                pc = parse_integer(visit)
+            except ValueError:
+                print(f"unknown label {visit!r}" + ("" if debug_info_path else ", pass --debug-info to resolve labels"))
+                exit(1)
+
+        visits = trace.find_visits(pc)
+        for index in visits:
+            print(format_record(trace[index], source_map))
+        print(f"{len(visits)} visits to {pc:#05x}")
+
+    if register is not None:
+        if not 1 <= register <= 7:
+            print(f"register r{register} can't change")
+            exit(1)
+
+        index = trace.find_first_register_change(register)
+        if index is None:
+            print(f"r{register} never changes")
+        else:
+            print(format_record(trace[index], source_map))
+
+    if memory_address is None and visit is None and register is None:
+        print_summary(trace)
@@ -0,0 +1,214 @@
+import json
+import mmap
+import struct
+
+# binary debug info layout, all integers are little endian:
+#   header
+#   instructions: (address, line) per instruction
+#   labels: (name offset, name length, address, line) per label, names are stored in the strings blob
+#   line offsets: offset of every line in the source blob, plus the offset of the end of the source
+#   source path, utf-8
+#   strings blob: the label names, utf-8
+#   source blob: the source, utf-8
+#   files header (version 2)
+#   files: (path size, line count, source size), path, line offsets and source per included file
+#   origins: (address, file, line) per instruction written somewhere else than its line of the source (in an
+#   included file or a macro), file 0 is the source itself and file n the nth included file
+DEBUG_INFO_MAGIC = b"BDBG"
+DEBUG_INFO_VERSION = 2
+
+# magic, version, reserved, instruction count, label count, line count, source path size, strings size, source size
+HEADER = struct.Struct("<4sHHIIIIII")
+INSTRUCTION = struct.Struct("<HI")
+LABEL = struct.Struct("<IIHI")
+LINE_OFFSET = struct.Struct("<I")
+# file count, origin count
+FILES_HEADER = struct.Struct("<II")
+FILE = struct.Struct("<III")
+ORIGIN = struct.Struct("<HHI")
+
+def get_line_offsets(source: bytes) -> list[int]:
+    # offsets of the lines, as split on "\n", plus the offset past the end
+    line_offsets = [0]
+    for i, byte in enumerate(source):
+        if byte == ord("\n"):
+            line_offsets.append(i + 1)
+    line_offsets.append(len(source) + 1)
+
+    return line_offsets
+
+def pack_debug_info(debug_info: dict) -> bytes:
+    source = debug_info["source"].encode()
+    source_path = debug_info["source_path"].encode()
+
+    line_offsets = get_line_offsets(source)
+
+    strings = bytearray()
+    labels = []
+    for name, label in debug_info["labels"].items():
+        name = name.encode()
+        labels.append(LABEL.pack(len(strings), len(name), label["address"], label["line"]))
+        strings += name
+
+    files = []
+    file_indices = {debug_info["source_path"]: 0}
+    for path, file_source in debug_info.get("files", {}).items():
+        file_indices[path] = len(file_indices)
+
+        encoded_path = path.encode()
+        file_source = file_source.encode()
+        file_line_offsets = get_line_offsets(file_source)
+        files += [
+            FILE.pack(len(encoded_path), len(file_line_offsets) - 1, len(file_source)), encoded_path,
+            *(LINE_OFFSET.pack(offset) for offset in file_line_offsets), file_source,
+        ]
+
+    origins = [
+        ORIGIN.pack(instruction["address"], file_indices[instruction["origin"]["path"]], instruction["origin"]["line"])
+        for instruction in debug_info["instructions"] if "origin" in instruction
+    ]
+
+    return b"".join([
+        HEADER.pack(
+            DEBUG_INFO_MAGIC, DEBUG_INFO_VERSION, 0,
+            len(debug_info["instructions"]), len(labels), len(line_offsets) - 1,
+            len(source_path), len(strings), len(source),
+        ),
+        *(INSTRUCTION.pack(instruction["address"], instruction["line"]) for instruction in debug_info["instructions"]),
+        *labels,
+        *(LINE_OFFSET.pack(offset) for offset in line_offsets),
+        source_path,
+        strings,
+        source,
+        FILES_HEADER.pack(len(debug_info.get("files", {})), len(origins)),
+        *files,
+        *origins,
+    ])
+
+class SourceLines:
+    # the lines of a source blob, only decoded when they're accessed
+    def __init__(self, buffer, line_count: int, line_offsets_offset: int, source_offset: int) -> None:
+        self.buffer = buffer
+        self.line_count = line_count
+        self.line_offsets_offset = line_offsets_offset
+        self.source_offset = source_offset
+
+    def __len__(self) -> int:
+        return self.line_count
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += self.line_count
+        if index < 0 or index >= self.line_count:
+            raise IndexError("line index out of range")
+
+        start, end = struct.unpack_from("<II", self.buffer, self.line_offsets_offset + index * LINE_OFFSET.size)
+        return self.buffer[self.source_offset + start:self.source_offset + end - 1].decode()
+
+class DebugInfo:
+    def __init__(self, source_path: str, lines, instructions: list[tuple[int, int]], labels: dict[str, tuple[int, int]], files: dict | None = None, origins: dict[int, tuple[str, int]] | None = None) -> None:
+        self.source_path = source_path
+        # list (or SourceLines) of the lines of the source
+        self.lines = lines
+        # (address, line) per instruction
+        self.instructions = instructions
+        # name: (address, line)
+        self.labels = labels
+        # path: lines, of every included file
+        self.files = files if files is not None else {}
+        # address: (path, line) it was written on, of the instructions that were included or expanded from a
+        # macro, their line is the line of the include or the macro call
+        self.origins = origins if origins is not None else {}
+
+    def get_origin_line(self, address: int) -> tuple[str, int, str] | None:
+        # (path, line number, line) the instruction at address was written on, when that's not its line
+        if address not in self.origins:
+            return None
+
+        path, line_number = self.origins[address]
+        lines = self.lines if path == self.source_path else self.files.get(path, [])
+        return path, line_number, lines[line_number - 1] if line_number <= len(lines) else ""
+
+    @property
+    def source(self) -> str:
+        return "\n".join(self.lines[i] for i in range(len(self.lines)))
+
+    @staticmethod
+    def from_json(debug_info: dict) -> "DebugInfo":
+        return DebugInfo(
+            debug_info["source_path"],
+            debug_info["source"].split("\n"),
+            [(instruction["address"], instruction["line"]) for instruction in debug_info["instructions"]],
+            {name: (label["address"], label["line"]) for name, label in debug_info["labels"].items()},
+            {path: source.split("\n") for path, source in debug_info.get("files", {}).items()},
+            {
+                instruction["address"]: (instruction["origin"]["path"], instruction["origin"]["line"])
+                for instruction in debug_info["instructions"] if "origin" in instruction
+            },
+        )
+
+    @staticmethod
+    def from_binary(buffer) -> "DebugInfo":
+        (magic, version, _, instruction_count, label_count, line_count,
+         source_path_size, strings_size, source_size) = HEADER.unpack_from(buffer, 0)
+        if magic != DEBUG_INFO_MAGIC:
+            raise ValueError("not a binary debug info file")
+        if version not in [1, DEBUG_INFO_VERSION]:
+            raise ValueError(f"unsupported debug info version {version}")
+
+        offset = HEADER.size
+        instructions = list(INSTRUCTION.iter_unpack(buffer[offset:offset + instruction_count * INSTRUCTION.size]))
+        offset += instruction_count * INSTRUCTION.size
+
+        label_entries = list(LABEL.iter_unpack(buffer[offset:offset + label_count * LABEL.size]))
+        offset += label_count * LABEL.size
+
+        line_offsets_offset = offset
+        offset += (line_count + 1) * LINE_OFFSET.size
+
+        source_path = buffer[offset:offset + source_path_size].decode()
+        offset += source_path_size
+
+        strings = buffer[offset:offset + strings_size]
+        offset += strings_size
+
+        labels = {}
+        for name_offset, name_length, address, line in label_entries:
+            labels[strings[name_offset:name_offset + name_length].decode()] = (address, line)
+
+        lines = SourceLines(buffer, line_count, line_offsets_offset, offset)
+        offset += source_size
+        if version == 1:
+            return DebugInfo(source_path, lines, instructions, labels)
+
+        file_count, origin_count = FILES_HEADER.unpack_from(buffer, offset)
+        offset += FILES_HEADER.size
+
+        files = {}
+        paths = [source_path]
+        for _ in range(file_count):
+            path_size, file_line_count, file_source_size = FILE.unpack_from(buffer, offset)
+            offset += FILE.size
+            path = buffer[offset:offset + path_size].decode()
+            offset += path_size
+
+            file_line_offsets_offset = offset
+            offset += (file_line_count + 1) * LINE_OFFSET.size
+            files[path] = SourceLines(buffer, file_line_count, file_line_offsets_offset, offset)
+            paths.append(path)
+            offset += file_source_size
+
+        origins = {}
+        for address, file, line in ORIGIN.iter_unpack(buffer[offset:offset + origin_count * ORIGIN.size]):
+            origins[address] = (paths[file], line)
+
+        return DebugInfo(source_path, lines, instructions, labels, files, origins)
+
+def load_debug_info(path: str) -> DebugInfo:
+    with open(path, "rb") as f:
+        if f.read(len(DEBUG_INFO_MAGIC)) != DEBUG_INFO_MAGIC:
+            f.seek(0)
+            return DebugInfo.from_json(json.load(f))
+
+        # the file stays mapped for as long as the source lines are in use
+        return DebugInfo.from_binary(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
@@ -0,0 +1,193 @@
+import collections
+import os
+import random
+import stat
+from typing import TextIO
+
+# default ports of the devices, as on the batpu-2
+CHARACTER_DISPLAY_PORTS = range(247, 250)
+NUMBER_DISPLAY_PORTS = range(250, 254)
+RNG_PORT = 254
+CONTROLLER_PORT = 255
+
+# character codes of the character display
+CHARACTERS = " ABCDEFGHIJKLMNOPQRSTUVWXYZ.!?"
+
+# output devices collect their output and write it to the stream once this many characters are pending
+OUTPUT_CHUNK_SIZE = 4096
+
+# cycles the emulator runs between giving the event loop a chance to read input
+ASYNC_SLICE_CYCLES = 2**14
+
+class Device:
+    # a device on one or more ports, pld reads a value from it and pst writes one to it
+    def read(self, port: int) -> int:
+        return 0
+
+    def write(self, port: int, value: int) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+class PortBus:
+    def __init__(self) -> None:
+        self.devices = []
+        # port: device on that port
+        self.ports = [None] * 256
+
+    def attach(self, device: Device, ports: range | list[int]) -> Device:
+        for port in ports:
+            if self.ports[port] is not None:
+                raise ValueError(f"port {port} is already in use")
+            self.ports[port] = device
+
+        self.devices.append(device)
+        return device
+
+    def flush(self) -> None:
+        for device in self.devices:
+            device.flush()
+
+class OutputBuffer:
+    # collects output for a stream and writes it in chunks. devices that write to the same stream share one buffer,
+    # so their output stays in the order the program wrote it
+    def __init__(self, stream: TextIO) -> None:
+        self.stream = stream
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text: str) -> None:
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= OUTPUT_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.stream.flush()
+            self.pending.clear()
+            self.pending_size = 0
+
+class OutputDevice(Device):
+    # writes its output to a buffer, a stream gets a buffer of its own
+    def __init__(self, output: TextIO | OutputBuffer) -> None:
+        self.buffer = output if isinstance(output, OutputBuffer) else OutputBuffer(output)
+
+    def output(self, text: str) -> None:
+        self.buffer.write(text)
+
+    def flush(self) -> None:
+        self.buffer.flush()
+
+class CharacterDisplay(OutputDevice):
+    # write character, show the written characters as a line, clear the written characters
+    def __init__(self, output: TextIO | OutputBuffer, ports: range = CHARACTER_DISPLAY_PORTS) -> None:
+        super().__init__(output)
+        self.write_port, self.show_port, self.clear_port = ports
+        self.characters = []
+
+    def write(self, port: int, value: int) -> None:
+        if port == self.write_port:
+            self.characters.append(CHARACTERS[value] if value < len(CHARACTERS) else "?")
+        elif port == self.show_port:
+            self.output("".join(self.characters) + "\n")
+        elif port == self.clear_port:
+            self.characters.clear()
+
+class NumberDisplay(OutputDevice):
+    # show number, clear, signed mode, unsigned mode
+    def __init__(self, output: TextIO | OutputBuffer, ports: range = NUMBER_DISPLAY_PORTS) -> None:
+        super().__init__(output)
+        self.show_port, self.clear_port, self.signed_port, self.unsigned_port = ports
+        self.signed = False
+
+    def write(self, port: int, value: int) -> None:
+        if port == self.show_port:
+            self.output(f"{value - 256 if self.signed and value & 0x80 else value}\n")
+        elif port == self.clear_port:
+            self.output("\n")
+        elif port == self.signed_port:
+            self.signed = True
+        elif port == self.unsigned_port:
+            self.signed = False
+
+class RandomNumberGenerator(Device):
+    def __init__(self, seed: int | None = None) -> None:
+        self.random = random.Random(seed)
+
+    def read(self, port: int) -> int:
+        return self.random.randrange(256)
+
+class InputDevice(Device):
+    # returns the bytes fed to it one per read, and keeps returning the last one once it runs out
+    def __init__(self) -> None:
+        self.pending = collections.deque()
+        self.value = 0
+
+    def feed(self, data: bytes) -> None:
+        self.pending.extend(data)
+
+    def read(self, port: int) -> int:
+        if self.pending:
+            self.value = self.pending.popleft()
+        return self.value
+
+def create_default_bus(output: TextIO, seed: int | None = None) -> tuple[PortBus, InputDevice]:
+    # returns a bus with a character display, number display, rng and controller, and the controller
+    bus = PortBus()
+    # both displays write to output
+    buffer = OutputBuffer(output)
+    bus.attach(CharacterDisplay(buffer), CHARACTER_DISPLAY_PORTS)
+    bus.attach(NumberDisplay(buffer), NUMBER_DISPLAY_PORTS)
+    bus.attach(RandomNumberGenerator(seed), [RNG_PORT])
+    controller = bus.attach(InputDevice(), [CONTROLLER_PORT])
+
+    return bus, controller
+
+async def feed_input(device: InputDevice, fd: int) -> None:
+    # feeds everything that arrives on fd to the device without blocking the event loop
+    import asyncio
+
+    reader = asyncio.StreamReader()
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", closefd=False))
+    try:
+        while data := await reader.read(OUTPUT_CHUNK_SIZE):
+            device.feed(data)
+    finally:
+        transport.close()
+
+async def run_async(emulator, max_cycles: int | None, inputs: list[tuple[InputDevice, int]], after_slice=None) -> str | None:
+    # runs the emulator in slices, reading the input streams in between, until it emits a message. after_slice is
+    # called after every slice. asyncio is imported here since it's slow to import and only async runs need it
+    import asyncio
+
+    tasks = []
+    for device, fd in inputs:
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            # regular files never block, so they're read before the first slice instead of racing it
+            with os.fdopen(fd, "rb", closefd=False) as f:
+                device.feed(f.read())
+        else:
+            tasks.append(asyncio.create_task(feed_input(device, fd)))
+    # let the readers connect to their pipes before the program starts
+    await asyncio.sleep(0)
+
+    message = None
+    try:
+        while message is None and (max_cycles is None or emulator.cycles < max_cycles):
+            budget = ASYNC_SLICE_CYCLES
+            if max_cycles is not None:
+                budget = min(budget, max_cycles - emulator.cycles)
+            message = emulator.run(budget)
+            if after_slice is not None:
+                after_slice()
+            await asyncio.sleep(0)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return message
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import struct
+
+# binary snapshot layout, all integers are little endian:
+#   header
+#   call stack: return address per entry, the outermost call first
+SNAPSHOT_MAGIC = b"BSNP"
+SNAPSHOT_VERSION = 1
+
+# magic, version, flags, cycles, pc, call stack depth, registers r0-r7, memory, sha-256 of the rom
+SNAPSHOT_HEADER = struct.Struct("<4sHHQHI8s256s32s")
+STACK_ENTRY = struct.Struct("<H")
+
+SNAPSHOT_ZERO = 0b1
+SNAPSHOT_CARRY = 0b10
+
+# cycles between the checkpoints of a long run by default
+DEFAULT_CHECKPOINT_INTERVAL = 1_000_000
+
+def get_rom_hash(machine_code: bytes) -> bytes:
+    # hash of the rom as the emulator loads it, so padding with nops doesn't change it
+    return hashlib.sha256(machine_code[:2 * 2**10].ljust(2 * 2**10, b"\x00")).digest()
+
+def pack_snapshot(emulator) -> bytes:
+    flags = emulator.zero * SNAPSHOT_ZERO | emulator.carry * SNAPSHOT_CARRY
+
+    return b"".join([
+        SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, emulator.cycles, emulator.pc, len(emulator.stack),
+            bytes(emulator.regs[:8]), bytes(emulator.memory), get_rom_hash(emulator.machine_code),
+        ),
+        *(STACK_ENTRY.pack(address) for address in emulator.stack),
+    ])
+
+def restore_snapshot(emulator, snapshot: bytes) -> None:
+    # raises a ValueError for anything but a snapshot of the rom the emulator runs, the journal is cleared since
+    # there's nothing to step back to
+    if len(snapshot) < SNAPSHOT_HEADER.size:
+        raise ValueError("not a snapshot")
+
+    magic, version, flags, cycles, pc, depth, regs, memory, rom_hash = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("not a snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+    if rom_hash != get_rom_hash(emulator.machine_code):
+        raise ValueError("the snapshot was taken of a different rom")
+    if len(snapshot) != SNAPSHOT_HEADER.size + depth * STACK_ENTRY.size:
+        raise ValueError("truncated snapshot")
+    if pc >= 2**10:
+        raise ValueError(f"invalid pc {pc}")
+    if regs[0] != 0:
+        # writes to r0 are discarded, the emulator relies on it reading 0
+        raise ValueError(f"invalid r0 {regs[0]}, it's always 0")
+    stack = [address for address, in STACK_ENTRY.iter_unpack(snapshot[SNAPSHOT_HEADER.size:])]
+    if any([address >= 2**10 for address in stack]):
+        raise ValueError("invalid return address on the call stack")
+
+    emulator.cycles = cycles
+    emulator.pc = pc
+    emulator.regs[:8] = regs
+    emulator.memory[:] = memory
+    emulator.zero = bool(flags & SNAPSHOT_ZERO)
+    emulator.carry = bool(flags & SNAPSHOT_CARRY)
+    emulator.stack[:] = stack
+
+    if emulator.journal is not None:
+        emulator.journal.clear()
+
+class Checkpoints:
+    # snapshots of one rom by cycle. they're kept in a directory, so later sessions can resume from them, which can
+    # hold the checkpoints of any amount of roms, or in memory without one
+    def __init__(self, machine_code: bytes, directory: str | None = None) -> None:
+        self.prefix = get_rom_hash(machine_code).hex()[:16]
+        self.directory = directory
+        # cycles: snapshot, without a directory
+        self.snapshots = {}
+
+    def get_path(self, cycles: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{cycles:016d}.snap")
+
+    def save(self, emulator) -> None:
+        snapshot = pack_snapshot(emulator)
+        if self.directory is None:
+            self.snapshots[emulator.cycles] = snapshot
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(emulator.cycles)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(snapshot)
+        os.replace(temp_path, path)
+
+    def get_cycles(self) -> list[int]:
+        if self.directory is None:
+            return sorted(self.snapshots)
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        cycles = []
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{self.prefix}-") and name.endswith(".snap"):
+                cycles.append(int(name[len(self.prefix) + 1:-len(".snap")]))
+        return sorted(cycles)
+
+    def load(self, cycles: int) -> bytes:
+        if self.directory is None:
+            return self.snapshots[cycles]
+
+        with open(self.get_path(cycles), "rb") as f:
+            return f.read()
+
+    def find(self, max_cycles: int | None = None) -> int | None:
+        # cycle of the latest checkpoint at or before max_cycles
+        cycles = [checkpoint for checkpoint in self.get_cycles() if max_cycles is None or checkpoint <= max_cycles]
+        return cycles[-1] if cycles else None